@@ -0,0 +1,160 @@
+import json
+
+MB = 1024 * 1024
+
+
+def _number(name, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"{name} has to be a non-negative number")
+    return value
+
+
+def _words(name, value):
+    if not isinstance(value, list) or not all(isinstance(item, str) and item for item in value):
+        raise ValueError(f"{name} has to be a list of non-empty strings")
+    return [item.lower() for item in value]
+
+
+def _max_size(limit):
+    limit = limit * MB
+    return lambda message, file: file.size is None or file.size <= limit
+
+
+def _min_size(limit):
+    limit = limit * 1024
+    return lambda message, file: file.size is None or file.size >= limit
+
+
+def _max_duration(limit):
+    return lambda message, file: file.duration is None or file.duration <= limit
+
+
+def _min_duration(limit):
+    return lambda message, file: file.duration is None or file.duration >= limit
+
+
+def _min_width(limit):
+    return lambda message, file: not file.width or file.width >= limit
+
+
+def _min_height(limit):
+    return lambda message, file: not file.height or file.height >= limit
+
+
+def _min_aspect(limit):
+    return lambda message, file: not file.width or not file.height or file.width / file.height >= limit
+
+
+def _max_aspect(limit):
+    return lambda message, file: not file.width or not file.height or file.width / file.height <= limit
+
+
+def _mime_types(patterns):
+    exact = frozenset(pattern for pattern in patterns if not pattern.endswith("/*"))
+    prefixes = tuple(pattern[:-1] for pattern in patterns if pattern.endswith("/*"))
+
+    def check(message, file):
+        mime_type = (file.mime_type or "").lower()
+        return mime_type in exact or mime_type.startswith(prefixes)
+    return check
+
+
+def _blocked_keywords(words):
+    def check(message, file):
+        caption = (message.message or "").lower()
+        return not any(word in caption for word in words)
+    return check
+
+
+def _required_keywords(words):
+    def check(message, file):
+        caption = (message.message or "").lower()
+        return any(word in caption for word in words)
+    return check
+
+
+# rule name -> (validator, factory of the check), the name is what the rejection counters show
+RULES = {
+    "max_size_mb": (_number, _max_size),
+    "min_size_kb": (_number, _min_size),
+    "max_duration": (_number, _max_duration),
+    "min_duration": (_number, _min_duration),
+    "min_width": (_number, _min_width),
+    "min_height": (_number, _min_height),
+    "min_aspect": (_number, _min_aspect),
+    "max_aspect": (_number, _max_aspect),
+    "mime_types": (_words, _mime_types),
+    "blocked_keywords": (_words, _blocked_keywords),
+    "required_keywords": (_words, _required_keywords),
+}
+
+
+def _validate(rules, where):
+    if not isinstance(rules, dict):
+        raise ValueError(f"{where} has to be an object")
+    validated = {}
+    for name, value in rules.items():
+        if name not in RULES:
+            raise ValueError(f"unknown rule {name} in {where}")
+        # null in a source turns off the global rule of the same name
+        validated[name] = None if value is None else RULES[name][0](name, value)
+    return validated
+
+
+def parse_rules(text):
+    if not text:
+        return {}
+    rules = json.loads(text) if isinstance(text, str) else text
+    if not isinstance(rules, dict):
+        raise ValueError("admission rules have to be an object")
+    rules = dict(rules)
+    sources = rules.pop("sources", {})
+    validated = _validate(rules, "global rules")
+    if not isinstance(sources, dict):
+        raise ValueError("sources have to be an object of source id -> rules")
+    validated_sources = {}
+    for source_id, source_rules in sources.items():
+        try:
+            int(source_id)
+        except ValueError:
+            raise ValueError(f"{source_id} is not a source id")
+        validated_sources[str(source_id)] = _validate(source_rules, f"source {source_id}")
+    if validated_sources:
+        validated["sources"] = validated_sources
+    return validated
+
+
+def _compile(rules):
+    return tuple((name, RULES[name][1](value)) for name, value in rules.items() if value is not None)
+
+
+class AdmissionRules:
+    def __init__(self, rules=None):
+        rules = dict(rules or {})
+        sources = rules.pop("sources", {})
+        self.rules = rules
+        self.source_rules = {int(source_id): source_rules for source_id, source_rules in sources.items()}
+        self.checks = _compile(rules)
+        # a source gets one merged tuple, so a message is never checked against the global rules twice
+        self.source_checks = {source_id: _compile({**rules, **source_rules})
+                              for source_id, source_rules in self.source_rules.items()}
+
+    def __bool__(self):
+        return bool(self.checks) or any(self.source_checks.values())
+
+    def check(self, source_id, message):
+        # returns the name of the first rule the message breaks, None if it is admitted
+        checks = self.source_checks.get(source_id, self.checks)
+        if not checks:
+            return None
+        file = message.file
+        if file is None:
+            return None
+        for name, check in checks:
+            if not check(message, file):
+                return name
+        return None
+
+
+def format_rules(rules):
+    return ", ".join(f"{name}={json.dumps(value, ensure_ascii=False)}" for name, value in rules.items()) or "none"
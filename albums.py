@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ALBUM_MAX_SIZE = 10
+
+
+class AlbumBuffer:
+    def __init__(self, flush_callback, window=1.5):
+        self.flush_callback = flush_callback
+        self.window = window
+        self.albums = {}
+        self.tasks = {}
+
+    def __len__(self):
+        return sum(len(album["messages"]) for album in self.albums.values())
+
+    def add(self, client, source_id, message):
+        key = (source_id, message.grouped_id)
+        album = self.albums.setdefault(key, {"client": client, "messages": {}, "last_added": 0})
+        album["messages"][message.id] = message
+        album["last_added"] = time.monotonic()
+        if len(album["messages"]) >= ALBUM_MAX_SIZE:
+            task = self.tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+            self.tasks[key] = asyncio.create_task(self._flush(key))
+        elif key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self._wait_and_flush(key))
+
+    async def _wait_and_flush(self, key):
+        while True:
+            album = self.albums.get(key)
+            if album is None:
+                return
+            remaining = album["last_added"] + self.window - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        await self._flush(key)
+
+    async def _flush(self, key):
+        album = self.albums.pop(key, None)
+        self.tasks.pop(key, None)
+        if album is None:
+            return
+        source_id, grouped_id = key
+        messages = sorted(album["messages"].values(), key=lambda message: message.id)
+        logger.info("Album %s from %s collected (%s files)", grouped_id, source_id, len(messages))
+        try:
+            await self.flush_callback(album["client"], source_id, messages)
+        except Exception as e:
+            logger.error("Error while processing album %s from %s: %s", grouped_id, source_id, e)
+
+    async def flush_all(self):
+        for key in list(self.albums):
+            task = self.tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+            await self._flush(key)
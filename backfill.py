@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class Backfiller:
+    def __init__(self, processor, batch_size=100, message_delay=0.2, idle_check_interval=1):
+        self.processor = processor
+        self.db_manager = processor.db_manager
+        self.batch_size = batch_size
+        self.message_delay = message_delay
+        self.idle_check_interval = idle_check_interval
+        self.tasks = {}
+
+    def is_running(self, source_id):
+        task = self.tasks.get(source_id)
+        return task is not None and not task.done()
+
+    async def start(self, source_id, messages=None, days=None):
+        await self.stop(source_id)
+        until = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+        await self.db_manager.add_backfill(source_id, messages, until)
+        logger.info("Backfill for %s started (messages: %s, days: %s)", source_id, messages, days)
+        if self.processor.collects:
+            self._spawn(source_id)
+        else:
+            await self.processor.jobs.put("backfill", source_id=source_id, action="start")
+
+    async def stop(self, source_id):
+        task = self.tasks.pop(source_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            logger.info("Backfill for %s stopped", source_id)
+
+    async def stop_all(self):
+        # the Backfills rows stay, so every backfill resumes from its last saved batch on the next start
+        for source_id in list(self.tasks):
+            await self.stop(source_id)
+
+    async def cancel(self, source_id):
+        await self.stop(source_id)
+        await self.db_manager.delete_backfill(source_id)
+        if not self.processor.collects:
+            await self.processor.jobs.put("backfill", source_id=source_id, action="stop")
+
+    async def run_job(self, source_id, action):
+        # started and stopped from the bot process, the Backfills row is already written
+        await self.stop(source_id)
+        if action != "start":
+            return
+        if source_id not in self.processor.sources:
+            await self.processor.sync_sources()
+        if source_id in self.processor.sources:
+            self._spawn(source_id)
+        else:
+            logger.info("Backfill for %s was not started, the source is not active", source_id)
+
+    async def resume_all(self):
+        backfills = await self.db_manager.get_backfills()
+        for backfill in backfills:
+            source_id = backfill[0]
+            if source_id in self.processor.sources:
+                logger.info("Resuming backfill for %s from message %s", source_id, backfill[1])
+                self._spawn(source_id)
+
+    def _spawn(self, source_id):
+        self.tasks[source_id] = asyncio.create_task(self._run(source_id))
+
+    async def _wait_for_live_traffic(self):
+        while self.processor.live_in_flight > 0:
+            await asyncio.sleep(self.idle_check_interval)
+
+    async def _run(self, source_id):
+        _, offset_id, remaining, until, processed = await self.db_manager.get_backfill(source_id)
+        if offset_id is None:
+            return
+        if isinstance(until, str):
+            until = datetime.fromisoformat(until)
+        client = self.processor.pool.client_for(source_id)
+        try:
+            while remaining is None or remaining > 0:
+                limit = self.batch_size if remaining is None else min(self.batch_size, remaining)
+                batch = await client.get_messages(source_id, limit=limit, offset_id=offset_id)
+                if not batch:
+                    break
+                reached_until = False
+                for message in batch:
+                    if until is not None and message.date < until:
+                        reached_until = True
+                        break
+                    await self._wait_for_live_traffic()
+                    if not self.processor.accepting:
+                        # shutting down, the batch is not saved and runs again after the restart
+                        return
+                    await self.processor.handle_message(client, source_id, message, live=False, check_mark=False)
+                    processed += 1
+                    await asyncio.sleep(self.message_delay)
+                offset_id = batch[-1].id
+                if remaining is not None:
+                    remaining -= len(batch)
+                await self.db_manager.update_backfill(source_id, offset_id, remaining, processed)
+                if reached_until:
+                    break
+            await self.db_manager.delete_backfill(source_id)
+            logger.info("Backfill for %s finished, %s messages processed", source_id, processed)
+        except Exception as e:
+            logger.error("Backfill for %s interrupted at message %s: %s", source_id, offset_id, e)
+        finally:
+            if self.tasks.get(source_id) is asyncio.current_task():
+                del self.tasks[source_id]
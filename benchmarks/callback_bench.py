@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import time
+
+from benchmarks import ROOT
+from benchmarks.pipeline import MAIN_ADMIN, TARGET_CHANNEL, percentile, write_results
+
+# (pattern, argument indexes) of the CallbackQuery handlers before the router, in registration order
+LEGACY_PATTERNS = [
+    (rb"main$", ()), (rb"manage_sources$", ()), (r"list_sources_\d+", (2,)), (rb"add_source$", ()),
+    (r"edit_\d+", (1,)), (r"edit_state_\d+", (2,)), (r"update_state_\d+", (2, 3)), (r"edit_chance_\d+", (2,)),
+    (r"add_\d+_\d+_\d+", (1, 2, 3)), (r"delete_\d+", (1,)), (r"source_stats_\d+", (2,)), (b"sources_stats", ()),
+    (r"backfill_\d+", (1,)), (r"backfill_start_\d+_[md]_\d+", (2, 3, 4)), (r"backfill_stop_\d+", (2,)),
+    (r"approve_\d+_\d+", (1, 2)), (r"approve_instantly_\d+_\d+", (2, 3)), (r"reject_\d+_\d+", (1, 2)),
+    (r"digest_approve_\d+", (2,)), (r"digest_reject_\d+", (2,)), (rb"manage_admins$", ()),
+    (r"list_admins_\d+", (2,)), (rb"add_admin$", ()), (r"edit_admin_\d+", (2,)), (r"sub_\d+_\d+", (1, 2)),
+    (r"super_\d+_\d+", (1, 2)), (r"add_admin_\d+_\d+", (2, 3)), (r"delete_admin_\d+", (2,)),
+    (b"additional_settings", ()), (b"watermark", ()), (b"add_watermark", ()), (b"disable_watermark", ()),
+    (b"caption", ()), (b"add_caption", ()), (b"disable_caption", ()), (b"delays", ()), (r".+_delay", (0,)),
+    (b"media_types", ()), (r"update_media_.+", (2,)), (b"approval_mode", ()), (r"approval_set_(single|digest)", (2,)),
+    (b"digest_interval", ()), (b"diagnostics", ()), (r"export_traces_(chrome|jsonl)", (2,)), (b"storage", ()),
+    (b"dedup_window", ()), (b"confirmation_ttl", ()), (b"prune_now", ()), (b"reload_settings", ()),
+]
+# route name, arguments and the same button in the old format
+PRESSES = [
+    ("main", (), b"main"),
+    ("list_sources", (3, 1200), b"list_sources_3"),
+    ("edit", (1001,), b"edit_1001"),
+    ("approve", (1001, 4242), b"approve_1001_4242"),
+    ("approve_instantly", (1001, 4242), b"approve_instantly_1001_4242"),
+    ("reject", (1001, 4242), b"reject_1001_4242"),
+    ("digest_approve", (17,), b"digest_approve_17"),
+    ("new_admin", (555, 1), b"add_admin_555_1"),
+    ("update_media", ("pic",), b"update_media_pic"),
+    ("reload_settings", (), b"reload_settings"),
+]
+
+
+class FakeQuery:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+class FakeCallbackEvent:
+    def __init__(self, data, user_id=MAIN_ADMIN):
+        self.data = data
+        self.query = FakeQuery(user_id)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+async def noop(event, *args):
+    pass
+
+
+async def is_super_admin(user_id):
+    return True
+
+
+def legacy_dispatcher(admins):
+    compiled = [(re.compile(pattern if isinstance(pattern, bytes) else pattern.encode()), indexes)
+                for pattern, indexes in LEGACY_PATTERNS]
+
+    async def dispatch(event):
+        # telethon checks every CallbackQuery builder, every matching handler then parses the data again
+        for pattern, indexes in compiled:
+            if pattern.match(event.data):
+                if event.query.user_id not in admins:
+                    continue
+                data = event.data.decode("utf-8").split("_")
+                await noop(event, *[data[i] for i in indexes])
+                await event.answer()
+    return dispatch
+
+
+async def measure(dispatch, events, rounds):
+    timings = []
+    for _ in range(rounds):
+        for event in events:
+            started = time.perf_counter()
+            await dispatch(event)
+            timings.append(time.perf_counter() - started)
+    return {
+        "presses": len(timings),
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 3),
+        "p50_us": round(percentile(timings, 0.5) * 1e6, 3),
+        "p99_us": round(percentile(timings, 0.99) * 1e6, 3),
+    }
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        logging.disable(logging.CRITICAL)
+        from media_processor import MediaProcessor
+
+        processor = MediaProcessor(client_session_name="bench",
+                                   bot_session_name="bench_bot",
+                                   api_id=0,
+                                   api_hash="",
+                                   bot_token="",
+                                   main_admin=MAIN_ADMIN,
+                                   target_channel=TARGET_CHANNEL,
+                                   db_path=os.path.join(workdir, "bench.db"))
+        processor.admins = [MAIN_ADMIN]
+        router = processor.router
+        # only the dispatch itself is measured, not the handlers and their database queries
+        router.is_super_admin = is_super_admin
+        for route in router.routes.values():
+            route.handler = noop
+
+        current = [FakeCallbackEvent(router.encode(name, *route_args).encode()) for name, route_args, _ in PRESSES]
+        legacy = [FakeCallbackEvent(data) for _, _, data in PRESSES]
+        results = {
+            "routes": len(router.routes),
+            "router": await measure(router.dispatch, current, args.rounds),
+            "router_legacy_data": await measure(router.dispatch, legacy, args.rounds),
+            "regex_handlers": await measure(legacy_dispatcher(processor.admins), legacy, args.rounds),
+        }
+        os.chdir(ROOT)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time the dispatch of bot button presses")
+    parser.add_argument("--rounds", type=int, default=2000, help="how many times every button is pressed")
+    parser.add_argument("--output", default="bench_callbacks.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    write_results(output, "callbacks", parameters, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks import ROOT
+from benchmarks.pipeline import write_results
+
+SOURCE_ID = 1000
+
+
+async def child(path, workers):
+    from db_manager import DBManager
+
+    db_manager = DBManager(path)
+    counter = iter(range(10 ** 12))
+
+    async def worker():
+        for i in counter:
+            if await db_manager.claim_media_hash(f"hash_{i}", datetime.now()):
+                await db_manager.increment_posts_amount(SOURCE_ID)
+                await db_manager.update_source_mark(SOURCE_ID, i)
+                # a line is only printed after the claim was acknowledged, so it is a promise of durability
+                sys.stdout.write(f"{i}\n")
+                sys.stdout.flush()
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+
+
+def prepare(path):
+    from db_manager import DBManager
+
+    DBManager(path)
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO Sources (ChannelId, State, Chance, PostsAmount) VALUES(?, ?, ?, ?)",
+                       (SOURCE_ID, 2, 100, 0))
+    connection.commit()
+    connection.close()
+
+
+def check(path, acknowledged):
+    connection = sqlite3.connect(path)
+    try:
+        stored = {int(row[0].split("_")[1]) for row in connection.execute("SELECT MediaHash FROM Hashes")}
+        posts_amount = connection.execute("SELECT PostsAmount FROM Sources WHERE ChannelId=?", (SOURCE_ID,)).fetchone()[0]
+        mark = connection.execute("SELECT LastMessageId FROM SourceMarks WHERE ChannelId=?", (SOURCE_ID,)).fetchone()
+    finally:
+        connection.close()
+    return {
+        "acknowledged_claims": len(acknowledged),
+        "stored_claims": len(stored),
+        "lost_acknowledged_claims": len(acknowledged - stored),
+        "committed_unacknowledged_claims": len(stored - acknowledged),
+        "posts_amount": posts_amount,
+        "lost_posts_amount_increments": len(stored) - posts_amount,
+        "source_mark": mark[0] if mark else None,
+        "source_mark_behind": max(stored, default=0) - (mark[0] if mark else 0),
+    }
+
+
+def crash_round(workdir, round_number, workers, rnd, min_runtime, max_runtime):
+    path = os.path.join(workdir, f"crash_{round_number}.db")
+    prepare(path)
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.crash_test", "--child", path,
+                                "--workers", str(workers)],
+                               cwd=workdir, env=dict(os.environ, PYTHONPATH=ROOT),
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    time.sleep(rnd.uniform(min_runtime, max_runtime))
+    process.kill()
+    output, _ = process.communicate()
+    acknowledged = {int(line) for line in output.split()}
+    return check(path, acknowledged)
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    rounds = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        for round_number in range(args.rounds):
+            result = crash_round(workdir, round_number, args.workers, rnd, args.min_runtime, args.max_runtime)
+            rounds.append(result)
+            print(f"round {round_number}: {result}", flush=True)
+        os.chdir(ROOT)
+    return {
+        "rounds": rounds,
+        "lost_acknowledged_claims": sum(result["lost_acknowledged_claims"] for result in rounds),
+        "max_lost_posts_amount_increments": max(result["lost_posts_amount_increments"] for result in rounds),
+        "max_source_mark_behind": max(result["source_mark_behind"] for result in rounds),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Kill a process writing through DBManager and check what survived")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=16, help="concurrent writers in the killed process")
+    parser.add_argument("--min-runtime", type=float, default=0.5, help="seconds before the process may be killed")
+    parser.add_argument("--max-runtime", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--output", default="bench_crash.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        asyncio.run(child(args.child, args.workers))
+        return
+    output = os.path.abspath(args.output)
+    results = run(args)
+    parameters = {key: value for key, value in vars(args).items() if key not in ("output", "child")}
+    write_results(output, "crash", parameters, results)
+    if results["lost_acknowledged_claims"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
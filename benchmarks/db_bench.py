@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from hashlib import md5
+
+from benchmarks import ROOT
+from benchmarks.pipeline import percentile, write_results
+from log_setup import setup_logging
+
+FILL_CHUNK = 100000
+SOURCES = 200
+ADMINS = 10
+SETTINGS = ("watermark", "caption", "approval_mode", "digest_interval", "collector_sessions")
+
+
+def media_hash(i):
+    return md5(i.to_bytes(8, "little")).hexdigest()
+
+
+def table_rows(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def fill(path, hashes, seed):
+    rnd = random.Random(seed)
+    now = datetime.now()
+    side_rows = max(100, hashes // 100)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA synchronous=OFF")
+    cursor = connection.cursor()
+    for table in ("Hashes", "ScheduledPosts", "ConfirmationPosts", "PendingPosts", "Sources", "Admins", "Settings",
+                  "SourceMarks", "AlbumItems", "Backfills"):
+        cursor.execute(f"DELETE FROM {table}")
+    for start in range(0, hashes, FILL_CHUNK):
+        cursor.executemany("INSERT INTO Hashes (MediaHash, Date) VALUES(?, ?)",
+                           ((media_hash(i), str(now - timedelta(seconds=rnd.randrange(365 * 86400))))
+                            for i in range(start, min(hashes, start + FILL_CHUNK))))
+        connection.commit()
+    cursor.executemany("INSERT INTO ScheduledPosts (ChannelId, MessageId, TimeAdded) VALUES(?, ?, ?)",
+                       ((1000 + i % SOURCES, i, str(now - timedelta(seconds=side_rows - i))) for i in range(side_rows)))
+    cursor.executemany("INSERT INTO ConfirmationPosts (PostId, AdminId, AdminMessageId) VALUES(?, ?, ?)",
+                       ((f"{1000 + i % SOURCES}_{i}", 1 + i % ADMINS, i) for i in range(side_rows)))
+    cursor.executemany("INSERT INTO PendingPosts (PostId, ChannelId, MessageId, TimeAdded) VALUES(?, ?, ?, ?)",
+                       ((f"{1000 + i % SOURCES}_{i}", 1000 + i % SOURCES, i, str(now)) for i in range(100)))
+    cursor.executemany("INSERT INTO Sources (ChannelId, State, Chance, PostsAmount) VALUES(?, ?, ?, ?)",
+                       ((1000 + i, 2, 100, 0) for i in range(SOURCES)))
+    cursor.executemany("INSERT INTO SourceMarks (ChannelId, LastMessageId) VALUES(?, ?)",
+                       ((1000 + i, side_rows) for i in range(SOURCES)))
+    cursor.executemany("INSERT INTO AlbumItems (ChannelId, AlbumId, MessageId) VALUES(?, ?, ?)",
+                       ((1000 + i % SOURCES, i // 10, i) for i in range(side_rows)))
+    cursor.executemany("INSERT INTO Admins (UserId, UserState, MenuMessage, Subscription, SuperAdmin) VALUES(?, ?, ?, ?, ?)",
+                       ((1 + i, "idle", None, 1, int(i == 0)) for i in range(ADMINS)))
+    cursor.executemany("INSERT INTO Settings (SettingName, SettingValue) VALUES(?, ?)",
+                       ((name, "") for name in SETTINGS))
+    connection.commit()
+    connection.close()
+    return side_rows
+
+
+def build_cases(db_manager, hashes, side_rows, seed):
+    rnd = random.Random(seed)
+    counter = iter(range(10 ** 12))
+    now = datetime.now()
+
+    async def resolve_confirmation_posts(i):
+        post_id = f"bench_{i}"
+        await db_manager.add_confirmation_post(post_id, 1, i)
+        await db_manager.resolve_confirmation_posts([post_id])
+
+    def existing_row():
+        row = rnd.randrange(side_rows)
+        return 1000 + row % SOURCES, row
+
+    def existing_album():
+        source_id, row = existing_row()
+        return source_id, row // 10
+
+    async def schedule_and_pop(i):
+        await db_manager.add_scheduled_post(-1, i, now)
+        await db_manager.delete_scheduled_post(-1, i)
+
+    # write-behind methods return once the write is queued, the flush makes the timing include the commit
+    async def committed(write):
+        await write
+        await db_manager.flush()
+
+    return {
+        "get_media_hash_hit": lambda i: db_manager.get_media_hash(media_hash(rnd.randrange(hashes))),
+        "get_media_hash_miss": lambda i: db_manager.get_media_hash(media_hash(hashes + next(counter))),
+        "add_media_hash": lambda i: db_manager.add_media_hash(media_hash(hashes + next(counter)), now),
+        "claim_media_hash": lambda i: db_manager.claim_media_hash(media_hash(hashes + next(counter)), now),
+        "get_scheduled_post": lambda i: db_manager.get_scheduled_post(),
+        "count_scheduled_posts": lambda i: db_manager.count_scheduled_posts(),
+        "add_and_delete_scheduled_post": lambda i: schedule_and_pop(next(counter)),
+        "get_confirmation_posts": lambda i: db_manager.get_confirmation_posts("{}_{}".format(*existing_row())),
+        "add_and_resolve_confirmation_post": lambda i: resolve_confirmation_posts(next(counter)),
+        "get_pending_posts": lambda i: db_manager.get_pending_posts(),
+        "get_sources": lambda i: db_manager.get_sources(),
+        "get_source": lambda i: db_manager.get_source(1000 + rnd.randrange(SOURCES)),
+        "update_posts_amount": lambda i: db_manager.update_posts_amount(1000 + rnd.randrange(SOURCES), i),
+        "increment_posts_amount": lambda i: committed(db_manager.increment_posts_amount(1000 + rnd.randrange(SOURCES))),
+        "get_admins": lambda i: db_manager.get_admins(),
+        "get_admin": lambda i: db_manager.get_admin(1 + rnd.randrange(ADMINS)),
+        "get_setting": lambda i: db_manager.get_setting(rnd.choice(SETTINGS)),
+        "get_source_marks": lambda i: db_manager.get_source_marks(),
+        "update_source_mark": lambda i: committed(
+            db_manager.update_source_mark(1000 + rnd.randrange(SOURCES), side_rows + i)),
+        "get_album": lambda i: db_manager.get_album(*existing_album()),
+    }
+
+
+async def measure(call, calls, concurrency):
+    latencies = []
+    errors = 0
+    queue = iter(range(calls))
+
+    async def worker():
+        nonlocal errors
+        for i in queue:
+            start = time.perf_counter()
+            try:
+                await call(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "calls": calls,
+        "errors": errors,
+        "ops_per_second": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        "latency_p90_ms": round(percentile(latencies, 0.9) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "latency_max_ms": round(max(latencies) * 1000, 3) if latencies else None,
+    }
+
+
+async def bench_size(path, hashes, args):
+    from db_manager import DBManager
+
+    db_manager = DBManager(path)
+    if args.reuse and table_rows(path, "Hashes") == hashes:
+        side_rows = table_rows(path, "ConfirmationPosts")
+        print(f"Reusing {path} with {hashes} hashes", flush=True)
+    else:
+        print(f"Filling {path} with {hashes} hashes", flush=True)
+        started = time.perf_counter()
+        side_rows = fill(path, hashes, args.seed)
+        print(f"Filled in {time.perf_counter() - started:.1f}s", flush=True)
+    cases = build_cases(db_manager, hashes, side_rows, args.seed)
+    selected = args.methods.split(",") if args.methods else list(cases)
+    results = {}
+    for name in selected:
+        results[name] = {}
+        for concurrency in args.concurrency:
+            results[name][str(concurrency)] = await measure(cases[name], args.calls, concurrency)
+            print(f"{hashes:>10} {name:<36} x{concurrency:<3} {results[name][str(concurrency)]}", flush=True)
+    await db_manager.close()
+    return {"hashes": hashes, "side_rows": side_rows, "methods": results}
+
+
+async def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="destructg-dbbench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    if args.log:
+        setup_logging()
+    else:
+        logging.disable(logging.CRITICAL)
+    results = []
+    for hashes in args.sizes:
+        path = os.path.join(workdir, f"bench_{hashes}.db")
+        results.append(await bench_size(path, hashes, args))
+        if not args.workdir:
+            os.remove(path)
+    os.chdir(ROOT)
+    if not args.workdir:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return results
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time DBManager methods against synthetic databases of production size")
+    parser.add_argument("--sizes", type=int_list, default=[10000, 1000000],
+                        help="comma separated amounts of rows in Hashes, e.g. 10000,1000000,10000000")
+    parser.add_argument("--calls", type=int, default=200, help="calls per method and concurrency level")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8, 32],
+                        help="comma separated amounts of concurrent callers")
+    parser.add_argument("--methods", default=None, help="comma separated subset of cases to run")
+    parser.add_argument("--workdir", default=None, help="keep generated databases in this directory")
+    parser.add_argument("--reuse", action="store_true", help="reuse databases from --workdir with the same size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log", action="store_true", help="keep INFO logging enabled")
+    parser.add_argument("--output", default="bench_db.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    if args.workdir:
+        args.workdir = os.path.abspath(args.workdir)
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    write_results(output, "db", parameters, {"sizes": results})
+
+
+if __name__ == "__main__":
+    main()
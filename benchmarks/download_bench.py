@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from hashlib import md5
+
+from benchmarks.db_bench import int_list
+from benchmarks.fake_client import FakeMedia, FakeMessage, FakeTelegramClient, generate_media
+from benchmarks.pipeline import write_results
+from downloader import Downloader
+from log_setup import setup_logging
+
+MB = 1024 * 1024
+
+
+async def timed_download(downloader, client, message):
+    started = time.perf_counter()
+    bio, media_hash = await downloader.download(client, message)
+    if media_hash is None:
+        media_hash = md5(bio.getbuffer()).hexdigest()
+    return time.perf_counter() - started, media_hash
+
+
+async def run(args):
+    if args.log:
+        setup_logging()
+    else:
+        logging.disable(logging.CRITICAL)
+    # the bandwidth of the fake client is per request, so parallel ranges model separate connections
+    client = FakeTelegramClient(request_latency=args.request_latency,
+                                download_bandwidth=args.bandwidth * MB if args.bandwidth else None)
+    results = []
+    for size_mb in args.sizes:
+        content = generate_media("video", size_mb * MB, args.seed)
+        expected = md5(content).hexdigest()
+        message = FakeMessage(1, 1, media=FakeMedia("video", content, size_mb))
+        # workers=1 is the old path: one download_media stream hashed after it finished
+        sequential, media_hash = await timed_download(Downloader(workers=1), client, message)
+        results.append({"size_mb": size_mb, "workers": 1, "chunk_kb": None, "seconds": round(sequential, 4),
+                        "mb_per_second": round(size_mb / sequential, 2), "speedup": 1.0,
+                        "hash_ok": media_hash == expected})
+        for workers in args.workers:
+            for chunk_kb in args.chunk_kb:
+                downloader = Downloader(workers=workers, chunk_size=chunk_kb * 1024, min_size=0)
+                elapsed, media_hash = await timed_download(downloader, client, message)
+                results.append({"size_mb": size_mb, "workers": workers, "chunk_kb": downloader.chunk_size // 1024,
+                                "seconds": round(elapsed, 4), "mb_per_second": round(size_mb / elapsed, 2),
+                                "speedup": round(sequential / elapsed, 2), "hash_ok": media_hash == expected})
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare parallel ranged downloads with a single download stream")
+    parser.add_argument("--sizes", type=int_list, default=[4, 32, 128], help="comma separated file sizes in MB")
+    parser.add_argument("--workers", type=int_list, default=[2, 4, 8],
+                        help="comma separated amounts of parallel ranges")
+    parser.add_argument("--chunk-kb", type=int_list, default=[512, 1024, 4096],
+                        help="comma separated range sizes in KB, rounded down to 512 KB requests")
+    parser.add_argument("--request-latency", type=float, default=0.05,
+                        help="simulated round trip of every 512 KB request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="simulated MB/s of one connection")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log", action="store_true", help="keep INFO logging enabled")
+    parser.add_argument("--output", default="bench_download.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    write_results(output, "download", parameters, {"runs": results})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from io import BytesIO
+
+from PIL import Image
+from telethon import events
+from telethon.errors import ScheduleTooMuchError
+
+
+def generate_media(kind, size, seed, real_images=False):
+    if kind == "photo" and real_images:
+        rnd = random.Random(seed)
+        img = Image.new("RGB", (640, 640), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        bio = BytesIO()
+        img.save(bio, format="PNG")
+        return bio.getvalue()
+    return random.Random(seed).randbytes(size)
+
+
+class FakeMedia:
+    def __init__(self, kind, content, media_id, mime_type=None, duration=None, width=None, height=None):
+        self.kind = kind
+        self.content = content
+        self.id = media_id
+        self.size = len(content)
+        self.mime_type = mime_type or ("image/jpeg" if kind == "photo" else "video/mp4")
+        self.duration = duration
+        self.width = width
+        self.height = height
+
+
+class FakeEntity:
+    def __init__(self, entity_id, title=None, username=None, first_name=None, last_name=None):
+        self.id = entity_id
+        self.title = title
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+
+
+class FakeMessage:
+    def __init__(self, message_id, chat_id, media=None, grouped_id=None, text="", date=None, out=False, buttons=None):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.media = media
+        self.grouped_id = grouped_id
+        self.text = text
+        self.message = text
+        self.date = date or datetime.now(timezone.utc)
+        self.out = out
+        self.buttons = buttons
+
+    @property
+    def photo(self):
+        return self.media if self.media is not None and self.media.kind == "photo" else None
+
+    @property
+    def video(self):
+        return self.media if self.media is not None and self.media.kind == "video" else None
+
+    @property
+    def document(self):
+        return self.media if self.media is not None and self.media.kind != "photo" else None
+
+    @property
+    def file(self):
+        return self.media
+
+
+class FakeNewMessageEvent:
+    def __init__(self, client, message, sender):
+        self.client = client
+        self.message = message
+        self.sender = sender
+        self.chat_id = message.chat_id
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    async def get_sender(self):
+        await self.client.simulate_latency()
+        return self.sender
+
+
+class FakeTelegramClient:
+    def __init__(self, name="fake", latency=0.0, download_bandwidth=None, request_latency=0.0,
+                 schedule_limit=100):
+        self.name = name
+        self.latency = latency
+        self.download_bandwidth = download_bandwidth
+        self.request_latency = request_latency
+        self.schedule_limit = schedule_limit
+        self.handlers = []
+        self.entities = {}
+        self.chats = {}
+        self.sent = []
+        self.scheduled = []
+        self.calls = {}
+        self.parse_mode = None
+        self.connected = False
+        self.disconnected = None
+        self.next_message_id = 1
+
+    def _count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    async def simulate_latency(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def start(self, *args, **kwargs):
+        self.connected = True
+        return self
+
+    async def connect(self):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self):
+        self.connected = False
+        if self.disconnected is not None:
+            self.disconnected.set()
+
+    async def run_until_disconnected(self):
+        self.disconnected = asyncio.Event()
+        await self.disconnected.wait()
+
+    async def __call__(self, request):
+        self._count(type(request).__name__)
+        await self.simulate_latency()
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    def add_entity(self, entity):
+        self.entities[entity.id] = entity
+        return entity
+
+    def add_message(self, chat_id, message):
+        self.chats.setdefault(chat_id, {})[message.id] = message
+        return message
+
+    def new_message_id(self):
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return message_id
+
+    def _matches(self, builder, message, incoming):
+        if not isinstance(builder, events.NewMessage):
+            return False
+        if builder.incoming and not incoming:
+            return False
+        if builder.outgoing and incoming:
+            return False
+        if builder.chats is not None and message.chat_id not in (builder.chats if isinstance(builder.chats, (list, tuple, set)) else [builder.chats]):
+            return False
+        return True
+
+    def dispatch(self, chat_id, message, incoming=True):
+        self.add_message(chat_id, message)
+        sender = self.entities.get(chat_id) or FakeEntity(chat_id, title=str(chat_id))
+        tasks = []
+        for callback, builder in self.handlers:
+            if self._matches(builder, message, incoming):
+                tasks.append(asyncio.create_task(callback(FakeNewMessageEvent(self, message, sender))))
+        return tasks
+
+    async def get_entity(self, entity):
+        self._count("get_entity")
+        await self.simulate_latency()
+        if entity in self.entities:
+            return self.entities[entity]
+        return self.add_entity(FakeEntity(entity, title=str(entity)))
+
+    async def get_messages(self, entity, limit=None, offset_id=0, min_id=0, max_id=0, ids=None, reverse=False, **kwargs):
+        self._count("get_messages")
+        await self.simulate_latency()
+        chat = self.chats.get(entity, {})
+        if ids is not None:
+            if isinstance(ids, (list, tuple)):
+                return [chat.get(message_id) for message_id in ids]
+            return chat.get(ids)
+        return [message async for message in self._iter(chat, limit, offset_id, min_id, max_id, reverse)]
+
+    async def iter_messages(self, entity, limit=None, offset_id=0, min_id=0, max_id=0, reverse=False, **kwargs):
+        self._count("iter_messages")
+        chat = self.chats.get(entity, {})
+        async for message in self._iter(chat, limit, offset_id, min_id, max_id, reverse):
+            yield message
+
+    async def _iter(self, chat, limit, offset_id, min_id, max_id, reverse):
+        returned = 0
+        for message_id in sorted(chat, reverse=not reverse):
+            if message_id <= min_id or (max_id and message_id >= max_id):
+                continue
+            if offset_id and (message_id >= offset_id if not reverse else message_id <= offset_id):
+                continue
+            if returned % 100 == 0:
+                await self.simulate_latency()
+            yield chat[message_id]
+            returned += 1
+            if limit and returned >= limit:
+                break
+
+    async def download_media(self, media, file=None, **kwargs):
+        self._count("download_media")
+        if hasattr(media, "media"):
+            media = media.media
+        await self.simulate_latency()
+        if self.download_bandwidth:
+            await asyncio.sleep(media.size / self.download_bandwidth)
+        if self.request_latency:
+            await asyncio.sleep(self.request_latency * -(-media.size // (512 * 1024)))
+        if file is bytes:
+            return media.content
+        if file is None:
+            return media.content
+        if isinstance(file, str):
+            with open(file, "wb") as f:
+                f.write(media.content)
+            return file
+        file.write(media.content)
+        return file
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=512 * 1024, file_size=None, **kwargs):
+        self._count("iter_download")
+        if hasattr(media, "media"):
+            media = media.media
+        position = offset
+        returned = 0
+        while position < media.size and (limit is None or returned < limit):
+            await asyncio.sleep(self.request_latency)
+            if self.download_bandwidth:
+                await asyncio.sleep(min(request_size, media.size - position) / self.download_bandwidth)
+            yield media.content[position:position + request_size]
+            position += request_size
+            returned += 1
+
+    def _make_media(self, file):
+        if isinstance(file, FakeMedia):
+            return file
+        if isinstance(file, FakeMessage):
+            return file.media
+        if isinstance(file, (bytes, bytearray)):
+            content = bytes(file)
+        elif isinstance(file, str):
+            with open(file, "rb") as f:
+                content = f.read()
+        else:
+            position = file.tell()
+            content = file.read()
+            file.seek(position)
+        name = getattr(file, "name", "") or ""
+        kind = "video" if str(name).endswith(".mp4") else "photo"
+        return FakeMedia(kind, content, hash(content))
+
+    async def send_file(self, entity, file=None, caption=None, schedule=None, buttons=None, **kwargs):
+        self._count("send_file")
+        await self.simulate_latency()
+        if schedule is not None:
+            if len(self.scheduled) + (len(file) if isinstance(file, list) else 1) > self.schedule_limit:
+                raise ScheduleTooMuchError(request=None)
+        files = file if isinstance(file, list) else [file]
+        sent = []
+        for item in files:
+            message = FakeMessage(self.new_message_id(), entity, media=self._make_media(item), out=True,
+                                  text=caption if isinstance(caption, str) else "", buttons=buttons)
+            self.sent.append((entity, message, schedule))
+            sent.append(message)
+            if schedule is None:
+                self.dispatch(entity, message, incoming=False)
+            else:
+                self.scheduled.append((entity, message))
+        return sent if isinstance(file, list) else sent[0]
+
+    async def send_message(self, entity, message="", buttons=None, **kwargs):
+        self._count("send_message")
+        await self.simulate_latency()
+        sent = FakeMessage(self.new_message_id(), entity, text=message, out=True, buttons=buttons)
+        self.sent.append((entity, sent, None))
+        return sent
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        self._count("edit_message")
+        await self.simulate_latency()
+
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        self._count("delete_messages")
+        await self.simulate_latency()
+
+    def publish_scheduled(self, amount=1):
+        tasks = []
+        for entity, message in self.scheduled[:amount]:
+            tasks.extend(self.dispatch(entity, message, incoming=False))
+        del self.scheduled[:amount]
+        return tasks
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from telethon import events
+
+from benchmarks import ROOT
+from benchmarks.fake_client import FakeEntity, FakeMedia, FakeMessage, FakeTelegramClient, generate_media
+from log_setup import setup_logging
+from storage import BACKENDS
+
+TARGET_CHANNEL = "@target"
+MAIN_ADMIN = 1
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def db_seconds():
+    from metrics import DB_SECONDS
+    return sum(series["sum"] for series in DB_SECONDS.values.values())
+
+
+async def build_processor(workdir, sources, state, chance, latency, collectors=1, **processor_kwargs):
+    from media_processor import MediaProcessor
+
+    processor = MediaProcessor(client_session_name="bench",
+                               bot_session_name="bench_bot",
+                               api_id=0,
+                               api_hash="",
+                               bot_token="",
+                               main_admin=MAIN_ADMIN,
+                               target_channel=TARGET_CHANNEL,
+                               db_path=os.path.join(workdir, "bench.db"),
+                               **processor_kwargs)
+    for i in range(collectors):
+        client = FakeTelegramClient(name=f"collector{i}", latency=latency)
+        processor.pool.add_client(client.name, client)
+        client.add_event_handler(processor.process_media, events.NewMessage(incoming=True))
+        client.add_event_handler(processor.send_media_from_db,
+                                 events.NewMessage(chats=TARGET_CHANNEL, outgoing=True))
+    processor.client = processor.pool.primary
+    processor.bot = FakeTelegramClient(name="bot", latency=latency)
+    await processor.db_manager.add_admin(MAIN_ADMIN, "idle", None, 1, 1)
+    processor.admins.append(MAIN_ADMIN)
+    for source_id in sources:
+        await processor.db_manager.add_source(source_id, state, chance, 0)
+        processor.pool.add_source(source_id)
+        for client in processor.pool.clients.values():
+            client.add_entity(FakeEntity(source_id, title=f"Source {source_id}"))
+    await processor.init_settings()
+    return processor
+
+
+def generate_stream(messages, sources, duplicate_ratio, media_size, video_ratio, seed):
+    rnd = random.Random(seed)
+    next_ids = {source_id: 1 for source_id in sources}
+    seen_seeds = []
+    for i in range(messages):
+        source_id = sources[i % len(sources)]
+        if seen_seeds and rnd.random() < duplicate_ratio:
+            content_seed = rnd.choice(seen_seeds)
+        else:
+            content_seed = rnd.getrandbits(64)
+            seen_seeds.append(content_seed)
+        kind = "video" if rnd.random() < video_ratio else "photo"
+        media = FakeMedia(kind, generate_media(kind, media_size, content_seed), content_seed)
+        message = FakeMessage(next_ids[source_id], source_id, media=media)
+        next_ids[source_id] += 1
+        yield source_id, message
+
+
+async def drive(processor, stream, rate):
+    latencies = []
+    tasks = []
+    started = time.perf_counter()
+
+    async def track(dispatched_at, handler_tasks):
+        await asyncio.gather(*handler_tasks)
+        latencies.append(time.perf_counter() - dispatched_at)
+
+    for i, (source_id, message) in enumerate(stream):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        client = processor.pool.client_for(source_id)
+        tasks.append(asyncio.create_task(track(time.perf_counter(), client.dispatch(source_id, message))))
+    await asyncio.gather(*tasks)
+    await processor.album_buffer.flush_all()
+    return time.perf_counter() - started, latencies
+
+
+def summarize(processor, elapsed, latencies, db_time):
+    from metrics import POSTS
+    return {
+        "messages": len(latencies),
+        "elapsed_seconds": round(elapsed, 4),
+        "posts_per_second": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "latency_max_ms": round(max(latencies) * 1000, 3) if latencies else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "db_seconds": round(db_time, 4),
+        "stages": {key[0]: value for key, value in POSTS.values.items()},
+        "api_calls": {client.name: client.calls for client in list(processor.pool.clients.values()) + [processor.bot]},
+    }
+
+
+def write_results(output, scenario, parameters, results):
+    document = {
+        "scenario": scenario,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(document, f, indent=2)
+    print(json.dumps(document, indent=2))
+    return document
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        if args.log:
+            setup_logging()
+        else:
+            logging.disable(logging.CRITICAL)
+        sources = list(range(1000, 1000 + args.sources))
+        processor = await build_processor(workdir, sources, args.state, args.chance, args.latency,
+                                          collectors=args.collectors, storage_backend=args.storage)
+        stream = generate_stream(args.messages, sources, args.duplicate_ratio, args.media_size,
+                                 args.video_ratio, args.seed)
+        db_before = db_seconds()
+        elapsed, latencies = await drive(processor, stream, args.rate)
+        results = summarize(processor, elapsed, latencies, db_seconds() - db_before)
+        await processor.db_manager.close()
+        os.chdir(ROOT)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive MediaProcessor end to end against fake Telegram clients")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=100, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--sources", type=int, default=20)
+    parser.add_argument("--collectors", type=int, default=1)
+    parser.add_argument("--state", type=int, default=2, help="source state: 1 manual approve, 2 auto approve")
+    parser.add_argument("--chance", type=int, default=100)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2)
+    parser.add_argument("--video-ratio", type=float, default=0.2)
+    parser.add_argument("--media-size", type=int, default=200 * 1024)
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated latency of every API call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=BACKENDS, default="sqlite",
+                        help="storage backend, memory takes the disk out of the measurement")
+    parser.add_argument("--log", action="store_true", help="keep INFO logging enabled")
+    parser.add_argument("--output", default="bench_pipeline.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    write_results(output, "pipeline", parameters, results)
+
+
+if __name__ == "__main__":
+    main()
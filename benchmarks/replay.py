@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks import ROOT
+from benchmarks.fake_client import FakeMedia, FakeMessage, generate_media
+from benchmarks.pipeline import build_processor, db_seconds, summarize, write_results
+from log_setup import setup_logging
+from storage import BACKENDS
+
+DEFAULT_MEDIA_SIZE = 200 * 1024
+
+
+def content_seed(update):
+    if update.get("content_hash"):
+        return int(update["content_hash"], 16)
+    if update.get("media_id") is not None:
+        return update["media_id"]
+    return hash((update["source_id"], update["message_id"]))
+
+
+def build_message(update, max_media_size):
+    media = None
+    if update.get("media_type"):
+        seed = content_seed(update)
+        size = min(update.get("size") or DEFAULT_MEDIA_SIZE, max_media_size)
+        media = FakeMedia(update["media_type"],
+                          generate_media(update["media_type"], size, seed),
+                          update.get("media_id") or seed,
+                          mime_type=update.get("mime_type"),
+                          duration=update.get("duration"),
+                          width=update.get("width"),
+                          height=update.get("height"))
+    date = datetime.fromtimestamp(update["date"], timezone.utc) if update.get("date") else None
+    return FakeMessage(update["message_id"], update["source_id"], media=media,
+                       grouped_id=update.get("grouped_id"), date=date)
+
+
+async def replay(processor, updates, speed, max_media_size):
+    latencies = []
+    tasks = []
+    started = time.perf_counter()
+    first_received = updates[0]["received"] if updates else 0
+
+    async def track(dispatched_at, handler_tasks):
+        await asyncio.gather(*handler_tasks)
+        latencies.append(time.perf_counter() - dispatched_at)
+
+    for update in updates:
+        if speed:
+            delay = started + (update["received"] - first_received) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        message = build_message(update, max_media_size)
+        client = processor.pool.client_for(update["source_id"])
+        tasks.append(asyncio.create_task(track(time.perf_counter(), client.dispatch(update["source_id"], message))))
+    await asyncio.gather(*tasks)
+    await processor.album_buffer.flush_all()
+    return time.perf_counter() - started, latencies
+
+
+async def run(args):
+    from recorder import load_recording
+
+    updates = load_recording(args.recording)
+    if args.limit:
+        updates = updates[:args.limit]
+    sources = sorted({update["source_id"] for update in updates})
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        if args.log:
+            setup_logging()
+        else:
+            logging.disable(logging.CRITICAL)
+        processor = await build_processor(workdir, sources, args.state, args.chance, args.latency,
+                                          collectors=args.collectors, random_seed=args.seed,
+                                          storage_backend=args.storage)
+        db_before = db_seconds()
+        elapsed, latencies = await replay(processor, updates, args.speed, args.max_media_size)
+        results = summarize(processor, elapsed, latencies, db_seconds() - db_before)
+        if updates:
+            results["recorded_seconds"] = round(updates[-1]["received"] - updates[0]["received"], 3)
+        await processor.db_manager.close()
+        os.chdir(ROOT)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded update stream through MediaProcessor")
+    parser.add_argument("recording", help="JSONL file written with record_updates_path")
+    parser.add_argument("--speed", type=float, default=1, help="1 for real time, 60 for a minute per second, 0 for as fast as possible")
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first N updates")
+    parser.add_argument("--collectors", type=int, default=1)
+    parser.add_argument("--state", type=int, default=2, help="source state: 1 manual approve, 2 auto approve")
+    parser.add_argument("--chance", type=int, default=100)
+    parser.add_argument("--max-media-size", type=int, default=2 * 1024 * 1024,
+                        help="cap for generated media, recorded sizes above it are truncated")
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated latency of every API call")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the Chance rolls and schedule delays")
+    parser.add_argument("--storage", choices=BACKENDS, default="sqlite",
+                        help="storage backend, memory takes the disk out of the measurement")
+    parser.add_argument("--log", action="store_true", help="keep INFO logging enabled")
+    parser.add_argument("--output", default="bench_replay.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    args.recording = os.path.abspath(args.recording)
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    write_results(output, "replay", parameters, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks import ROOT
+from benchmarks.pipeline import write_results
+from storage import BACKENDS, create_storage
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def at(minutes):
+    return T0 + timedelta(minutes=minutes)
+
+
+def without_time(rows):
+    # confirmation posts are stamped with the current time by the backend itself
+    return sorted(row[:3] for row in rows)
+
+
+async def check_admins(storage):
+    for user_id in (30, 10, 20):
+        await storage.add_admin(user_id, "idle", None, 1, 0)
+    await storage.update_user_state(10, "adding_source")
+    await storage.update_menu_message(10, 555)
+    await storage.update_subscription(20, 0)
+    await storage.update_super_admin(30, 1)
+    observed = [await storage.get_admin(10), await storage.get_admin(99), sorted(await storage.get_admins()),
+                await storage.get_admins_page(None, None, 2), await storage.get_admins_page(10, None, 5),
+                await storage.get_admins_page(None, 30, 1), await storage.count_admins()]
+    await storage.delete_admin(20)
+    observed += [await storage.count_admins(), await storage.get_admins_page(10, None, 5)]
+    return observed
+
+
+async def check_sources(storage):
+    for channel_id in (-1003, -1001, -1002, 5):
+        await storage.add_source(channel_id, 1, 100, 0)
+    await storage.update_state(-1001, 2)
+    await storage.update_chance(-1002, 40)
+    await storage.update_posts_amount(5, 7)
+    await storage.increment_posts_amount(5, 3)
+    await storage.increment_posts_amount(-1003)
+    await storage.flush()
+    observed = [await storage.get_source(5), await storage.get_source(42), sorted(await storage.get_sources()),
+                await storage.get_sources_page(), await storage.get_sources_page(-1002, None, 5),
+                await storage.get_sources_page(None, 5, 2), await storage.count_sources()]
+    await storage.delete_source(-1002)
+    observed += [await storage.count_sources(), await storage.get_sources_page()]
+    return observed
+
+
+async def check_source_stats(storage):
+    rows = [(1, "h", "2024-01-01 10", 5, 4, 1, 1, 0, 1), (1, "d", "2024-01-01", 5, 4, 1, 1, 0, 1),
+            (2, "h", "2024-01-01 11", 3, 3, 0, 0, 1, 0), (2, "d", "2024-01-01", 3, 3, 0, 0, 1, 0),
+            (1, "h", "2023-12-01 10", 1, 1, 0, 0, 0, 1)]
+    await storage.add_source_stats(rows)
+    await storage.add_source_stats(rows[:2])
+    observed = [await storage.get_source_stats(1, "h", "2024-01-01 00"), await storage.get_source_stats(1, "h", ""),
+                await storage.get_source_stats_totals("d", "2024-01-01"),
+                await storage.get_source_stats_totals("h", "", 2),
+                await storage.prune_source_stats("h", "2024-01-01 00", 100)]
+    await storage.delete_source_stats(2)
+    observed += [await storage.get_source_stats_totals("d", "")]
+    return observed
+
+
+async def check_settings(storage):
+    await storage.add_setting("caption", "")
+    await storage.add_settings([("top_delay", "10"), ("bottom_delay", "5")])
+    await storage.update_setting("caption", "hello")
+    await storage.update_settings([("top_delay", "20"), ("unknown", "1")])
+    return [await storage.get_setting("caption"), await storage.get_setting("unknown"),
+            sorted(await storage.get_settings())]
+
+
+async def check_confirmations(storage):
+    for admin_id, message_id in ((1, 10), (2, 20)):
+        await storage.add_confirmation_post("100_1", admin_id, message_id)
+    await storage.add_pending_post("100_2", 100, 2, at(0))
+    await storage.add_pending_post("100_3", 100, 3, at(1))
+    digest_id = await storage.next_digest_id()
+    await storage.add_digest(digest_id, ["100_2", "100_3"],
+                             [("100_2", 1, 11), ("100_3", 1, 12), ("100_2", 2, 21), ("100_3", 2, 22),
+                              (f"digest_{digest_id}", 1, 99)])
+    observed = [digest_id, await storage.get_pending_posts(), await storage.next_digest_id(),
+                without_time(await storage.get_confirmation_posts("100_1")),
+                without_time(await storage.resolve_confirmation_posts(["100_1", "missing"])),
+                without_time(await storage.resolve_confirmation_posts(["100_1"])),
+                without_time(await storage.resolve_digest(digest_id)),
+                await storage.next_digest_id()]
+    await storage.add_digest(1, ["100_4"], [("100_4", 1, 30), ("digest_1", 1, 32)])
+    await storage.add_confirmation_post("100_5", 1, 31)
+    await storage.delete_confirmation_posts("100_5")
+    observed += [await storage.next_digest_id(),
+                 without_time(await storage.expire_confirmation_posts(datetime.now() - timedelta(days=1), 10)),
+                 without_time(await storage.expire_confirmation_posts(datetime.now() + timedelta(days=1), 10)),
+                 # the digest lost its keyboard message, so its id is free again
+                 await storage.next_digest_id()]
+    await storage.add_pending_post("100_7", 100, 7, at(5))
+    await storage.add_pending_post("100_8", 100, 8, at(1))
+    await storage.add_pending_post("100_9", 100, 9, at(3))
+    observed.append(await storage.get_pending_posts())
+    observed.append(await storage.retry_pending_posts(["100_7", "100_9"], 2))
+    observed.append(await storage.retry_pending_posts(["100_7", "missing"], 2))
+    observed.append(await storage.get_pending_posts())
+    await storage.delete_pending_posts(["100_8"])
+    observed.append(await storage.get_pending_posts())
+    return observed
+
+
+async def check_scheduled_posts(storage):
+    for channel_id, message_id, minutes in ((1, 1, 5), (1, 2, 1), (2, 1, 3), (2, 2, 1), (1, 3, 9)):
+        await storage.add_scheduled_post(channel_id, message_id, at(minutes))
+    observed = [await storage.count_scheduled_posts(), await storage.get_scheduled_post()]
+    await storage.delete_scheduled_post(1, 2)
+    observed.append(await storage.get_scheduled_post())
+    await storage.delete_scheduled_posts(2)
+    observed += [await storage.count_scheduled_posts(), await storage.get_scheduled_post()]
+    # draining the overflow queue the way send_media_from_db does
+    while True:
+        channel_id, message_id, time_added = await storage.get_scheduled_post()
+        if channel_id is None:
+            break
+        observed.append((channel_id, message_id, time_added))
+        await storage.delete_scheduled_post(channel_id, message_id)
+    observed.append(await storage.count_scheduled_posts())
+    return observed
+
+
+async def check_hashes(storage):
+    await storage.add_media_hash("old", at(-60 * 24 * 200))
+    await storage.add_media_hash("a", at(0))
+    window = at(-60 * 24 * 180)
+    observed = [await storage.claim_media_hash("a", at(1), window),
+                await storage.claim_media_hash("old", at(1), window),
+                await storage.claim_media_hash("old", at(2), window),
+                await storage.claim_media_hash("b", at(2)),
+                await storage.claim_media_hash("b", at(3)),
+                await storage.get_media_hash("old"), await storage.get_media_hash("old", at(0)),
+                await storage.get_media_hash("missing")]
+    claims = await asyncio.gather(*[storage.claim_media_hash("race", at(4)) for _ in range(10)])
+    observed.append(sorted(claims))
+    observed.append((await storage.get_table_sizes())["Hashes"])
+    observed.append(await storage.prune_media_hashes(at(0), 100))
+    observed.append(await storage.prune_media_hashes(at(10), 2))
+    await storage.delete_media_hash("race")
+    observed += [await storage.get_media_hash("race"), (await storage.get_table_sizes())["Hashes"]]
+    return observed
+
+
+async def check_entities(storage):
+    await storage.add_entities([(1, "One", None, at(0)), (2, "Two", "two", at(-10)), (3, "Three", None, at(-5))])
+    await storage.add_entities([(1, "One renamed", "one", at(1))])
+    await storage.flush()
+    observed = [sorted(await storage.get_entities([1, 2, 4])), await storage.get_stale_entities(at(0), 10),
+                await storage.get_stale_entities(at(0), 1)]
+    await storage.delete_entity(2)
+    await storage.flush()
+    observed.append(sorted(await storage.get_entities([1, 2, 3])))
+    return observed
+
+
+async def check_progress(storage):
+    await storage.add_backfill(1, 100, None)
+    await storage.add_backfill(2, None, at(0))
+    await storage.update_backfill(1, 500, 0, 100)
+    observed = [await storage.get_backfill(1), await storage.get_backfill(2), await storage.get_backfill(3)]
+    await storage.add_backfill(1, 10, None)
+    await storage.delete_backfill(2)
+    observed.append(sorted(await storage.get_backfills()))
+    await storage.update_source_mark(1, 10)
+    await storage.update_source_mark(1, 5)
+    await storage.update_source_mark(2, 3)
+    await storage.flush()
+    observed.append(sorted(await storage.get_source_marks()))
+    await storage.delete_source_mark(2)
+    observed.append(sorted(await storage.get_source_marks()))
+    await storage.add_interrupted_posts([(1, 1, "process", "h1"), (1, 2, "schedule", None)], at(2))
+    await storage.add_interrupted_posts([(2, 1, "send", None)], at(1))
+    observed.append(await storage.get_interrupted_posts())
+    await storage.delete_interrupted_posts(1, [1, 3])
+    observed.append(await storage.get_interrupted_posts())
+    await storage.add_album(1, 10, [12, 10, 11])
+    await storage.add_album(1, 20, [20, 21])
+    await storage.add_album(2, 10, [10])
+    observed += [await storage.get_album(1, 10), await storage.get_album(3, 1)]
+    await storage.delete_album(1, 10)
+    observed += [await storage.get_album(1, 10), (await storage.get_table_sizes())["AlbumItems"]]
+    await storage.delete_albums(1)
+    observed.append((await storage.get_table_sizes())["AlbumItems"])
+    return observed
+
+
+async def check_jobs(storage):
+    first = await storage.add_job("publish", '{"n": 1}', at(0))
+    second = await storage.add_job("publish", '{"n": 2}', at(5))
+    third = await storage.add_job("approval", '{"n": 3}', at(0))
+    observed = [second - first, third - first,
+                await storage.lease_job("publish", "a", at(1), at(3)),
+                await storage.lease_job("publish", "b", at(1), at(3)),
+                await storage.extend_job_lease(first, "b", at(4)),
+                await storage.extend_job_lease(first, "a", at(4)),
+                await storage.count_jobs()]
+    # the lease of "a" runs out and "b" takes the job over
+    observed.append(await storage.lease_job("publish", "b", at(6), at(8)))
+    await storage.complete_job(first, "a")
+    observed.append(await storage.count_jobs())
+    await storage.fail_job(first, "b", "queued", at(20), "flood")
+    observed.append(await storage.lease_job("publish", "c", at(6), at(8)))
+    await storage.release_job(second, "c")
+    observed.append(await storage.lease_job("publish", "c", at(6), at(8)))
+    await storage.complete_job(second, "c")
+    observed.append(await storage.lease_job("publish", "c", at(21), at(23)))
+    await storage.fail_job(first, "c", "dead", at(21), "gave up")
+    observed += [await storage.lease_job("publish", "c", at(30), at(32)), await storage.count_jobs(),
+                 (await storage.get_table_sizes())["Jobs"]]
+    return observed
+
+
+CHECKS = [check_admins, check_sources, check_source_stats, check_settings, check_confirmations,
+          check_scheduled_posts, check_hashes, check_entities, check_progress, check_jobs]
+
+
+def normalize(value):
+    # sqlite returns lists of tuples, the comparison only cares about the values
+    return json.loads(json.dumps(value, default=str))
+
+
+async def run_backend(backend, workdir):
+    observations = {}
+    timings = {}
+    for check in CHECKS:
+        storage = create_storage(backend, os.path.join(workdir, f"{check.__name__}.db"))
+        started = time.perf_counter()
+        observations[check.__name__] = normalize(await check(storage))
+        timings[check.__name__] = round((time.perf_counter() - started) * 1000, 3)
+        await storage.close()
+    return observations, timings
+
+
+async def run(args):
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as workdir:
+        runs = {backend: await run_backend(backend, workdir) for backend in BACKENDS}
+    reference = BACKENDS[0]
+    mismatches = []
+    for backend in BACKENDS[1:]:
+        for check in CHECKS:
+            expected = runs[reference][0][check.__name__]
+            observed = runs[backend][0][check.__name__]
+            for i, (left, right) in enumerate(zip(expected, observed)):
+                if left != right:
+                    mismatches.append({"check": check.__name__, "backend": backend, "step": i,
+                                       reference: left, backend: right})
+            if len(expected) != len(observed):
+                mismatches.append({"check": check.__name__, "backend": backend, "steps": [len(expected), len(observed)]})
+    if args.verbose:
+        print(json.dumps(runs[reference][0], indent=2))
+    return {
+        "checks": len(CHECKS),
+        "mismatches": mismatches,
+        "check_ms": {backend: timings for backend, (_, timings) in runs.items()},
+        "total_ms": {backend: round(sum(timings.values()), 3) for backend, (_, timings) in runs.items()},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the same storage scenarios against every backend and compare them")
+    parser.add_argument("--verbose", action="store_true", help="print what the sqlite backend returned")
+    parser.add_argument("--output", default="storage_check.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    results = asyncio.run(run(args))
+    os.chdir(ROOT)
+    write_results(output, "storage_check", {}, results)
+    if results["mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import logging
+import time
+
+from metrics import CALLBACK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# callback data is "<VERSION><route>|<arg>|<arg>", data without the version is the old "<route>_<arg>_<arg>" format
+VERSION = "2"
+SEPARATOR = "|"
+LEGACY_SEPARATOR = "_"
+MAX_DATA_LENGTH = 64
+
+
+class Route:
+    def __init__(self, name, handler, types, super_admin):
+        self.name = name
+        self.handler = handler
+        self.types = types
+        self.super_admin = super_admin
+
+
+class CallbackRouter:
+    def __init__(self, is_admin, is_super_admin):
+        self.is_admin = is_admin
+        self.is_super_admin = is_super_admin
+        self.routes = {}
+        self.trie = {}
+
+    def add(self, name, handler, *types, super_admin=None, legacy=None):
+        route = Route(name, handler, types, super_admin)
+        self.routes[name] = route
+        if types:
+            self._insert(f"{VERSION}{name}{SEPARATOR}", route, SEPARATOR)
+        else:
+            self._insert(f"{VERSION}{name}", route, None)
+        if legacy is False:
+            return
+        legacy = legacy or name
+        if types:
+            self._insert(f"{legacy}{LEGACY_SEPARATOR}", route, LEGACY_SEPARATOR)
+        else:
+            self._insert(legacy, route, None)
+
+    def _insert(self, key, route, separator):
+        node = self.trie
+        for byte in key.encode("utf-8"):
+            node = node.setdefault(byte, {})
+        if None in node:
+            raise ValueError(f"Callback prefix {key} is already used by {node[None][0].name}")
+        # a route without arguments has no separator and only matches the whole data
+        node[None] = (route, separator)
+
+    def encode(self, name, *args):
+        route = self.routes[name]
+        if len(args) > len(route.types):
+            raise ValueError(f"Callback {name} takes {len(route.types)} arguments, got {len(args)}")
+        data = f"{VERSION}{name}"
+        if route.types:
+            data += SEPARATOR + SEPARATOR.join("" if arg is None else str(arg) for arg in args)
+        if len(data.encode("utf-8")) > MAX_DATA_LENGTH:
+            raise ValueError(f"Callback data {data} is longer than {MAX_DATA_LENGTH} bytes")
+        return data
+
+    def match(self, data):
+        node = self.trie
+        found = None
+        for i, byte in enumerate(data):
+            node = node.get(byte)
+            if node is None:
+                break
+            terminal = node.get(None)
+            # the longest prefix wins, so approve_instantly_ is never taken for approve_
+            if terminal is not None and (terminal[1] is not None or i == len(data) - 1):
+                found = terminal, i + 1
+        if found is None:
+            return None
+        (route, separator), end = found
+        if separator is None:
+            return route, ()
+        parts = data[end:].decode("utf-8").split(separator)
+        if len(parts) > len(route.types):
+            return None
+        # trailing arguments may be left out, the handler defaults fill them in
+        try:
+            return route, tuple(None if part == "" else cast(part) for cast, part in zip(route.types, parts))
+        except ValueError:
+            return None
+
+    async def dispatch(self, event):
+        started = time.perf_counter()
+        match = self.match(event.data)
+        if match is None:
+            logger.info("Unknown callback data %s", event.data)
+            await event.answer("This button is outdated, send /start to get a new menu.")
+            return
+        route, args = match
+        user_id = event.query.user_id
+        try:
+            if not self.is_admin(user_id):
+                return
+            if route.super_admin and not await self.is_super_admin(user_id):
+                await event.answer(f"You're not allowed to {route.super_admin}")
+                return
+            await route.handler(event, *args)
+        except Exception as e:
+            logger.error("Error while handling callback %s %s: %s", route.name, args, e)
+        finally:
+            # telethon ignores the second answer, so handlers may answer with their own text first
+            await event.answer()
+            CALLBACK_SECONDS.observe(time.perf_counter() - started, route=route.name)
@@ -0,0 +1,116 @@
+import bisect
+import logging
+from hashlib import md5
+
+from telethon.tl.functions.channels import JoinChannelRequest
+from telethon.tl.types import Channel
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self.keys = []
+        self.nodes = {}
+
+    @staticmethod
+    def _hash(value):
+        return int(md5(str(value).encode("utf-8")).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        for i in range(self.replicas):
+            key = self._hash(f"{node}#{i}")
+            self.nodes[key] = node
+            bisect.insort(self.keys, key)
+
+    def remove_node(self, node):
+        for i in range(self.replicas):
+            key = self._hash(f"{node}#{i}")
+            if self.nodes.get(key) == node:
+                del self.nodes[key]
+                self.keys.remove(key)
+
+    def get_node(self, item):
+        if not self.keys:
+            return None
+        index = bisect.bisect(self.keys, self._hash(item)) % len(self.keys)
+        return self.nodes[self.keys[index]]
+
+
+class CollectorPool:
+    def __init__(self, replicas=64):
+        self.ring = HashRing(replicas)
+        self.clients = {}
+        self.sources = set()
+
+    def __len__(self):
+        return len(self.clients)
+
+    @property
+    def primary(self):
+        return next(iter(self.clients.values()), None)
+
+    def owner_name(self, source_id):
+        return self.ring.get_node(source_id)
+
+    def client_for(self, source_id):
+        return self.clients.get(self.ring.get_node(source_id))
+
+    def owns(self, client, source_id):
+        return self.client_for(source_id) is client
+
+    def assignment(self):
+        shards = {name: [] for name in self.clients}
+        for source_id in self.sources:
+            shards[self.owner_name(source_id)].append(source_id)
+        return shards
+
+    def add_source(self, source_id):
+        self.sources.add(source_id)
+        return self.owner_name(source_id)
+
+    def remove_source(self, source_id):
+        self.sources.discard(source_id)
+
+    def add_client(self, name, client):
+        before = {source_id: self.owner_name(source_id) for source_id in self.sources}
+        self.clients[name] = client
+        self.ring.add_node(name)
+        return self._moved(before)
+
+    def remove_client(self, name):
+        before = {source_id: self.owner_name(source_id) for source_id in self.sources}
+        self.clients.pop(name, None)
+        self.ring.remove_node(name)
+        return self._moved(before)
+
+    def moved_since(self, previous_names):
+        previous_ring = HashRing(self.ring.replicas)
+        for name in previous_names:
+            previous_ring.add_node(name)
+        before = {source_id: previous_ring.get_node(source_id) for source_id in self.sources}
+        return self._moved(before)
+
+    def _moved(self, before):
+        moved = {}
+        for source_id, old_owner in before.items():
+            new_owner = self.owner_name(source_id)
+            if new_owner != old_owner:
+                moved[source_id] = new_owner
+        return moved
+
+    async def ensure_joined(self, source_id):
+        client = self.client_for(source_id)
+        if client is None:
+            return False
+        try:
+            entity = await client.get_entity(source_id)
+            if not isinstance(entity, Channel):
+                return True
+            await client(JoinChannelRequest(entity))
+            logger.info("Collector %s joined source %s", self.owner_name(source_id), source_id)
+            return True
+        except Exception as e:
+            logger.error("Collector %s could not join source %s: %s", self.owner_name(source_id), source_id, e)
+            return False
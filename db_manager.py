@@ -1,38 +1,154 @@
+import asyncio
 import aiosqlite
 import sqlite3
 import os
 import logging
+from datetime import datetime
+
+from metrics import DB_SECONDS, timed_methods
+from storage import Storage
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    filename="app.log",
-                    filemode="a"
-                    )
 logger = logging.getLogger(__name__)
 
-class DBManager:
-    def __init__(self, path_to_db, drop_db=False):
+@timed_methods(DB_SECONDS)
+class DBManager(Storage):
+    def __init__(self, path_to_db, drop_db=False, batch_interval=0.005, batch_size=100):
         self.path_to_db = path_to_db
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.writes = []
+        self.writes_pending = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.writer_db = None
+        self.writer_task = None
         if drop_db:
-            logger.info(f"Dropping {path_to_db}")
+            logger.info("Dropping %s", path_to_db)
             try:
                 os.remove(path_to_db)
-                logger.info(f"{path_to_db} dropped")
+                logger.info("%s dropped", path_to_db)
             except OSError as e:
-                logger.error(f"Error while dropping db: {e}")
+                logger.error("Error while dropping db: %s", e)
         try:
             connection = sqlite3.connect(path_to_db)
             cursor = connection.cursor()
+            # readers keep working while the writer commits a batch
+            cursor.execute("PRAGMA journal_mode=WAL")
             cursor.execute("CREATE TABLE IF NOT EXISTS Admins (UserId INTEGER, UserState TEXT, MenuMessage INTEGER, Subscription INTEGER, SuperAdmin INTEGER)")
             cursor.execute('CREATE TABLE IF NOT EXISTS Sources (ChannelId INTEGER, State INTEGER, Chance INTEGER, PostsAmount INTEGER)')
             cursor.execute('CREATE TABLE IF NOT EXISTS Settings (SettingName TEXT, SettingValue TEXT)')
             cursor.execute('CREATE TABLE IF NOT EXISTS ConfirmationPosts (PostId TEXT, AdminId INTEGER, AdminMessageId INTEGER)')
             cursor.execute('CREATE TABLE IF NOT EXISTS ScheduledPosts (ChannelId INTEGER, MessageId INTEGER, TimeAdded TIMESTAMP)')
             cursor.execute('CREATE TABLE IF NOT EXISTS Hashes (MediaHash TEXT, Date TIMESTAMP)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS Backfills (ChannelId INTEGER, OffsetId INTEGER, Remaining INTEGER, Until TIMESTAMP, Processed INTEGER)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS SourceMarks (ChannelId INTEGER PRIMARY KEY, LastMessageId INTEGER)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS AlbumItems (ChannelId INTEGER, AlbumId INTEGER, MessageId INTEGER)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS PendingPosts (PostId TEXT, ChannelId INTEGER, MessageId INTEGER, TimeAdded TIMESTAMP)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS DigestPosts (DigestId INTEGER, PostId TEXT)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS SourceStats (ChannelId INTEGER, Period TEXT, Bucket TEXT, Seen INTEGER, ChancePassed INTEGER, Duplicate INTEGER, Approved INTEGER, Rejected INTEGER, Published INTEGER, PRIMARY KEY (ChannelId, Period, Bucket))')
+            cursor.execute('CREATE TABLE IF NOT EXISTS Entities (EntityId INTEGER PRIMARY KEY, Title TEXT, Username TEXT, Updated TIMESTAMP)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS InterruptedPosts (ChannelId INTEGER, MessageId INTEGER, Stage TEXT, MediaHash TEXT, TimeAdded TIMESTAMP)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS Jobs (JobId INTEGER PRIMARY KEY AUTOINCREMENT, Kind TEXT, Payload TEXT, State TEXT, Attempts INTEGER, AvailableAt TIMESTAMP, LeaseOwner TEXT, LeaseUntil TIMESTAMP, LastError TEXT)')
+            self._add_column(cursor, "ConfirmationPosts", "TimeAdded", "TIMESTAMP", datetime.now())
+            self._add_column(cursor, "PendingPosts", "Attempts", "INTEGER DEFAULT 0", 0)
+            cursor.execute('CREATE INDEX IF NOT EXISTS HashesMediaHash ON Hashes (MediaHash)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS HashesDate ON Hashes (Date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS ConfirmationPostsPostId ON ConfirmationPosts (PostId)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS ConfirmationPostsTimeAdded ON ConfirmationPosts (TimeAdded)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS SourceStatsPeriodBucket ON SourceStats (Period, Bucket)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS SourcesChannelId ON Sources (ChannelId)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS AdminsUserId ON Admins (UserId)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS EntitiesUpdated ON Entities (Updated)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS JobsKindState ON Jobs (Kind, State, AvailableAt)')
             connection.commit()
             logger.info("All tables successfully created")
         except Exception as e:
-            logger.error(f"Error while creating tables: {e}")
+            logger.error("Error while creating tables: %s", e)
+
+    @staticmethod
+    def _add_column(cursor, table, column, definition, default=None):
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+        if column in columns:
+            return
+        logger.info("Adding column %s to %s", column, table)
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        if default is not None:
+            cursor.execute(f"UPDATE {table} SET {column}=?", (default,))
+
+    async def _write(self, operation, wait=True):
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.create_task(self._writer())
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self.writes.append((operation, future))
+        self.writes_pending.set()
+        if len(self.writes) >= self.batch_size:
+            self.batch_full.set()
+        if future is not None:
+            return await future
+
+    async def _writer(self):
+        if self.writer_db is None:
+            self.writer_db = await aiosqlite.connect(self.path_to_db, timeout=30)
+        while True:
+            await self.writes_pending.wait()
+            if len(self.writes) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), self.batch_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.writes_pending.clear()
+            self.batch_full.clear()
+            batch, self.writes = self.writes, []
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        results = []
+        try:
+            await self.writer_db.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                try:
+                    results.append((future, await operation(self.writer_db), None))
+                except Exception as e:
+                    # sqlite rolls back only the failed statement, the rest of the batch is still committed
+                    results.append((future, None, e))
+            await self.writer_db.commit()
+        except Exception as e:
+            logger.error("Error while committing %s writes: %s", len(batch), e)
+            try:
+                await self.writer_db.rollback()
+            except Exception:
+                pass
+            results = [(future, None, e) for _, future in batch]
+        for future, result, error in results:
+            if future is None:
+                if error is not None:
+                    logger.error("Error in background write: %s", error)
+            elif not future.done():
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    async def flush(self):
+        if self.writer_task is not None and not self.writer_task.done():
+            await self._write(self._noop)
+
+    @staticmethod
+    async def _noop(db):
+        return None
+
+    async def close(self):
+        await self.flush()
+        if self.writer_task is not None:
+            # the writer may still be inside a commit, the connection is closed only after it has stopped
+            writer_task, self.writer_task = self.writer_task, None
+            writer_task.cancel()
+            try:
+                await writer_task
+            except asyncio.CancelledError:
+                pass
+        if self.writer_db is not None:
+            await self.writer_db.close()
+            self.writer_db = None
 
     async def add_admin(self, user_id, user_state, menu_message, subscription, super_admin):
         async with aiosqlite.connect(self.path_to_db) as db:
@@ -59,6 +175,14 @@ class DBManager:
                 res = await cursor.fetchall()
             return res
 
+    async def get_admins_page(self, after_id=None, before_id=None, limit=5):
+        return await self._get_page("Admins", "UserId", after_id, before_id, limit)
+
+    async def count_admins(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT COUNT(*) FROM Admins") as cursor:
+                return (await cursor.fetchone())[0]
+
     async def update_user_state(self, user_id, user_state):
         async with aiosqlite.connect(self.path_to_db) as db:
             await db.execute("UPDATE Admins SET UserState=? WHERE UserId=?", (user_state, user_id))
@@ -104,6 +228,25 @@ class DBManager:
                 res = await cursor.fetchall()
             return res
 
+    async def get_sources_page(self, after_id=None, before_id=None, limit=5):
+        return await self._get_page("Sources", "ChannelId", after_id, before_id, limit)
+
+    async def count_sources(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT COUNT(*) FROM Sources") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def _get_page(self, table, key, after_id, before_id, limit):
+        # keyset pagination, a page costs an index seek no matter how deep it is
+        async with aiosqlite.connect(self.path_to_db) as db:
+            if before_id is not None:
+                async with db.execute(f"SELECT * FROM {table} WHERE {key}<? ORDER BY {key} DESC LIMIT ?",
+                                      (before_id, limit)) as cursor:
+                    return list(reversed(await cursor.fetchall()))
+            async with db.execute(f"SELECT * FROM {table} WHERE {key}>? ORDER BY {key} LIMIT ?",
+                                  (after_id if after_id is not None else -2 ** 63, limit)) as cursor:
+                return await cursor.fetchall()
+
     async def update_state(self, channel_id, state):
         async with aiosqlite.connect(self.path_to_db) as db:
             await db.execute("UPDATE Sources SET State=? WHERE ChannelId=?", (state, channel_id))
@@ -119,6 +262,56 @@ class DBManager:
             await db.execute("UPDATE Sources SET PostsAmount=? WHERE ChannelId=?", (posts_amount, channel_id))
             await db.commit()
 
+    async def increment_posts_amount(self, channel_id, amount=1):
+        async def operation(db):
+            await db.execute("UPDATE Sources SET PostsAmount=PostsAmount+? WHERE ChannelId=?", (amount, channel_id))
+        await self._write(operation, wait=False)
+
+    async def add_source_stats(self, rows):
+        async def operation(db):
+            await db.executemany("INSERT INTO SourceStats (ChannelId, Period, Bucket, Seen, ChancePassed, Duplicate, Approved, Rejected, Published) "
+                                 "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                                 "ON CONFLICT(ChannelId, Period, Bucket) DO UPDATE SET "
+                                 "Seen=Seen+excluded.Seen, ChancePassed=ChancePassed+excluded.ChancePassed, "
+                                 "Duplicate=Duplicate+excluded.Duplicate, Approved=Approved+excluded.Approved, "
+                                 "Rejected=Rejected+excluded.Rejected, Published=Published+excluded.Published",
+                                 rows)
+        await self._write(operation)
+
+    async def get_source_stats(self, channel_id, period, since):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT Bucket, Seen, ChancePassed, Duplicate, Approved, Rejected, Published FROM SourceStats "
+                                  "WHERE ChannelId=? AND Period=? AND Bucket>=? ORDER BY Bucket",
+                                  (channel_id, period, since)) as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def get_source_stats_totals(self, period, since, channel_id=None):
+        query = ("SELECT ChannelId, SUM(Seen), SUM(ChancePassed), SUM(Duplicate), SUM(Approved), SUM(Rejected), SUM(Published) "
+                 "FROM SourceStats WHERE Period=? AND Bucket>=?")
+        params = (period, since)
+        if channel_id is not None:
+            query += " AND ChannelId=?"
+            params += (channel_id,)
+        query += " GROUP BY ChannelId ORDER BY SUM(Published) DESC"
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute(query, params) as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def prune_source_stats(self, period, before, limit):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            cursor = await db.execute("DELETE FROM SourceStats WHERE rowid IN "
+                                      "(SELECT rowid FROM SourceStats WHERE Period=? AND Bucket<? LIMIT ?)",
+                                      (period, before, limit))
+            await db.commit()
+            return cursor.rowcount
+
+    async def delete_source_stats(self, channel_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("DELETE FROM SourceStats WHERE ChannelId=?", (channel_id,))
+            await db.commit()
+
     async def add_setting(self, setting_name, setting_value):
         async with aiosqlite.connect(self.path_to_db) as db:
             await db.execute("INSERT INTO Settings(SettingName, SettingValue) VALUES(?, ?)", (setting_name, setting_value))
@@ -137,10 +330,27 @@ class DBManager:
                 return None, None
             return res
 
-    async def add_confirmation_post(self, post_id, admin_id, admin_message_id):
+    async def get_settings(self):
         async with aiosqlite.connect(self.path_to_db) as db:
-            await db.execute("INSERT INTO ConfirmationPosts (PostId, AdminId, AdminMessageId) VALUES(?, ?, ?)", (post_id, admin_id, admin_message_id))
-            await db.commit()
+            async with db.execute("SELECT SettingName, SettingValue FROM Settings") as cursor:
+                return await cursor.fetchall()
+
+    async def add_settings(self, settings):
+        async def operation(db):
+            await db.executemany("INSERT INTO Settings(SettingName, SettingValue) VALUES(?, ?)", settings)
+        await self._write(operation)
+
+    async def update_settings(self, settings):
+        async def operation(db):
+            await db.executemany("UPDATE Settings SET SettingValue=? WHERE SettingName=?",
+                                 [(setting_value, setting_name) for setting_name, setting_value in settings])
+        await self._write(operation)
+
+    async def add_confirmation_post(self, post_id, admin_id, admin_message_id):
+        async def operation(db):
+            await db.execute("INSERT INTO ConfirmationPosts (PostId, AdminId, AdminMessageId, TimeAdded) VALUES(?, ?, ?, ?)",
+                             (post_id, admin_id, admin_message_id, datetime.now()))
+        await self._write(operation)
 
     async def delete_confirmation_posts(self, post_id):
         async with aiosqlite.connect(self.path_to_db) as db:
@@ -153,11 +363,102 @@ class DBManager:
                 res = await cursor.fetchall()
             return res
 
-    async def add_scheduled_post(self, channel_id, message_id, time_added):
+    async def resolve_confirmation_posts(self, post_ids):
+        placeholders = ", ".join("?" * len(post_ids))
         async with aiosqlite.connect(self.path_to_db) as db:
-            await db.execute("INSERT INTO ScheduledPosts (ChannelId, MessageId, TimeAdded) VALUES(?, ?, ?)", (channel_id, message_id, time_added))
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute(f"SELECT * FROM ConfirmationPosts WHERE PostId IN ({placeholders})", post_ids) as cursor:
+                res = await cursor.fetchall()
+            await db.execute(f"DELETE FROM ConfirmationPosts WHERE PostId IN ({placeholders})", post_ids)
+            await db.commit()
+            return res
+
+    async def expire_confirmation_posts(self, before, limit):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("SELECT PostId FROM ConfirmationPosts WHERE TimeAdded < ? LIMIT ?", (before, limit)) as cursor:
+                post_ids = list(dict.fromkeys(row[0] for row in await cursor.fetchall()))
+            if not post_ids:
+                await db.commit()
+                return []
+            placeholders = ", ".join("?" * len(post_ids))
+            async with db.execute(f"SELECT * FROM ConfirmationPosts WHERE PostId IN ({placeholders})", post_ids) as cursor:
+                res = await cursor.fetchall()
+            await db.execute(f"DELETE FROM ConfirmationPosts WHERE PostId IN ({placeholders})", post_ids)
+            await db.execute("DELETE FROM DigestPosts WHERE 'digest_' || DigestId NOT IN (SELECT PostId FROM ConfirmationPosts)")
+            await db.commit()
+            return res
+
+    async def add_pending_post(self, post_id, channel_id, message_id, time_added):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("INSERT INTO PendingPosts (PostId, ChannelId, MessageId, TimeAdded) VALUES(?, ?, ?, ?)",
+                             (post_id, channel_id, message_id, time_added))
+            await db.commit()
+
+    async def delete_pending_posts(self, post_ids):
+        placeholders = ", ".join("?" * len(post_ids))
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute(f"DELETE FROM PendingPosts WHERE PostId IN ({placeholders})", post_ids)
             await db.commit()
 
+    async def get_pending_posts(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT PostId, ChannelId, MessageId, TimeAdded FROM PendingPosts ORDER BY TimeAdded ASC") as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def retry_pending_posts(self, post_ids, max_attempts):
+        placeholders = ", ".join("?" * len(post_ids))
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.execute(f"UPDATE PendingPosts SET Attempts=Attempts + 1 WHERE PostId IN ({placeholders})", post_ids)
+            async with db.execute(f"SELECT PostId, ChannelId, MessageId FROM PendingPosts WHERE PostId IN ({placeholders}) AND Attempts >= ?",
+                                  (*post_ids, max_attempts)) as cursor:
+                res = await cursor.fetchall()
+            await db.execute(f"DELETE FROM PendingPosts WHERE PostId IN ({placeholders}) AND Attempts >= ?",
+                             (*post_ids, max_attempts))
+            await db.commit()
+            return res
+
+    async def next_digest_id(self):
+        # only the bot process sends digests, so the id can be taken before the digest rows are written
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT COALESCE(MAX(DigestId), 0) + 1 FROM DigestPosts") as cursor:
+                digest_id, = await cursor.fetchone()
+            return digest_id
+
+    async def add_digest(self, digest_id, post_ids, confirmations):
+        # the digest, the messages admins got and the removal from the queue are written together
+        now = datetime.now()
+        placeholders = ", ".join("?" * len(post_ids))
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.executemany("INSERT INTO DigestPosts (DigestId, PostId) VALUES(?, ?)",
+                                 [(digest_id, post_id) for post_id in post_ids])
+            await db.executemany("INSERT INTO ConfirmationPosts (PostId, AdminId, AdminMessageId, TimeAdded) VALUES(?, ?, ?, ?)",
+                                 [(post_id, admin_id, admin_message_id, now)
+                                  for post_id, admin_id, admin_message_id in confirmations])
+            await db.execute(f"DELETE FROM PendingPosts WHERE PostId IN ({placeholders})", post_ids)
+            await db.commit()
+
+    async def resolve_digest(self, digest_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("SELECT PostId FROM DigestPosts WHERE DigestId=?", (digest_id,)) as cursor:
+                post_ids = [row[0] for row in await cursor.fetchall()] + [f"digest_{digest_id}"]
+            placeholders = ", ".join("?" * len(post_ids))
+            async with db.execute(f"SELECT * FROM ConfirmationPosts WHERE PostId IN ({placeholders})", post_ids) as cursor:
+                res = await cursor.fetchall()
+            await db.execute(f"DELETE FROM ConfirmationPosts WHERE PostId IN ({placeholders})", post_ids)
+            await db.execute("DELETE FROM DigestPosts WHERE DigestId=?", (digest_id,))
+            await db.commit()
+            return res
+
+    async def add_scheduled_post(self, channel_id, message_id, time_added):
+        async def operation(db):
+            await db.execute("INSERT INTO ScheduledPosts (ChannelId, MessageId, TimeAdded) VALUES(?, ?, ?)", (channel_id, message_id, time_added))
+        await self._write(operation)
+
     async def delete_scheduled_post(self, channel_id, message_id):
         async with aiosqlite.connect(self.path_to_db) as db:
             await db.execute("DELETE FROM ScheduledPosts WHERE ChannelId=? AND MessageId=?", (channel_id, message_id))
@@ -168,6 +469,12 @@ class DBManager:
             await db.execute("DELETE FROM ScheduledPosts WHERE ChannelId=?", (channel_id,))
             await db.commit()
 
+    async def count_scheduled_posts(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT COUNT(*) FROM ScheduledPosts") as cursor:
+                res = await cursor.fetchone()
+            return res[0]
+
     async def get_scheduled_post(self):
         async with aiosqlite.connect(self.path_to_db) as db:
             async with db.execute("SELECT * FROM ScheduledPosts ORDER BY TimeAdded ASC LIMIT 1") as cursor:
@@ -177,19 +484,224 @@ class DBManager:
             return res
 
     async def add_media_hash(self, media_hash, date):
-        async with aiosqlite.connect(self.path_to_db) as db:
+        async def operation(db):
             await db.execute("INSERT INTO Hashes (MediaHash, Date) VALUES(?, ?)", (media_hash, date))
-            await db.commit()
+        await self._write(operation)
+
+    async def claim_media_hash(self, media_hash, date, since=None):
+        # check and insert run in the single writer transaction, so two posts can never claim the same hash,
+        # and the claim is only acknowledged after the batch is committed
+        async def operation(db):
+            if since is None:
+                query, params = "SELECT 1 FROM Hashes WHERE MediaHash=? LIMIT 1", (media_hash,)
+            else:
+                query, params = "SELECT 1 FROM Hashes WHERE MediaHash=? AND Date>=? LIMIT 1", (media_hash, since)
+            async with db.execute(query, params) as cursor:
+                if await cursor.fetchone() is not None:
+                    return False
+            await db.execute("INSERT INTO Hashes (MediaHash, Date) VALUES(?, ?)", (media_hash, date))
+            return True
+        return await self._write(operation)
 
     async def delete_media_hash(self, media_hash):
         async with aiosqlite.connect(self.path_to_db) as db:
             await db.execute("DELETE FROM Hashes WHERE MediaHash=?", (media_hash,))
             await db.commit()
 
-    async def get_media_hash(self, media_hash):
+    async def get_media_hash(self, media_hash, since=None):
         async with aiosqlite.connect(self.path_to_db) as db:
-            async with db.execute("SELECT * FROM Hashes WHERE MediaHash=? LIMIT 1", (media_hash,)) as cursor:
+            if since is None:
+                query, params = "SELECT * FROM Hashes WHERE MediaHash=? LIMIT 1", (media_hash,)
+            else:
+                query, params = "SELECT * FROM Hashes WHERE MediaHash=? AND Date>=? LIMIT 1", (media_hash, since)
+            async with db.execute(query, params) as cursor:
                 res = await cursor.fetchone()
             if res is None:
                 return None, None
-            return res
\ No newline at end of file
+            return res
+
+    async def prune_media_hashes(self, before, limit):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            cursor = await db.execute("DELETE FROM Hashes WHERE rowid IN (SELECT rowid FROM Hashes WHERE Date < ? LIMIT ?)",
+                                      (before, limit))
+            await db.commit()
+            return cursor.rowcount
+
+    async def add_entities(self, entities):
+        async def operation(db):
+            await db.executemany("INSERT INTO Entities (EntityId, Title, Username, Updated) VALUES(?, ?, ?, ?) "
+                                 "ON CONFLICT(EntityId) DO UPDATE SET Title=excluded.Title, Username=excluded.Username, "
+                                 "Updated=excluded.Updated",
+                                 entities)
+        await self._write(operation, wait=False)
+
+    async def get_entities(self, entity_ids):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute(f"SELECT * FROM Entities WHERE EntityId IN ({', '.join('?' * len(entity_ids))})",
+                                  list(entity_ids)) as cursor:
+                return await cursor.fetchall()
+
+    async def get_stale_entities(self, before, limit):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT * FROM Entities WHERE Updated<? ORDER BY Updated LIMIT ?",
+                                  (before, limit)) as cursor:
+                return await cursor.fetchall()
+
+    async def delete_entity(self, entity_id):
+        async def operation(db):
+            await db.execute("DELETE FROM Entities WHERE EntityId=?", (entity_id,))
+        await self._write(operation, wait=False)
+
+    async def get_table_sizes(self):
+        sizes = {}
+        async with aiosqlite.connect(self.path_to_db) as db:
+            for table in ("Hashes", "ConfirmationPosts", "ScheduledPosts", "PendingPosts", "AlbumItems", "Sources", "Admins",
+                          "Jobs"):
+                async with db.execute(f"SELECT COUNT(*) FROM {table}") as cursor:
+                    sizes[table] = (await cursor.fetchone())[0]
+        return sizes
+
+    async def add_backfill(self, channel_id, remaining, until):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("DELETE FROM Backfills WHERE ChannelId=?", (channel_id,))
+            await db.execute("INSERT INTO Backfills (ChannelId, OffsetId, Remaining, Until, Processed) VALUES(?, ?, ?, ?, ?)",
+                             (channel_id, 0, remaining, until, 0))
+            await db.commit()
+
+    async def update_backfill(self, channel_id, offset_id, remaining, processed):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("UPDATE Backfills SET OffsetId=?, Remaining=?, Processed=? WHERE ChannelId=?",
+                             (offset_id, remaining, processed, channel_id))
+            await db.commit()
+
+    async def delete_backfill(self, channel_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("DELETE FROM Backfills WHERE ChannelId=?", (channel_id,))
+            await db.commit()
+
+    async def get_backfill(self, channel_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT * FROM Backfills WHERE ChannelId=? LIMIT 1", (channel_id,)) as cursor:
+                res = await cursor.fetchone()
+            if res is None:
+                return None, None, None, None, None
+            return res
+
+    async def get_backfills(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT * FROM Backfills") as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def update_source_mark(self, channel_id, message_id):
+        async def operation(db):
+            await db.execute("INSERT INTO SourceMarks (ChannelId, LastMessageId) VALUES(?, ?) "
+                             "ON CONFLICT(ChannelId) DO UPDATE SET LastMessageId=MAX(LastMessageId, excluded.LastMessageId)",
+                             (channel_id, message_id))
+        await self._write(operation, wait=False)
+
+    async def delete_source_mark(self, channel_id):
+        # goes through the writer after any queued mark update, so a late update can't bring the row back
+        async def operation(db):
+            await db.execute("DELETE FROM SourceMarks WHERE ChannelId=?", (channel_id,))
+        await self._write(operation)
+
+    async def get_source_marks(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT * FROM SourceMarks") as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def add_interrupted_posts(self, posts, time_added):
+        async def operation(db):
+            await db.executemany("INSERT INTO InterruptedPosts (ChannelId, MessageId, Stage, MediaHash, TimeAdded) VALUES(?, ?, ?, ?, ?)",
+                                 [(channel_id, message_id, stage, media_hash, time_added)
+                                  for channel_id, message_id, stage, media_hash in posts])
+        await self._write(operation)
+
+    async def get_interrupted_posts(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT * FROM InterruptedPosts ORDER BY TimeAdded ASC") as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def delete_interrupted_posts(self, channel_id, message_ids):
+        async def operation(db):
+            await db.executemany("DELETE FROM InterruptedPosts WHERE ChannelId=? AND MessageId=?",
+                                 [(channel_id, message_id) for message_id in message_ids])
+        await self._write(operation)
+
+    async def add_job(self, kind, payload, available_at):
+        async def operation(db):
+            cursor = await db.execute("INSERT INTO Jobs (Kind, Payload, State, Attempts, AvailableAt) VALUES(?, ?, 'queued', 0, ?)",
+                                      (kind, payload, available_at))
+            return cursor.lastrowid
+        return await self._write(operation)
+
+    async def lease_job(self, kind, owner, now, lease_until):
+        async def operation(db):
+            # the batch runs in an immediate transaction, so two processes never lease the same job
+            async with db.execute("SELECT JobId, Payload, Attempts FROM Jobs WHERE Kind=? AND "
+                                  "((State='queued' AND AvailableAt<=?) OR (State='leased' AND LeaseUntil<?)) "
+                                  "ORDER BY AvailableAt, JobId LIMIT 1", (kind, now, now)) as cursor:
+                job = await cursor.fetchone()
+            if job is None:
+                return None
+            await db.execute("UPDATE Jobs SET State='leased', LeaseOwner=?, LeaseUntil=?, Attempts=Attempts+1 WHERE JobId=?",
+                             (owner, lease_until, job[0]))
+            return job[0], job[1], job[2] + 1
+        return await self._write(operation)
+
+    async def extend_job_lease(self, job_id, owner, lease_until):
+        async def operation(db):
+            cursor = await db.execute("UPDATE Jobs SET LeaseUntil=? WHERE JobId=? AND LeaseOwner=? AND State='leased'",
+                                      (lease_until, job_id, owner))
+            return cursor.rowcount
+        return await self._write(operation)
+
+    async def complete_job(self, job_id, owner):
+        async def operation(db):
+            await db.execute("DELETE FROM Jobs WHERE JobId=? AND LeaseOwner=?", (job_id, owner))
+        await self._write(operation)
+
+    async def fail_job(self, job_id, owner, state, available_at, error):
+        async def operation(db):
+            await db.execute("UPDATE Jobs SET State=?, AvailableAt=?, LeaseOwner=NULL, LeaseUntil=NULL, LastError=? "
+                             "WHERE JobId=? AND LeaseOwner=?", (state, available_at, error, job_id, owner))
+        await self._write(operation)
+
+    async def release_job(self, job_id, owner):
+        async def operation(db):
+            # an interrupted job is not a failed attempt
+            await db.execute("UPDATE Jobs SET State='queued', Attempts=Attempts-1, LeaseOwner=NULL, LeaseUntil=NULL "
+                             "WHERE JobId=? AND LeaseOwner=?", (job_id, owner))
+        await self._write(operation)
+
+    async def count_jobs(self):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT Kind, State, COUNT(*) FROM Jobs GROUP BY Kind, State ORDER BY Kind, State") as cursor:
+                res = await cursor.fetchall()
+            return res
+
+    async def add_album(self, channel_id, album_id, message_ids):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.executemany("INSERT INTO AlbumItems (ChannelId, AlbumId, MessageId) VALUES(?, ?, ?)",
+                                 [(channel_id, album_id, message_id) for message_id in message_ids])
+            await db.commit()
+
+    async def delete_album(self, channel_id, album_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("DELETE FROM AlbumItems WHERE ChannelId=? AND AlbumId=?", (channel_id, album_id))
+            await db.commit()
+
+    async def delete_albums(self, channel_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            await db.execute("DELETE FROM AlbumItems WHERE ChannelId=?", (channel_id,))
+            await db.commit()
+
+    async def get_album(self, channel_id, album_id):
+        async with aiosqlite.connect(self.path_to_db) as db:
+            async with db.execute("SELECT MessageId FROM AlbumItems WHERE ChannelId=? AND AlbumId=? ORDER BY MessageId",
+                                  (channel_id, album_id)) as cursor:
+                res = await cursor.fetchall()
+            return [row[0] for row in res]
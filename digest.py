@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+from telethon.custom import Button
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 10
+# digests a pending post can fail to get into before it is dropped
+MAX_ATTEMPTS = 5
+
+
+class DigestSender:
+    def __init__(self, processor):
+        self.processor = processor
+        self.db_manager = processor.db_manager
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.processor.settings.current.digest_interval * 60)
+            try:
+                await self.send_digests()
+            except Exception as e:
+                logger.error("Error while sending digest: %s", e)
+
+    async def send_digests(self):
+        pending_posts = await self.db_manager.get_pending_posts()
+        if not pending_posts:
+            return
+        logger.info("Sending digest of %s pending posts", len(pending_posts))
+        for i in range(0, len(pending_posts), DIGEST_SIZE):
+            await self.send_digest(pending_posts[i:i + DIGEST_SIZE])
+
+    async def load_files(self, source_id, message_id):
+        # a separate bot process has no collector session, the collector spooled the files for it
+        spooled = await self.processor.spool.load(source_id, message_id)
+        if spooled:
+            return spooled
+        client = self.processor.pool.client_for(source_id) or self.processor.client
+        album_ids = await self.db_manager.get_album(source_id, message_id)
+        messages = await client.get_messages(source_id, ids=album_ids or [message_id])
+        files = []
+        for message in messages:
+            if message is not None:
+                file, _ = await self.processor.download_media(client, message)
+                files.append(file)
+        if not files:
+            raise ValueError("message was deleted")
+        return files
+
+    async def send_digest(self, pending_posts):
+        post_ids = []
+        post_keys = []
+        files = []
+        # post id of every file, an album is sent whole so the admins see what they approve
+        file_post_ids = []
+        captions = []
+        failed_post_ids = []
+        for post_id, source_id, message_id, _ in pending_posts:
+            try:
+                post_files = await self.load_files(source_id, message_id)
+            except Exception as e:
+                logger.error("Error while getting pending post %s, keeping it for the next digest: %s", post_id, e)
+                failed_post_ids.append(post_id)
+                continue
+            number = len(post_ids) + 1
+            post_ids.append(post_id)
+            post_keys.append((source_id, message_id))
+            files.extend(post_files)
+            file_post_ids.extend([post_id] * len(post_files))
+            captions.append(f"#{number}" if len(post_files) == 1 else f"#{number}, album of {len(post_files)} files")
+            captions.extend([""] * (len(post_files) - 1))
+        if post_ids:
+            digest_id = await self.db_manager.next_digest_id()
+            router = self.processor.router
+            buttons = [[Button.inline(f"✅ #{i + 1}", data=router.encode("approve", *post_key)),
+                        Button.inline(f"⚡ #{i + 1}", data=router.encode("approve_instantly", *post_key)),
+                        Button.inline(f"❌ #{i + 1}", data=router.encode("reject", *post_key))]
+                       for i, post_key in enumerate(post_keys)]
+            buttons.append([Button.inline("Approve all", data=router.encode("digest_approve", digest_id)),
+                            Button.inline("Reject all", data=router.encode("digest_reject", digest_id))])
+            confirmations = []
+            delivered = 0
+            undelivered = 0
+            admins = await self.db_manager.get_admins()
+            for admin in admins:
+                if admin[3] != 1:
+                    continue
+                try:
+                    digest_messages = await self.processor.bot.send_file(admin[0], file=files, caption=captions)
+                    confirmations.extend((post_id, admin[0], digest_message.id)
+                                         for post_id, digest_message in zip(file_post_ids, digest_messages))
+                    keyboard_message = await self.processor.bot.send_message(admin[0],
+                                                                             f"Digest of {len(post_ids)} posts",
+                                                                             buttons=buttons)
+                    confirmations.append((f"digest_{digest_id}", admin[0], keyboard_message.id))
+                    delivered += 1
+                except Exception as e:
+                    logger.error("Error while sending digest %s to admin %s: %s", digest_id, admin[0], e)
+                    undelivered += 1
+                finally:
+                    for file in files:
+                        file.seek(0)
+            if delivered or not undelivered:
+                await self.db_manager.add_digest(digest_id, post_ids, confirmations)
+                for source_id, message_id in post_keys:
+                    await self.processor.spool.discard(source_id, message_id)
+            else:
+                # no admin got the keyboard, the posts stay pending and the files already sent are
+                # deleted once the posts are resolved from the next digest
+                for confirmation in confirmations:
+                    await self.db_manager.add_confirmation_post(*confirmation)
+                failed_post_ids.extend(post_ids)
+        if failed_post_ids:
+            dropped = await self.db_manager.retry_pending_posts(failed_post_ids, MAX_ATTEMPTS)
+            for post_id, source_id, message_id in dropped:
+                logger.error("Pending post %s failed %s times, dropping it", post_id, MAX_ATTEMPTS)
+                await self.processor.spool.discard(source_id, message_id)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from hashlib import md5
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# Telegram serves at most 512 KB per request and ranges have to start on a request boundary
+REQUEST_SIZE = 512 * 1024
+
+
+class Downloader:
+    def __init__(self, workers=4, chunk_size=1024 * 1024, min_size=8 * 1024 * 1024):
+        self.workers = workers
+        self.chunk_size = max(REQUEST_SIZE, chunk_size // REQUEST_SIZE * REQUEST_SIZE)
+        self.min_size = min_size
+
+    def file_size(self, message):
+        # photos are small and come in several sizes, only documents are split into ranges
+        if self.workers < 2 or message.document is None or message.file is None:
+            return None
+        size = message.file.size
+        if not size or size < self.min_size:
+            return None
+        return size
+
+    async def download(self, client, message):
+        # returns the hash only when it was computed along the way, the caller hashes simple downloads itself
+        size = self.file_size(message)
+        if size is not None:
+            bio = self.new_file(message)
+            try:
+                media_hash = await self.download_ranges(client, message, bio, size)
+                bio.seek(0)
+                return bio, media_hash
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Parallel download of %s bytes failed, downloading it as one stream: %s", size, e)
+        bio = self.new_file(message)
+        await client.download_media(message.media, file=bio)
+        bio.seek(0)
+        return bio, None
+
+    @staticmethod
+    def new_file(message):
+        bio = BytesIO()
+        if message.photo:
+            bio.name = "file.png"
+        elif message.video:
+            bio.name = "file.mp4"
+        return bio
+
+    async def download_ranges(self, client, message, bio, size):
+        # the whole file is allocated up front and every range is written in place
+        bio.seek(size - 1)
+        bio.write(b"\0")
+        buffer = bio.getbuffer()
+        offsets = iter(range(0, size, self.chunk_size))
+        finished = set()
+        hasher = md5()
+        hashed = 0
+
+        async def fetch():
+            nonlocal hashed
+            for offset in offsets:
+                end = min(offset + self.chunk_size, size)
+                position = offset
+                async for chunk in client.iter_download(message.media, offset=offset,
+                                                        limit=-(-(end - offset) // REQUEST_SIZE),
+                                                        request_size=REQUEST_SIZE, file_size=size):
+                    chunk = chunk[:end - position]
+                    buffer[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+                if position != end:
+                    raise IOError(f"Range {offset}-{end} ended at {position}")
+                finished.add(offset)
+                # ranges finish out of order, the hash only advances over the ones without gaps before them
+                while hashed in finished:
+                    finished.discard(hashed)
+                    hasher.update(buffer[hashed:min(hashed + self.chunk_size, size)])
+                    hashed += self.chunk_size
+
+        tasks = [asyncio.create_task(fetch()) for _ in range(min(self.workers, -(-size // self.chunk_size)))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            buffer.release()
+        return hasher.hexdigest()
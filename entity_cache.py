@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def entity_title(entity):
+    # channels and chats have a title, users only have first and last names
+    if getattr(entity, "title", None):
+        return entity.title
+    names = (getattr(entity, "first_name", None), getattr(entity, "last_name", None))
+    return " ".join(name for name in names if name) or "No name"
+
+
+class EntityCache:
+    def __init__(self, processor, ttl=86400, refresh_interval=600, refresh_batch=20, refresh_delay=1):
+        self.processor = processor
+        self.db_manager = processor.db_manager
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.refresh_batch = refresh_batch
+        self.refresh_delay = refresh_delay
+        self.hits = 0
+        self.misses = 0
+
+    async def store(self, entity):
+        await self.db_manager.add_entities([(entity.id, entity_title(entity), getattr(entity, "username", None),
+                                             datetime.now())])
+
+    async def get_many(self, entity_ids):
+        entity_ids = list(dict.fromkeys(entity_ids))
+        if not entity_ids:
+            return {}
+        # stale rows are still served, the background refresh updates them later
+        cached = {row[0]: (row[1], row[2]) for row in await self.db_manager.get_entities(entity_ids)}
+        missing = [entity_id for entity_id in entity_ids if entity_id not in cached]
+        self.hits += len(entity_ids) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            resolved = await asyncio.gather(*[self._resolve(entity_id) for entity_id in missing])
+            cached.update((entity_id, names or (str(entity_id), None)) for entity_id, names in zip(missing, resolved))
+        return cached
+
+    async def get(self, entity_id):
+        return (await self.get_many([entity_id]))[entity_id]
+
+    async def delete(self, entity_id):
+        await self.db_manager.delete_entity(entity_id)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("Error while refreshing cached entities: %s", e)
+
+    async def refresh(self):
+        stale = await self.db_manager.get_stale_entities(datetime.now() - timedelta(seconds=self.ttl), self.refresh_batch)
+        # a few entities at a time with a pause in between, so refreshing never competes with the pipeline for flood budget
+        for entity_id, title, username, _ in stale:
+            if await self._resolve(entity_id) is None:
+                # keep the old names until the next ttl, so one broken entity does not block the others
+                await self.db_manager.add_entities([(entity_id, title, username, datetime.now())])
+            await asyncio.sleep(self.refresh_delay)
+        if stale:
+            logger.info("Refreshed %s cached entities", len(stale))
+        return len(stale)
+
+    async def _resolve(self, entity_id):
+        try:
+            entity = await self.processor.bot.get_entity(entity_id)
+        except Exception as e:
+            logger.error("Error while resolving entity %s: %s", entity_id, e)
+            return None
+        await self.store(entity)
+        return entity_title(entity), getattr(entity, "username", None)
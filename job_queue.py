@@ -0,0 +1,131 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from metrics import JOBS
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    def __init__(self, db_manager, owner, lease=120, poll_interval=1, max_attempts=5, min_backoff=10,
+                 max_backoff=3600):
+        self.db_manager = db_manager
+        self.owner = owner
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+    async def put(self, kind, **payload):
+        job_id = await self.db_manager.add_job(kind, json.dumps(payload), datetime.now())
+        JOBS.inc(kind=kind, outcome="queued")
+        return job_id
+
+    async def work(self, kind, handler):
+        # the producers are other processes, so an empty queue is polled instead of waited on
+        while True:
+            now = datetime.now()
+            job = await self.db_manager.lease_job(kind, self.owner, now, now + timedelta(seconds=self.lease))
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self.execute(kind, handler, *job)
+
+    async def execute(self, kind, handler, job_id, payload, attempts):
+        renew_task = asyncio.create_task(self._renew(job_id))
+        started = time.perf_counter()
+        try:
+            await handler(**json.loads(payload))
+        except asyncio.CancelledError:
+            # another worker picks the job up right away instead of waiting for the lease to expire
+            await self.db_manager.release_job(job_id, self.owner)
+            JOBS.inc(kind=kind, outcome="released")
+            raise
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                logger.error("Job %s %s failed %s times, giving up: %s", kind, job_id, attempts, e, exc_info=e)
+                await self.db_manager.fail_job(job_id, self.owner, "dead", datetime.now(), str(e))
+                JOBS.inc(kind=kind, outcome="dead")
+            else:
+                delay = min(self.min_backoff * 2 ** (attempts - 1), self.max_backoff)
+                logger.warning("Job %s %s failed, retrying in %ss: %s", kind, job_id, delay, e)
+                await self.db_manager.fail_job(job_id, self.owner, "queued",
+                                               datetime.now() + timedelta(seconds=delay), str(e))
+                JOBS.inc(kind=kind, outcome="retried")
+        else:
+            await self.db_manager.complete_job(job_id, self.owner)
+            JOBS.inc(kind=kind, outcome="done")
+            logger.debug("Job %s %s done in %.2fs", kind, job_id, time.perf_counter() - started)
+        finally:
+            renew_task.cancel()
+
+    async def _renew(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            now = datetime.now()
+            if not await self.db_manager.extend_job_lease(job_id, self.owner, now + timedelta(seconds=self.lease)):
+                logger.warning("Lease of job %s was lost, another worker may run it again", job_id)
+                return
+
+
+class MediaSpool:
+    # files downloaded by the collector for the bot process, which can't download from the sources itself
+    def __init__(self, path):
+        self.path = path
+
+    def _pattern(self, source_id, message_id):
+        return os.path.join(self.path, f"{source_id}_{message_id}_*")
+
+    async def save(self, source_id, message_id, files):
+        await asyncio.to_thread(self._save, source_id, message_id, files)
+
+    def _save(self, source_id, message_id, files):
+        os.makedirs(self.path, exist_ok=True)
+        for i, file in enumerate(files):
+            extension = os.path.splitext(getattr(file, "name", ""))[1]
+            path = os.path.join(self.path, f"{source_id}_{message_id}_{i}{extension}")
+            # the bot process never sees a half written file
+            with open(path + ".tmp", "wb") as f:
+                f.write(file.getbuffer())
+            os.replace(path + ".tmp", path)
+            file.seek(0)
+
+    async def load(self, source_id, message_id):
+        return await asyncio.to_thread(self._load, source_id, message_id)
+
+    def _load(self, source_id, message_id):
+        files = []
+        for path in sorted(glob.glob(self._pattern(source_id, message_id))):
+            if path.endswith(".tmp"):
+                continue
+            with open(path, "rb") as f:
+                file = BytesIO(f.read())
+            file.name = "file" + os.path.splitext(path)[1]
+            files.append(file)
+        return files
+
+    async def discard(self, source_id, message_id):
+        await asyncio.to_thread(self._discard, glob.glob(self._pattern(source_id, message_id)))
+
+    async def prune(self, before):
+        return await asyncio.to_thread(self._prune, before.timestamp())
+
+    def _prune(self, before):
+        paths = [path for path in glob.glob(os.path.join(self.path, "*")) if os.path.getmtime(path) < before]
+        self._discard(paths)
+        return len(paths)
+
+    @staticmethod
+    def _discard(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error("Error while removing spooled file %s: %s", path, e)
@@ -0,0 +1,119 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+from metrics import LOG_RECORDS_DROPPED
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# attributes passed with `extra=log_context(...)`, the JSON output has them as separate keys
+CONTEXT_FIELDS = ("source_id", "message_id")
+
+
+def log_context(source_id, message_id=None, throttled=False):
+    return {"source_id": source_id, "message_id": message_id, "throttled": throttled}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                document[field] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        return json.dumps(document, ensure_ascii=False, default=str)
+
+
+class ThrottleFilter(logging.Filter):
+    def __init__(self, interval=10, burst=20):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+
+    def filter(self, record):
+        if not getattr(record, "throttled", False):
+            return True
+        # the format string is the same for every call site, so it identifies the kind of message
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        started, emitted, suppressed = self.windows.get(key, (now, 0, 0))
+        if now - started >= self.interval:
+            if suppressed and isinstance(record.args, tuple):
+                record.msg = f"{record.msg} (%s similar messages suppressed)"
+                record.args = record.args + (suppressed,)
+            started, emitted, suppressed = now, 0, 0
+        if emitted >= self.burst:
+            self.windows[key] = (started, emitted, suppressed + 1)
+            LOG_RECORDS_DROPPED.inc(reason="throttled")
+            return False
+        self.windows[key] = (started, emitted + 1, suppressed)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # only the message is rendered on the caller's thread, the listener applies the file format
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # a stalled disk drops log records instead of blocking the event loop
+            LOG_RECORDS_DROPPED.inc(reason="queue_full")
+
+
+class LogListener(logging.handlers.QueueListener):
+    def stop(self):
+        # stopped explicitly or at exit, whichever comes first
+        if self._thread is not None:
+            super().stop()
+
+
+def file_handler(path, max_bytes, when, backup_count):
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count,
+                                                         encoding="utf-8")
+    if max_bytes:
+        return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                    encoding="utf-8")
+    return logging.FileHandler(path, mode="a", encoding="utf-8")
+
+
+def setup_logging(path="app.log", level="INFO", max_bytes=50 * 1024 * 1024, when=None, backup_count=5,
+                  json_format=False, queue_size=10000, throttle_interval=10, throttle_burst=20):
+    handler = file_handler(path, max_bytes, when, backup_count)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+    # the file is only written by the listener thread, callers just put records on the queue
+    records = queue.Queue(queue_size)
+    listener = LogListener(records, handler, respect_handler_level=True)
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(ThrottleFilter(throttle_interval, throttle_burst))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
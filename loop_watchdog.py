@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+from metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+
+def describe_task(task):
+    if task is None:
+        return "callback"
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or task.get_name()
+
+
+class Stall:
+    def __init__(self, started, duration, task, stack):
+        self.started = started
+        self.duration = duration
+        self.task = task
+        self.stack = stack
+
+    @property
+    def location(self):
+        # the innermost frame is where the loop was stuck, e.g. add_watermark or md5
+        if not self.stack:
+            return "not captured"
+        frame = self.stack[-1]
+        return f"{frame.name} ({frame.filename.rsplit('/', 1)[-1]}:{frame.lineno})"
+
+
+class LoopWatchdog:
+    def __init__(self, tick=0.1, threshold=0.25, window=300, max_stalls=50):
+        self.tick = tick
+        self.threshold = threshold
+        self.window = window
+        self.recent = deque(maxlen=max(1, int(window / tick)))
+        self.stalls = deque(maxlen=max_stalls)
+        self.stalls_total = 0
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.capture = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        # the loop can't see its own stall while it lasts, a thread samples the stack meanwhile
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    async def run(self):
+        while True:
+            beat = self.last_beat = time.monotonic()
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            lag = max(0.0, now - beat - self.tick)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.recent.append((now, lag))
+            if lag >= self.threshold:
+                self._record_stall(beat, lag)
+
+    def _watch(self):
+        while not self.stopped.wait(self.threshold / 2):
+            beat = self.last_beat
+            if time.monotonic() - beat - self.tick < self.threshold:
+                continue
+            if self.capture is not None and self.capture[0] == beat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = traceback.extract_stack(frame)[-8:] if frame is not None else []
+            self.capture = (beat, describe_task(asyncio.current_task(self.loop)), stack)
+
+    def _record_stall(self, beat, lag):
+        capture = self.capture
+        if capture is not None and capture[0] == beat:
+            _, task, stack = capture
+        else:
+            # the stall ended before the thread looked, only its length is known
+            task, stack = "unknown", []
+        stall = Stall(datetime.now(), lag, task, stack)
+        self.stalls.append(stall)
+        self.stalls_total += 1
+        LOOP_STALLS.inc(task=task)
+        logger.warning("Event loop was blocked for %.3fs in %s at %s\n%s", lag, task, stall.location,
+                       "".join(traceback.format_list(stack)).rstrip())
+
+    def summary(self):
+        since = time.monotonic() - self.window
+        lags = sorted(lag for observed, lag in self.recent if observed >= since)
+        if not lags:
+            return None
+        return {
+            "p50": lags[len(lags) // 2],
+            "p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+            "max": lags[-1],
+            "samples": len(lags),
+        }
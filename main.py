@@ -1,17 +1,20 @@
+import argparse
 import json
 import asyncio
 import logging
+import os.path
+import signal
 
-from media_processor import MediaProcessor
-
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    filename="app.log",
-                    filemode="a"
-                    )
+from log_setup import setup_logging
+from media_processor import ROLES, MediaProcessor
 
 logger = logging.getLogger(__name__)
 
+parser = argparse.ArgumentParser(description="destrucTG")
+parser.add_argument("--role", choices=ROLES, help="part of the bot to run in this process, overrides \"role\" from config.json")
+parser.add_argument("--metrics-port", type=int, help="overrides \"metrics_port\", every process needs its own port")
+args = parser.parse_args()
+
 with open("config.json", "r") as f:
     config = json.load(f)
     CLIENT_SESSION_NAME = config["client_session_name"]
@@ -21,6 +24,49 @@ with open("config.json", "r") as f:
     BOT_TOKEN = config["bot_token"]
     MAIN_ADMIN = config["main_admin"]
     TARGET_CHANNEL = config["target_channel"]
+    COLLECTOR_SESSION_NAMES = config.get("collector_session_names")
+    RECOVERY_CONCURRENCY = config.get("recovery_concurrency", 4)
+    RECOVERY_BATCH_SIZE = config.get("recovery_batch_size", 20)
+    ALBUM_WINDOW = config.get("album_window", 1.5)
+    METRICS_HOST = config.get("metrics_host", "127.0.0.1")
+    METRICS_PORT = config.get("metrics_port")
+    TRACING_ENABLED = config.get("tracing", False)
+    MAX_TRACES = config.get("max_traces", 1000)
+    RECORD_UPDATES_PATH = config.get("record_updates_path")
+    DB_BATCH_INTERVAL_MS = config.get("db_batch_interval_ms", 5)
+    DB_BATCH_SIZE = config.get("db_batch_size", 100)
+    WARMUP_CONCURRENCY = config.get("warmup_concurrency", 8)
+    ENTITY_CACHE_TTL_HOURS = config.get("entity_cache_ttl_hours", 24)
+    WATCHDOG_TICK_MS = config.get("watchdog_tick_ms", 100)
+    WATCHDOG_THRESHOLD_MS = config.get("watchdog_threshold_ms", 250)
+    DRAIN_TIMEOUT = config.get("drain_timeout", 30)
+    LOG_PATH = config.get("log_path", "app.log")
+    LOG_LEVEL = config.get("log_level", "INFO")
+    LOG_MAX_MB = config.get("log_max_mb", 50)
+    LOG_ROTATE_WHEN = config.get("log_rotate_when")
+    LOG_BACKUP_COUNT = config.get("log_backup_count", 5)
+    LOG_JSON = config.get("log_json", False)
+    ROLE = args.role or config.get("role", "all")
+    PUBLISHER_SESSION_NAME = config.get("publisher_session_name")
+    SPOOL_DIR = config.get("spool_dir", "spool")
+    STORAGE_BACKEND = config.get("storage_backend", "sqlite")
+    DOWNLOAD_WORKERS = config.get("download_workers", 4)
+    DOWNLOAD_CHUNK_KB = config.get("download_chunk_kb", 1024)
+    PARALLEL_DOWNLOAD_MB = config.get("parallel_download_mb", 8)
+    if args.metrics_port:
+        METRICS_PORT = args.metrics_port
+
+if ROLE != "all":
+    # processes of a split deployment would rotate the same file under each other
+    log_root, log_extension = os.path.splitext(LOG_PATH)
+    LOG_PATH = f"{log_root}.{ROLE}{log_extension}"
+
+setup_logging(path=LOG_PATH,
+              level=LOG_LEVEL,
+              max_bytes=LOG_MAX_MB * 1024 * 1024,
+              when=LOG_ROTATE_WHEN,
+              backup_count=LOG_BACKUP_COUNT,
+              json_format=LOG_JSON)
 
 
 async def main():
@@ -30,12 +76,50 @@ async def main():
                                api_hash=API_HASH,
                                bot_token=BOT_TOKEN,
                                main_admin=MAIN_ADMIN,
-                               target_channel=TARGET_CHANNEL
+                               target_channel=TARGET_CHANNEL,
+                               collector_session_names=COLLECTOR_SESSION_NAMES,
+                               recovery_concurrency=RECOVERY_CONCURRENCY,
+                               recovery_batch_size=RECOVERY_BATCH_SIZE,
+                               album_window=ALBUM_WINDOW,
+                               metrics_host=METRICS_HOST,
+                               metrics_port=METRICS_PORT,
+                               tracing_enabled=TRACING_ENABLED,
+                               max_traces=MAX_TRACES,
+                               record_updates_path=RECORD_UPDATES_PATH,
+                               db_batch_interval=DB_BATCH_INTERVAL_MS / 1000,
+                               db_batch_size=DB_BATCH_SIZE,
+                               warmup_concurrency=WARMUP_CONCURRENCY,
+                               entity_ttl=ENTITY_CACHE_TTL_HOURS * 3600,
+                               watchdog_tick=WATCHDOG_TICK_MS / 1000,
+                               watchdog_threshold=WATCHDOG_THRESHOLD_MS / 1000,
+                               role=ROLE,
+                               publisher_session_name=PUBLISHER_SESSION_NAME,
+                               spool_dir=SPOOL_DIR,
+                               storage_backend=STORAGE_BACKEND,
+                               download_workers=DOWNLOAD_WORKERS,
+                               download_chunk_size=DOWNLOAD_CHUNK_KB * 1024,
+                               parallel_download_min_size=PARALLEL_DOWNLOAD_MB * 1024 * 1024
                                )
-    await processor.init_clients()
+    # settings are loaded before the clients connect, so the first updates already see them
     await processor.init_settings()
-    await processor.client.run_until_disconnected()
-    await processor.bot.run_until_disconnected()
+    await processor.init_clients()
+    await processor.warm_up_entities()
+    try:
+        # `kill -HUP` re-reads the "settings" object from config.json and the Settings table
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.create_task(processor.reload_settings()))
+    except (AttributeError, NotImplementedError):
+        logger.info("SIGHUP is not supported on this platform, settings can be reloaded from the bot")
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(stop_signal, processor.supervisor.request_stop)
+        except (AttributeError, NotImplementedError):
+            pass
+    await processor.start_background_tasks()
+    processor.mark_ready()
+    # the sessions and background workers are restarted by the supervisor until a stop is requested
+    await processor.supervisor.wait()
+    await processor.shutdown(DRAIN_TIMEOUT)
 
 
 if __name__ == '__main__':
@@ -44,4 +128,4 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logging.info("Bot stopped manually")
     except Exception as e:
-        logging.error(f"Critical error: {str(e)}")
+        logging.error("Critical error: %s", e)
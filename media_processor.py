@@ -1,25 +1,48 @@
+import asyncio
+import html
+import json
 import logging
 import os.path
 import random
+import tempfile
+import time
 from io import BytesIO
 from hashlib import md5
 
 from telethon import TelegramClient, events
-from telethon.tl.types import User, Channel, Chat
+from telethon.tl.types import User
 from telethon.custom import Button
 from telethon.errors import ScheduleTooMuchError
 from datetime import datetime, timedelta
 
-from db_manager import DBManager
+from admission import RULES as ADMISSION_RULES, format_rules
+from albums import AlbumBuffer
+from backfill import Backfiller
+from callback_router import CallbackRouter
+from collector_pool import CollectorPool
+from digest import DigestSender
+from downloader import Downloader
+from entity_cache import EntityCache
+from job_queue import JobQueue, MediaSpool
+from log_setup import log_context
+from loop_watchdog import LoopWatchdog
+from memprofile import MemoryProfiler, deep_size, format_size, rss_bytes
+from metrics import ADMISSION_REJECTED, POSTS, STAGE_SECONDS, QUEUE_DEPTH, OVERFLOW_QUEUE_SIZE, STARTUP_SECONDS, MetricsServer, registry
+from storage import create_storage
+from recorder import UpdateRecorder
+from stats import COUNTERS, SourceStats
+from supervisor import Supervisor
+from recovery import GapRecovery
+from retention import RetentionPruner
+from settings import SettingsManager
+from tracing import tracer
 from utils import add_watermark
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    filename="app.log",
-                    filemode="a"
-                    )
 logger = logging.getLogger(__name__)
 
+# "all" runs everything in one process, the other roles split it between processes that share the database
+ROLES = ("all", "collector", "publisher", "bot")
+
 class MediaProcessor:
     def __init__(self,
                  client_session_name,
@@ -28,7 +51,36 @@ class MediaProcessor:
                  api_hash,
                  bot_token,
                  main_admin,
-                 target_channel):
+                 target_channel,
+                 collector_session_names=None,
+                 recovery_concurrency=4,
+                 recovery_batch_size=20,
+                 album_window=1.5,
+                 metrics_host="127.0.0.1",
+                 metrics_port=None,
+                 tracing_enabled=False,
+                 max_traces=1000,
+                 db_path="destrucTG.db",
+                 record_updates_path=None,
+                 random_seed=None,
+                 db_batch_interval=0.005,
+                 db_batch_size=100,
+                 warmup_concurrency=8,
+                 entity_ttl=86400,
+                 watchdog_tick=0.1,
+                 watchdog_threshold=0.25,
+                 role="all",
+                 publisher_session_name=None,
+                 spool_dir="spool",
+                 sync_interval=10,
+                 storage_backend="sqlite",
+                 download_workers=4,
+                 download_chunk_size=1024 * 1024,
+                 parallel_download_min_size=8 * 1024 * 1024):
+        if role not in ROLES:
+            raise ValueError(f"Unknown role {role}, expected one of {', '.join(ROLES)}")
+        if role != "all" and storage_backend == "memory":
+            raise ValueError("In-memory storage can't be shared between processes, use role \"all\" with it")
 
         self.client_session_name = client_session_name
         self.bot_session_name = bot_session_name
@@ -37,63 +89,133 @@ class MediaProcessor:
         self.bot_token = bot_token
         self.main_admin = main_admin
         self.target_channel = target_channel
-
-        self.db_manager = DBManager('destrucTG.db')
-
+        self.collector_session_names = collector_session_names or [client_session_name]
+        # the publisher can't share a session file with a running collector, so it logs in separately
+        self.publisher_session_name = publisher_session_name or f"{client_session_name}_publisher"
+        self.role = role
+        self.collects = role in ("all", "collector")
+        self.publishes = role in ("all", "publisher")
+        self.serves_bot = role in ("all", "bot")
+        self.sync_interval = sync_interval
+        self.warmup_concurrency = warmup_concurrency
+        self.started_at = time.monotonic()
+        self.first_post_seconds = None
+
+        self.db_manager = create_storage(storage_backend, db_path, batch_interval=db_batch_interval,
+                                         batch_size=db_batch_size)
+
+        self.pool = CollectorPool()
         self.client = None
         self.bot = None
-        self.sources = []
+        self.sources = self.pool.sources
         self.admins = []
-
-        self.watermark = None
-        self.caption = None
-        self.bottom_delay = None
-        self.top_delay = None
-        self.media_types = None
+        self.live_in_flight = 0
+        # message key -> the task processing it, so a shutdown can interrupt and save it
+        self.messages_in_flight = {}
+        self.publishing = {}
+        self.claims = {}
+        self.resumed_claims = set()
+        self.resumed_keys = set()
+        self.accepting = True
+        self.source_marks = {}
+        # source id -> {message id: holds}, the stored mark never passes a message that is still being processed
+        self.mark_holds = {}
+        self.album_holds = set()
+        # releases of the tasks cancelled by a shutdown, applied once they are saved as interrupted posts
+        self.deferred_releases = None
+        self.finished_ids = {}
+        self.backfiller = Backfiller(self)
+        self.recovery = GapRecovery(self, concurrency=recovery_concurrency, batch_size=recovery_batch_size)
+        self.album_buffer = AlbumBuffer(self.process_album, window=album_window)
+        self.digest_sender = DigestSender(self)
+        self.retention = RetentionPruner(self)
+        self.stats = SourceStats(self.db_manager)
+        self.entities = EntityCache(self, ttl=entity_ttl)
+        self.watchdog = LoopWatchdog(tick=watchdog_tick, threshold=watchdog_threshold)
+        self.memory_profiler = MemoryProfiler()
+        self.supervisor = Supervisor()
+        self.jobs = JobQueue(self.db_manager, owner=f"{role}-{os.getpid()}")
+        self.spool = MediaSpool(spool_dir)
+        self.downloader = Downloader(workers=download_workers, chunk_size=download_chunk_size,
+                                     min_size=parallel_download_min_size)
+        self.metrics_server = MetricsServer(registry, metrics_host, metrics_port) if metrics_port else None
+        QUEUE_DEPTH.set_function(lambda: len(self.messages_in_flight) + len(self.album_buffer))
+        tracer.configure(tracing_enabled, max_traces)
+        self.recorder = UpdateRecorder(record_updates_path) if record_updates_path else None
+        self.random_seed = random_seed
+        self.random = random.Random(random_seed)
+
+        self.settings = SettingsManager(self.db_manager)
+        self.router = CallbackRouter(lambda user_id: user_id in self.admins, self.is_super_admin)
+        self.add_routes()
 
     async def init_clients(self):
-        self.client = TelegramClient(self.client_session_name, self.api_id, self.api_hash)
-        await self.client.start()
-        logger.info(f"Client {self.client_session_name} launched successfully")
+        clients = {}
+        if self.collects:
+            clients = {session_name: TelegramClient(session_name, self.api_id, self.api_hash)
+                       for session_name in self.collector_session_names}
+        logins = [self.start_collectors(clients)]
+        if self.serves_bot:
+            self.bot = TelegramClient(self.bot_session_name, self.api_id, self.api_hash)
+            self.bot.parse_mode = "html"
+            logins.append(self.start_bot())
+        if self.role == "publisher":
+            self.client = TelegramClient(self.publisher_session_name, self.api_id, self.api_hash)
+            logins.append(self.start_collector(self.publisher_session_name, self.client))
+        await asyncio.gather(*logins)
+        for session_name, client in clients.items():
+            self.pool.add_client(session_name, client)
+        if self.collects:
+            self.client = self.pool.primary
+        login_seconds = time.monotonic() - self.started_at
+        STARTUP_SECONDS.set(login_seconds, phase="login")
+        logger.info("Logged in %s sessions for role %s in %.2fs", len(self.telegram_clients()), self.role, login_seconds)
 
         sources = await self.db_manager.get_sources()
         if sources is not None:
             for source in sources:
                 source_id, state, chance, _ = source
-                logger.info(f"Found source {source_id}")
+                logger.info("Found source %s", source_id)
                 if state != 0:
-                    self.sources.append(source_id)
-                    logger.info(f"Source {source_id} is added to sources")
+                    owner = self.pool.add_source(source_id)
+                    logger.info("Source %s is added to sources (collector %s)", source_id, owner)
                 else:
                     logger.info("Source is not active, skipping")
         else:
             logger.info("No sources found, skipping")
-        try:
-            self.client.add_event_handler(
-                self.process_media,
-                events.NewMessage(incoming=True)
-            )
-            logger.info(f"Added sources handlers")
-        except Exception as e:
-            logger.error(f"Error while adding sources handlers: {e}")
+        if self.collects:
+            await self.rebalance_sources()
 
-        self.client.add_event_handler(self.send_media_from_db,
-                                      events.NewMessage(chats=self.target_channel,
-                                                        outgoing=True)
-                                      )
-        logger.info("Added outgoing messages handler")
+        for source_id, last_message_id in await self.db_manager.get_source_marks():
+            self.source_marks[source_id] = last_message_id
 
-        self.bot = TelegramClient(self.bot_session_name, self.api_id, self.api_hash)
-        self.bot.parse_mode = "html"
-        await self.bot.start(bot_token=self.bot_token)
-        logger.info(f"Bot {self.bot_session_name} launched successfully")
+        for session_name, client in self.pool.clients.items():
+            try:
+                client.add_event_handler(
+                    self.process_media,
+                    events.NewMessage(incoming=True)
+                )
+                logger.info("Added sources handlers for %s", session_name)
+            except Exception as e:
+                logger.error("Error while adding sources handlers for %s: %s", session_name, e)
+
+        if self.publishes:
+            for client in self.pool.clients.values() if self.collects else [self.client]:
+                client.add_event_handler(self.send_media_from_db,
+                                         events.NewMessage(chats=self.target_channel,
+                                                           outgoing=True)
+                                         )
+            logger.info("Added outgoing messages handler")
+
+        if not self.serves_bot:
+            return
         self.add_bot_handlers()
 
         admins = await self.db_manager.get_admins()
         if admins:
             for admin in admins:
                 self.admins.append(admin[0])
-                logger.info(f"Added {admin[0]} to admins list")
+                logger.info("Added %s to admins list", admin[0])
         else:
             logger.info("No admins found")
             if self.main_admin:
@@ -103,255 +225,449 @@ class MediaProcessor:
             else:
                 logger.error("Main admin was not specified, bot won't work")
 
+    async def start_collectors(self, clients):
+        await asyncio.gather(*[client.connect() for client in clients.values()])
+        authorized = await asyncio.gather(*[client.is_user_authorized() for client in clients.values()])
+        await asyncio.gather(*[self.start_collector(session_name, client)
+                               for (session_name, client), is_authorized in zip(clients.items(), authorized)
+                               if is_authorized])
+        # new sessions ask for a phone and a code in the terminal, so they are logged in one at a time
+        for (session_name, client), is_authorized in zip(clients.items(), authorized):
+            if not is_authorized:
+                await self.start_collector(session_name, client)
+
+    async def start_collector(self, session_name, client):
+        await client.start()
+        logger.info("Client %s launched successfully", session_name)
+
+    async def start_bot(self):
+        await self.bot.start(bot_token=self.bot_token)
+        logger.info("Bot %s launched successfully", self.bot_session_name)
+
+    async def warm_up_entities(self):
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.warmup_concurrency)
+
+        async def resolve(client, entity, store=True):
+            async with semaphore:
+                try:
+                    entity = await client.get_entity(entity)
+                    if store:
+                        await self.entities.store(entity)
+                    return True
+                except Exception as e:
+                    logger.error("Error while resolving entity %s: %s", entity, e)
+                    return False
+
+        # every later get_entity, get_messages and send_file call is answered from the session cache
+        publishers = list(self.pool.clients.values()) if self.collects else [self.client] if self.publishes else []
+        if self.role == "publisher":
+            await self.load_dialogs()
+        results = await asyncio.gather(
+            *[resolve(self.pool.client_for(source_id), source_id) for source_id in self.sources if self.collects],
+            *[resolve(self.client, source_id, store=False) for source_id in self.sources if self.role == "publisher"],
+            *[resolve(client, self.target_channel, store=False) for client in publishers],
+            *[resolve(self.bot, admin_id) for admin_id in dict.fromkeys(self.admins) if self.serves_bot])
+        logger.info("Resolved %s of %s source, target and admin entities in %.2fs",
+                    sum(results), len(results), time.monotonic() - started)
+
+    async def load_dialogs(self):
+        # a publisher session never received updates from the sources, its dialogs bring their access hashes
+        # into the cache, otherwise get_messages can't find the source channels
+        try:
+            await self.client.get_dialogs()
+        except Exception as e:
+            logger.error("Error while loading dialogs of %s: %s", self.publisher_session_name, e)
+
+    def mark_ready(self):
+        ready_seconds = time.monotonic() - self.started_at
+        STARTUP_SECONDS.set(ready_seconds, phase="ready")
+        logger.info("Ready in %.2fs after start", ready_seconds)
+
+    async def rebalance_sources(self):
+        _, previous_sessions = await self.db_manager.get_setting("collector_sessions")
+        current_sessions = json.dumps(list(self.pool.clients))
+        if previous_sessions is None:
+            await self.db_manager.add_setting("collector_sessions", current_sessions)
+            previous_names = [self.client_session_name]
+        else:
+            previous_names = json.loads(previous_sessions)
+        if previous_sessions == current_sessions:
+            return
+        moved = self.pool.moved_since(previous_names)
+        logger.info("Collector pool changed, %s sources moved to other collectors", len(moved))
+        for source_id in moved:
+            await self.pool.ensure_joined(source_id)
+        await self.db_manager.update_setting("collector_sessions", current_sessions)
+
     async def init_settings(self):
         logger.info("Initializing additional settings")
+        await self.settings.load()
 
-        _, watermark_path = await self.db_manager.get_setting("watermark")
-        if watermark_path is None:
-            logger.info("Watermark path not found, setting to default (\"\")")
-            await self.db_manager.add_setting("watermark", "")
-            self.watermark = None
-        else:
-            logger.info(f"Watermark path is \"{watermark_path}\"")
+    async def reload_settings(self, from_config=True):
+        try:
+            await self.settings.reload(from_config)
+        except Exception as e:
+            logger.error("Error while reloading settings: %s", e)
+            return False
+        return True
+
+    async def start_background_tasks(self):
+        supervisor = self.supervisor
+        self.watchdog.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        await self.update_overflow_queue_size()
+        for session_name, client in self.pool.clients.items():
+            supervisor.add(f"collector {session_name}", lambda client=client: self.run_client(client))
+        if self.role == "publisher":
+            supervisor.add("publisher", lambda: self.run_client(self.client))
+        if self.serves_bot:
+            supervisor.add("bot", lambda: self.run_client(self.bot))
+        supervisor.add("watchdog", self.watchdog.run)
+        if self.collects:
+            supervisor.add("recovery", self.recovery.recover, restart=False)
+        if self.collects or self.publishes:
+            supervisor.add("interrupted posts", self.resume_interrupted, restart=False)
+        if self.serves_bot:
+            supervisor.add("digest", self.digest_sender.run)
+            supervisor.add("retention", self.retention.run)
+            supervisor.add("entities", self.entities.run)
+        supervisor.add("stats", self.stats.run)
+        if self.role == "collector":
+            supervisor.add("backfill jobs", lambda: self.jobs.work("backfill", self.backfiller.run_job))
+        elif self.role == "publisher":
+            supervisor.add("publish jobs", lambda: self.jobs.work("publish", self.publish_job))
+        elif self.role == "bot":
+            supervisor.add("approval jobs", lambda: self.jobs.work("approval", self.approval_job))
+        if self.role != "all":
+            supervisor.add("shared state", self.follow_shared_state)
+        if self.collects:
+            await self.backfiller.resume_all()
+
+    def telegram_clients(self):
+        clients = list(self.pool.clients.values())
+        if self.client is not None and self.client not in clients:
+            clients.append(self.client)
+        if self.bot is not None:
+            clients.append(self.bot)
+        return clients
+
+    async def follow_shared_state(self):
+        # sources, backfills and settings are changed from the bot process, the others pick the changes up from the database
+        while True:
+            await asyncio.sleep(self.sync_interval)
             try:
-                self.watermark = open(watermark_path, "rb")
-            except FileNotFoundError:
-                logger.info("Watermark file was probably moved or deleted, setting watermark path to (\"\")")
-                self.watermark = None
-                await self.db_manager.update_setting("watermark", "")
-
-
-        _, caption = await self.db_manager.get_setting("caption")
-        if caption is None:
-            logger.info("Caption not found, setting to default (\"\")")
-            await self.db_manager.add_setting("caption", "")
-            self.caption = ""
-        else:
-            logger.info(f"Caption is \"{caption}\"")
-            self.caption = caption
-
-        _, bottom_delay = await self.db_manager.get_setting("bottom_delay")
-        if bottom_delay is None:
-            logger.info("Bottom delay not found, setting to default (720)")
-            await self.db_manager.add_setting("bottom_delay", "720")
-            self.bottom_delay = 720
-        else:
-            logger.info(f"Bottom delay is {bottom_delay}")
-            self.bottom_delay = int(bottom_delay)
-
-        _, top_delay = await self.db_manager.get_setting("top_delay")
-        if top_delay is None:
-            logger.info("Top delay not found, setting to default (1440)")
-            await self.db_manager.add_setting("top_delay", "1440")
-            self.top_delay = 1440
-        else:
-            logger.info(f"Top delay is {top_delay}")
-            self.top_delay = int(top_delay)
-
-        _, media_types = await self.db_manager.get_setting("media_types")
-        if media_types is None:
-            logger.info("Media types not found, setting to default (\"pic+vid\")")
-            await self.db_manager.add_setting("media_types", "pic+vid")
-            self.media_types = "pic+vid"
-        else:
-            logger.info(f"Media types is \"{media_types}\"")
-            self.media_types = media_types
+                if await self.settings.refresh():
+                    logger.info("Settings changed by another process were loaded")
+                if self.collects or self.publishes:
+                    await self.sync_sources()
+            except Exception as e:
+                logger.error("Error while syncing shared state: %s", e)
+
+    async def sync_sources(self):
+        sources = {source_id: state for source_id, state, _, _ in await self.db_manager.get_sources()}
+        added = []
+        for source_id, state in sources.items():
+            if state != 0 and source_id not in self.sources:
+                owner = self.pool.add_source(source_id)
+                logger.info("Source %s is added to sources (collector %s)", source_id, owner)
+                added.append(source_id)
+                if len(self.pool) > 1:
+                    await self.pool.ensure_joined(source_id)
+        if added and self.role == "publisher":
+            await self.load_dialogs()
+        for source_id in [source_id for source_id in self.sources if source_id not in sources]:
+            logger.info("Source %s was deleted, removing it from sources", source_id)
+            self.pool.remove_source(source_id)
+            self.forget_source_mark(source_id)
+
+    async def run_client(self, client):
+        # telethon reconnects on its own, this only runs once it gave up
+        if not client.is_connected():
+            await client.connect()
+        await client.run_until_disconnected()
+
+    async def shutdown(self, drain_timeout=30):
+        started = time.monotonic()
+        await self.drain(drain_timeout)
+        await self.supervisor.stop()
+        self.watchdog.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        for client in self.telegram_clients():
+            await client.disconnect()
+        await self.stats.flush()
+        await self.db_manager.close()
+        logger.info("Shut down in %.2fs", time.monotonic() - started)
+
+    async def drain(self, timeout):
+        # new updates are left to gap recovery, the source marks do not move past them
+        self.accepting = False
+        deadline = time.monotonic() + timeout
+        flush_task = asyncio.create_task(self.album_buffer.flush_all())
+        while (self.messages_in_flight or self.publishing or not flush_task.done()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        processing = dict(self.messages_in_flight)
+        publishing = dict(self.publishing)
+        claims = dict(self.claims)
+        tasks = set(processing.values()) | {task for task, _, _ in publishing.values()} | {flush_task}
+        self.deferred_releases = []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.backfiller.stop_all()
+
+        # approved posts are published right away on the next start, the rest goes through processing again,
+        # posts published from a job are not saved, the job queue gives them to the next publisher
+        interrupted = [(source_id, message_id, "schedule" if schedule else "send", None)
+                       for (source_id, message_id), (task, schedule, queued) in publishing.items()
+                       if task.cancelled() and not queued]
+        interrupted.extend((source_id, message_id, "process", claims.get((source_id, message_id)))
+                           for (source_id, message_id), task in processing.items()
+                           if task.cancelled() and (source_id, message_id) not in publishing)
+        for (source_id, _), album in self.album_buffer.albums.items():
+            interrupted.extend((source_id, message_id, "process", None) for message_id in album["messages"])
+        if interrupted:
+            await self.db_manager.add_interrupted_posts(interrupted, datetime.now())
+        logger.info("Drained in-flight work, %s interrupted posts saved for the next start", len(interrupted))
+        # if saving failed the marks stay below the cancelled posts and gap recovery picks them up again
+        deferred_releases, self.deferred_releases = self.deferred_releases, None
+        for source_id, message_id in deferred_releases:
+            await self.release_mark(source_id, message_id)
+
+    async def resume_interrupted(self):
+        posts = await self.db_manager.get_interrupted_posts()
+        if not posts:
+            return
+        logger.info("Resuming %s posts interrupted by the last shutdown", len(posts))
+        message_ids = {}
+        for source_id, message_id, stage, media_hash, _ in posts:
+            # each process only resumes the stage it runs, the rest stays for the other process
+            if not (self.collects if stage == "process" else self.publishes):
+                continue
+            if stage != "process":
+                await self.schedule_media(source_id, message_id, stage == "schedule")
+                await self.db_manager.delete_interrupted_posts(source_id, [message_id])
+                continue
+            message_ids.setdefault(source_id, []).append(message_id)
+            self.resumed_keys.add((source_id, message_id))
+            # the hash was claimed by this post before the shutdown, it is not a duplicate of itself
+            if media_hash:
+                self.resumed_claims.add(media_hash)
+        for source_id, source_message_ids in message_ids.items():
+            client = self.pool.client_for(source_id)
+            if client is not None:
+                messages = await client.get_messages(source_id, ids=source_message_ids)
+                for message in messages:
+                    if message is not None:
+                        await self.handle_message(client, source_id, message, live=False, check_mark=False)
+            await self.db_manager.delete_interrupted_posts(source_id, source_message_ids)
+
+    async def claim_hash(self, media_hash):
+        if media_hash in self.resumed_claims:
+            self.resumed_claims.discard(media_hash)
+            return True
+        return await self.db_manager.claim_media_hash(media_hash, datetime.now(), self.dedup_since())
+
+    async def release_hashes(self, media_hashes):
+        # claims of a post that was not taken after all, so its files stay new for the next post
+        await asyncio.gather(*[self.db_manager.delete_media_hash(media_hash) for media_hash in media_hashes])
+
+    def add_routes(self):
+        # the longest prefix wins, so "approve" never takes "approve_instantly" or "add" takes "add_admin"
+        route = self.router.add
+        route("main", self.main_handler)
+        route("manage_sources", self.manage_sources_handler)
+        route("list_sources", self.list_sources_handler, int, int, int)
+        route("add_source", self.add_source_handler, super_admin="add sources")
+        route("edit", self.edit_source_handler, int, super_admin="edit sources")
+        route("edit_state", self.edit_state_handler, int)
+        route("update_state", self.update_state_handler, int, int)
+        route("edit_chance", self.edit_chance_handler, int)
+        route("new_source", self.new_source_handler, int, int, int, legacy="add")
+        route("delete", self.delete_source_handler, int)
+        route("source_stats", self.source_stats_handler, int)
+        route("sources_stats", self.sources_stats_handler)
+        route("backfill", self.backfill_handler, int)
+        route("backfill_start", self.start_backfill_handler, int, str, int)
+        route("backfill_stop", self.stop_backfill_handler, int)
+        route("approve", self.approve_handler, int, int)
+        route("approve_instantly", self.instant_approve_handler, int, int)
+        route("reject", self.reject_handler, int, int)
+        route("digest_approve", self.digest_approve_handler, int)
+        route("digest_reject", self.digest_reject_handler, int)
+        route("manage_admins", self.manage_admins_handler)
+        route("list_admins", self.list_admins_handler, int, int, int)
+        route("add_admin", self.add_admin_handler, super_admin="add admins")
+        route("edit_admin", self.edit_admin_handler, int, super_admin="edit admins")
+        route("sub", self.edit_subscription_handler, int, int)
+        route("super", self.edit_superadmin_handler, int, int)
+        route("new_admin", self.new_admin_handler, int, int, legacy="add_admin")
+        route("delete_admin", self.delete_admin_handler, int)
+        route("additional_settings", self.additional_settings_handler, super_admin="edit additional settings")
+        route("watermark", self.watermark_handler, super_admin="edit watermark")
+        route("add_watermark", self.add_watermark_handler, super_admin="add watermark")
+        route("disable_watermark", self.disable_watermark_handler, super_admin="disable watermark")
+        route("caption", self.caption_handler, super_admin="edit caption")
+        route("add_caption", self.add_caption_handler, super_admin="add caption")
+        route("disable_caption", self.disable_caption_handler, super_admin="disable caption")
+        route("delays", self.delay_handler, super_admin="edit delays")
+        # the old "bottom_delay"/"top_delay" buttons only lived in the settings menu, they are not decoded
+        route("edit_delay", self.edit_delay_handler, str, super_admin="edit delays", legacy=False)
+        route("media_types", self.media_type_handler, super_admin="edit media types")
+        route("update_media", self.edit_media_type_handler, str, super_admin="edit media types")
+        route("admission", self.admission_handler, super_admin="edit admission rules")
+        route("admission_edit", self.edit_admission_handler, super_admin="edit admission rules")
+        route("admission_clear", self.clear_admission_handler, super_admin="edit admission rules")
+        route("approval_mode", self.approval_mode_handler, super_admin="edit approval mode")
+        route("approval_set", self.edit_approval_mode_handler, str, super_admin="edit approval mode")
+        route("digest_interval", self.digest_interval_handler, super_admin="edit digest interval")
+        route("diagnostics", self.diagnostics_handler, super_admin="view diagnostics")
+        route("export_traces", self.export_traces_handler, str, super_admin="export traces")
+        route("loop_lag", self.loop_lag_handler, super_admin="view diagnostics")
+        route("memory", self.memory_handler, super_admin="profile memory")
+        route("memory_start", self.memory_start_handler, super_admin="profile memory")
+        route("memory_stop", self.memory_stop_handler, super_admin="profile memory")
+        route("storage", self.storage_handler, super_admin="view storage")
+        route("dedup_window", self.dedup_window_handler, super_admin="edit dedup window")
+        route("confirmation_ttl", self.confirmation_ttl_handler, super_admin="edit confirmation TTL")
+        route("prune_now", self.prune_now_handler, super_admin="prune storage")
+        route("reload_settings", self.reload_settings_handler, super_admin="reload settings")
+
+    async def is_super_admin(self, user_id):
+        _, _, _, _, super_admin = await self.db_manager.get_admin(user_id)
+        return bool(super_admin)
 
     def add_bot_handlers(self):
-        logger.info(f"Adding bot handlers")
+        logger.info("Adding bot handlers")
         try:
             self.bot.add_event_handler(
                 self.start_handler,
                 events.NewMessage(pattern="/start")
             )
-            self.bot.add_event_handler(
-                self.main_handler,
-                events.CallbackQuery(data=b"main")
-            )
-            self.bot.add_event_handler(
-                self.manage_sources_handler,
-                events.CallbackQuery(data=b"manage_sources")
-            )
-            self.bot.add_event_handler(
-                self.list_sources_handler,
-                events.CallbackQuery(pattern=r"list_sources_\d+")
-            )
-            self.bot.add_event_handler(
-                self.add_source_handler,
-                events.CallbackQuery(data=b"add_source")
-            )
-            self.bot.add_event_handler(
-                self.edit_source_handler,
-                events.CallbackQuery(pattern=r"edit_\d+")
-            )
-            self.bot.add_event_handler(
-                self.edit_state_handler,
-                events.CallbackQuery(pattern=r"edit_state_\d+")
-            )
-            self.bot.add_event_handler(
-                self.update_state_handler,
-                events.CallbackQuery(pattern=r"update_state_\d+")
-            )
-            self.bot.add_event_handler(
-                self.edit_chance_handler,
-                events.CallbackQuery(pattern=r"edit_chance_\d+")
-            )
-            self.bot.add_event_handler(
-                self.new_source_handler,
-                events.CallbackQuery(pattern=r"add_\d+_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.delete_source_handler,
-                events.CallbackQuery(pattern=r"delete_\d+")
-            )
-            self.bot.add_event_handler(
-                self.approve_handler,
-                events.CallbackQuery(pattern=r"approve_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.instant_approve_handler,
-                events.CallbackQuery(pattern=r"approve_instantly_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.reject_handler,
-                events.CallbackQuery(pattern=r"reject_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.manage_admins_handler,
-                events.CallbackQuery(data=b"manage_admins")
-            )
-            self.bot.add_event_handler(
-                self.list_admins_handler,
-                events.CallbackQuery(pattern=r"list_admins_\d+")
-            )
-            self.bot.add_event_handler(
-                self.add_admin_handler,
-                events.CallbackQuery(data=b"add_admin")
-            )
-            self.bot.add_event_handler(
-                self.edit_admin_handler,
-                events.CallbackQuery(pattern=r"edit_admin_\d+")
-            )
-            self.bot.add_event_handler(
-                self.edit_subscription_handler,
-                events.CallbackQuery(pattern=r"sub_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.edit_superadmin_handler,
-                events.CallbackQuery(pattern=r"super_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.new_admin_handler,
-                events.CallbackQuery(pattern=r"add_admin_\d+_\d+")
-            )
-            self.bot.add_event_handler(
-                self.delete_admin_handler,
-                events.CallbackQuery(pattern=r"delete_admin_\d+")
-            )
-            self.bot.add_event_handler(
-                self.additional_settings_handler,
-                events.CallbackQuery(pattern=b"additional_settings")
-            )
-            self.bot.add_event_handler(
-                self.watermark_handler,
-                events.CallbackQuery(pattern=b"watermark")
-            )
-            self.bot.add_event_handler(
-                self.add_watermark_handler,
-                events.CallbackQuery(pattern=b"add_watermark")
-            )
-            self.bot.add_event_handler(
-                self.disable_watermark_handler,
-                events.CallbackQuery(pattern=b"disable_watermark")
-            )
-            self.bot.add_event_handler(
-                self.caption_handler,
-                events.CallbackQuery(pattern=b"caption")
-            )
-            self.bot.add_event_handler(
-                self.add_caption_handler,
-                events.CallbackQuery(pattern=b"add_caption")
-            )
-            self.bot.add_event_handler(
-                self.disable_caption_handler,
-                events.CallbackQuery(pattern=b"disable_caption")
-            )
-            self.bot.add_event_handler(
-                self.delay_handler,
-                events.CallbackQuery(pattern=b"delays")
-            )
-            self.bot.add_event_handler(
-                self.edit_delay_handler,
-                events.CallbackQuery(pattern=r".+_delay")
-            )
             self.bot.add_event_handler(
                 self.new_message_handler,
                 events.NewMessage()
             )
+            # one handler for every button, telethon would otherwise run each CallbackQuery pattern per press
             self.bot.add_event_handler(
-                self.media_type_handler,
-                events.CallbackQuery(pattern=b"media_types")
-            )
-            self.bot.add_event_handler(
-                self.edit_media_type_handler,
-                events.CallbackQuery(pattern=r"update_media_.+")
+                self.router.dispatch,
+                events.CallbackQuery()
             )
-            logger.info(f"Bot handlers successfully added")
+            logger.info("Bot handlers successfully added")
         except Exception as e:
-            logger.error(f"Error while adding bot handlers: {e}")
+            logger.error("Error while adding bot handlers: %s", e)
+
+    def media_filter(self, message):
+        return self.settings.current.media_predicate(message)
+
+    def record_first_post(self):
+        # only a post that got through filtering and dedup counts, skipped messages say nothing about startup
+        if self.first_post_seconds is None:
+            self.first_post_seconds = time.monotonic() - self.started_at
+            STARTUP_SECONDS.set(self.first_post_seconds, phase="first_post")
+            logger.info("First post processed %.2fs after start", self.first_post_seconds)
+
+    async def publish(self, source_id, message_id, schedule):
+        self.record_first_post()
+        if self.publishes:
+            await self.schedule_media(source_id, message_id, schedule)
+        else:
+            await self.jobs.put("publish", source_id=source_id, message_id=message_id, schedule=schedule)
 
-    def media_filter(self, event):
-        if self.media_types == "pic+vid":
-            if event.photo or event.video:
-                return True
-            return False
-        elif self.media_types == "pic":
-            if event.photo:
-                return True
-            return False
-        elif self.media_types == "vid":
-            if event.video:
-                return True
-            return False
+    async def request_approval(self, source_id, message_id, files):
+        self.record_first_post()
+        if self.serves_bot:
+            await self.send_for_approval(source_id, message_id, files)
+            return
+        await self.spool.save(source_id, message_id, files if isinstance(files, list) else [files])
+        await self.jobs.put("approval", source_id=source_id, message_id=message_id, album=isinstance(files, list))
 
-    async def schedule_media(self, source_id, message_id, schedule):
+    async def publish_job(self, source_id, message_id, schedule):
+        await self.schedule_media(source_id, message_id, schedule, queued=True)
+
+    async def approval_job(self, source_id, message_id, album):
+        files = await self.spool.load(source_id, message_id)
+        if not files:
+            logger.error("Spooled files of post %s_%s are missing, skipping it", source_id, message_id,
+                         extra=log_context(source_id, message_id))
+            return
+        await self.send_for_approval(source_id, message_id, files if album else files[0])
+        # digests are sent later from the spooled files
+        if self.settings.current.approval_mode != "digest":
+            await self.spool.discard(source_id, message_id)
+
+    async def schedule_media(self, source_id, message_id, schedule, queued=False):
+        trace_key = (source_id, message_id)
+        self.publishing[trace_key] = (asyncio.current_task(), schedule, queued)
+        try:
+            await self._schedule_media(source_id, message_id, schedule, queued)
+        finally:
+            self.publishing.pop(trace_key, None)
+
+    async def _schedule_media(self, source_id, message_id, schedule, queued=False):
+        trace_key = (source_id, message_id)
+        client = self.pool.client_for(source_id) or self.client
+        album_ids = await self.db_manager.get_album(source_id, message_id)
         try:
-            source_message = await self.client.get_messages(source_id, ids=message_id)
-            media = source_message.media
+            source_messages = await client.get_messages(source_id, ids=album_ids or [message_id])
         except Exception as e:
-            logger.error(f"Error while getting mediafile: {str(e)}")
-            logger.info("Message was probably deleted or broken, skipping it")
+            logger.error("Error while getting mediafile: %s", e, extra=log_context(source_id, message_id))
+            # a queued job is retried with backoff, a failed lookup is not a reason to drop the post
+            if queued:
+                raise
+            logger.info("Message was probably broken, skipping it", extra=log_context(source_id, message_id))
+            return
+        source_messages = [message for message in source_messages if message and message.media]
+        medias = [source_message.media for source_message in source_messages]
+        if not medias:
+            logger.info("Message was deleted, skipping it", extra=log_context(source_id, message_id))
+            if album_ids:
+                await self.db_manager.delete_album(source_id, message_id)
             return
 
+        settings = self.settings.current
         try:
-            if source_message.photo and self.watermark:
-                image_bytes = await self.client.download_media(media, file=bytes)
-                media = add_watermark(image_bytes, self.watermark)
+            for i, source_message in enumerate(source_messages):
+                if source_message.photo and settings.watermark:
+                    with STAGE_SECONDS.time(stage="download"), tracer.span(trace_key, "download"):
+                        image_bytes = await client.download_media(medias[i], file=bytes)
+                    with STAGE_SECONDS.time(stage="watermark"), tracer.span(trace_key, "watermark"):
+                        medias[i] = add_watermark(image_bytes, BytesIO(settings.watermark))
 
             if schedule:
                 now = datetime.now()
-                target_time = now + timedelta(minutes=random.randint(self.bottom_delay, self.top_delay))
+                target_time = now + timedelta(minutes=self.random.randint(settings.bottom_delay, settings.top_delay))
                 target_time = target_time.astimezone()
             else:
                 target_time = None
 
-            await self.client.send_file(
-                self.target_channel,
-                file=media,
-                caption=self.caption,
-                schedule=target_time,
-                parse_mode="html"
-            )
-            _, _, _, posts_amount = await self.db_manager.get_source(source_id)
-            await self.db_manager.update_posts_amount(source_id, posts_amount + 1)
+            with STAGE_SECONDS.time(stage="upload"), tracer.span(trace_key, "send_file"):
+                await client.send_file(
+                    self.target_channel,
+                    file=medias if album_ids else medias[0],
+                    caption=settings.caption,
+                    schedule=target_time,
+                    parse_mode="html"
+                )
+            POSTS.inc(stage="published")
+            self.stats.inc(source_id, "published")
+            await self.db_manager.increment_posts_amount(source_id)
+            if album_ids:
+                await self.db_manager.delete_album(source_id, message_id)
             if target_time:
-                logger.info(f"Mediafile scheduled for {target_time}")
+                logger.info("Mediafile scheduled for %s", target_time, extra=log_context(source_id, message_id))
             else:
-                logger.info(f"Mediafile sent instantly")
+                logger.info("Mediafile sent instantly", extra=log_context(source_id, message_id))
 
         except ScheduleTooMuchError:
-            logger.info(f"Scheduled messages are full, adding post to db instead")
+            logger.info("Scheduled messages are full, adding post to db instead", extra=log_context(source_id, message_id))
             await self.db_manager.add_scheduled_post(source_id, message_id, datetime.now())
+            await self.update_overflow_queue_size()
+
+    async def update_overflow_queue_size(self):
+        OVERFLOW_QUEUE_SIZE.set(await self.db_manager.count_scheduled_posts())
 
     async def start_handler(self, event):
         sender = await event.get_sender()
@@ -360,7 +676,7 @@ class MediaProcessor:
         await self.db_manager.update_subscription(sender.id, 1)
         await self.db_manager.update_user_state(sender.id, "idle")
         reply_message = await event.reply("Welcome to destrucTG control bot.\nPress the button below to continue.",
-                                          buttons=[[Button.inline("Start", data="main")]]
+                                          buttons=[[Button.inline("Start", data=self.router.encode("main"))]]
                                           )
         _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
         if menu_message:
@@ -369,161 +685,109 @@ class MediaProcessor:
         await reply_message.pin()
 
     async def main_handler(self, event):
-        if event.query.user_id not in self.admins:
-            return
         await event.edit("Main menu",
-                         buttons=[[Button.inline("Manage sources", data="manage_sources")],
-                                  [Button.inline("Manage bot admins", data="manage_admins")],
-                                  [Button.inline("Additional settings", data="additional_settings")]]
+                         buttons=[[Button.inline("Manage sources", data=self.router.encode("manage_sources"))],
+                                  [Button.inline("Manage bot admins", data=self.router.encode("manage_admins"))],
+                                  [Button.inline("Additional settings", data=self.router.encode("additional_settings"))]]
                          )
 
     async def manage_sources_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
         await self.db_manager.update_user_state(event.query.user_id, "idle")
         await event.edit("Managing sources",
-                         buttons=[[Button.inline("List sources", data="list_sources_1")],
-                                  [Button.inline("Add source", data="add_source")],
-                                  [Button.inline("Main Menu", data="main")]]
+                         buttons=[[Button.inline("List sources", data=self.router.encode("list_sources", 1))],
+                                  [Button.inline("Add source", data=self.router.encode("add_source"))],
+                                  [Button.inline("Statistics", data=self.router.encode("sources_stats"))],
+                                  [Button.inline("Main Menu", data=self.router.encode("main"))]]
                          )
 
-    async def list_sources_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        sources_page_number = int(event.data.decode("utf-8").split("_")[2])
+    async def list_sources_handler(self, event, sources_page_number, after_id=None, before_id=None):
         if sources_page_number < 1:
             return
-        sources = await self.db_manager.get_sources()
-        if sources:
-            basic_buttons = [[Button.inline("Prev", data=f"list_sources_{sources_page_number-1}"),
-                              Button.inline("Back ⬅️", data="manage_sources"),
-                              Button.inline("Next", data=f"list_sources_{sources_page_number+1}")]]
-            sources_on_page = sources[5*(sources_page_number-1):5*sources_page_number]
+        sources_amount = await self.db_manager.count_sources()
+        if sources_amount:
+            sources_on_page = await self.db_manager.get_sources_page(after_id, before_id, 5)
             if sources_on_page:
-                sources_buttons = []
-                for source in sources_on_page:
-                    source_object = await self.bot.get_entity(source[0])
-                    if isinstance(source_object, (Chat, Channel)):
-                        source_name = source_object.title
-                    elif isinstance(source_object, User):
-                        source_name = f"{source_object.first_name} {source_object.last_name}"
-                    else:
-                        source_name = "No name"
-
-                    sources_buttons.append([Button.inline(source_name, data=f"edit_{source[0]}")])
-                await event.edit("Here is the list of sources.\nClick one of the buttons below to edit properties of source.",
+                basic_buttons = [[Button.inline("Prev", data=self.router.encode("list_sources", sources_page_number-1, None, sources_on_page[0][0])),
+                                  Button.inline("Back ⬅️", data=self.router.encode("manage_sources")),
+                                  Button.inline("Next", data=self.router.encode("list_sources", sources_page_number+1, sources_on_page[-1][0]))]]
+                source_names = await self.entities.get_many([source[0] for source in sources_on_page])
+                sources_buttons = [[Button.inline(source_names[source[0]][0], data=self.router.encode("edit", source[0]))]
+                                   for source in sources_on_page]
+                await event.edit(f"Here is the list of sources (page {sources_page_number} of {-(-sources_amount // 5)}).\n"
+                                 f"Click one of the buttons below to edit properties of source.",
                                  buttons=sources_buttons+basic_buttons
                                  )
             else:
                 await event.answer("No sources to show.")
         else:
             await event.edit("No sources have been added yet.",
-                             buttons=[[Button.inline("Back ⬅️", data="manage_sources")]])
+                             buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_sources"))]])
 
     async def add_source_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            message_text = "You're not allowed to add sources"
-        else:
-            message_text = "Send new source link/username/id"
-            await self.db_manager.update_user_state(event.query.user_id, "adding_source")
-        await event.edit(message_text,
-                         buttons=[[Button.inline("Back ⬅️", data="manage_sources")]]
+        await self.db_manager.update_user_state(event.query.user_id, "adding_source")
+        await event.edit("Send new source link/username/id",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_sources"))]]
                          )
 
-    async def new_source_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        data = event.data.decode("utf-8").split("_")
-        source_id = int(data[1])
-        source_chance = int(data[2])
-        source_state = int(data[3])
+    async def new_source_handler(self, event, source_id, source_chance, source_state):
         await self.db_manager.add_source(source_id, source_state, source_chance, 0)
-        self.sources.append(source_id)
+        owner = self.pool.add_source(source_id)
+        logger.info("Source %s is assigned to collector %s", source_id, owner)
+        if len(self.pool) > 1:
+            await self.pool.ensure_joined(source_id)
         await event.edit(f"Source {source_id} successfully added.",
-                         buttons=[[Button.inline("Back", data="manage_sources")]]
+                         buttons=[[Button.inline("Back", data=self.router.encode("manage_sources"))]]
                          )
 
-    async def edit_source_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit sources",
-                             buttons=[[Button.inline("Back ⬅️", data="list_sources_1")]]
-                             )
+    async def edit_source_handler(self, event, source_id):
+        _, source_state, source_chance, source_amount = await self.db_manager.get_source(source_id)
+
+        source_name, source_username = await self.entities.get(source_id)
+        if source_username:
+            source_link_text = f"<a href=https://t.me/{source_username}>{source_name}</a>"
         else:
-            source_id = int(event.data.decode("utf-8").split("_")[1])
-            _, source_state, source_chance, source_amount = await self.db_manager.get_source(source_id)
-
-            source_object = await self.bot.get_entity(source_id)
-            if isinstance(source_object, (Chat, Channel)):
-                source_name = source_object.title
-            elif isinstance(source_object, User):
-                source_name = f"{source_object.first_name} {source_object.last_name if source_object.last_name else ''}"
-            else:
-                source_name = "No name"
+            source_link_text = source_name
 
-            if source_object.username:
-                source_link_text = f"<a href=https://t.me/{source_object.username}>{source_name}</a>"
-            else:
-                source_link_text = source_name
-
-            if source_state == 0:
-                state = "inactive"
-            elif source_state == 1:
-                state = "active"
-            elif source_state == 2:
-                state = "active + auto approve"
-
-            await event.edit(f"<b>Source:</b> <i>{source_link_text}</i>\n"
-                             f"<b>State:</b> <i>{source_state} ({state})</i>\n"
-                             f"<b>Chance:</b> <i>{source_chance}%</i>\n"
-                             f"<b>Posts taken:</b> <i>{source_amount}</i>",
-                             parse_mode="html",
-                             buttons=[[Button.inline("Edit state", data=f"edit_state_{source_id}")],
-                                      [Button.inline("Edit chance", data=f"edit_chance_{source_id}")],
-                                      [Button.inline("Delete Source", data=f"delete_{source_id}")],
-                                      [Button.inline("Back ⬅️", data="list_sources_1")]])
-
-    async def edit_state_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        source_id = int(event.data.decode("utf-8").split("_")[2])
+        if source_state == 0:
+            state = "inactive"
+        elif source_state == 1:
+            state = "active"
+        elif source_state == 2:
+            state = "active + auto approve"
+
+        await event.edit(f"<b>Source:</b> <i>{source_link_text}</i>\n"
+                         f"<b>State:</b> <i>{source_state} ({state})</i>\n"
+                         f"<b>Chance:</b> <i>{source_chance}%</i>\n"
+                         f"<b>Posts taken:</b> <i>{source_amount}</i>",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Edit state", data=self.router.encode("edit_state", source_id))],
+                                  [Button.inline("Edit chance", data=self.router.encode("edit_chance", source_id))],
+                                  [Button.inline("Statistics", data=self.router.encode("source_stats", source_id))],
+                                  [Button.inline("Backfill history", data=self.router.encode("backfill", source_id))],
+                                  [Button.inline("Delete Source", data=self.router.encode("delete", source_id))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("list_sources", 1))]])
+
+    async def edit_state_handler(self, event, source_id):
         _, source_state, _, _ = await self.db_manager.get_source(source_id)
         if source_state:
             await event.edit(f"Choose state for channel {source_id}\n",
                              parse_mode="html",
                              buttons=[[Button.inline(f"Active {'[chosen]' if source_state == 1 else ''}",
-                                                     data=f"update_state_{source_id}_1")],
+                                                     data=self.router.encode("update_state", source_id, 1))],
                                       [Button.inline(f"Active (with auto approve) {'[chosen]' if source_state == 2 else ''}",
-                                                     data=f"update_state_{source_id}_2")],
+                                                     data=self.router.encode("update_state", source_id, 2))],
                                       [Button.inline(f"Inactive {'[chosen]' if source_state == 0 else ''}",
-                                                     data=f"update_state_{source_id}_0")],
-                                      [Button.inline("Back ⬅️", data=f"edit_{source_id}")]]
+                                                     data=self.router.encode("update_state", source_id, 0))],
+                                      [Button.inline("Back ⬅️", data=self.router.encode("edit", source_id))]]
                              )
         else:
             await event.edit(f"Source {source_id} was removed from sources",
-                             buttons=[[Button.inline("Back ⬅️", data="list_sources_1")]]
+                             buttons=[[Button.inline("Back ⬅️", data=self.router.encode("list_sources", 1))]]
                              )
 
-    async def update_state_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        data = event.data.decode("utf-8").split("_")
-        source_id = int(data[2])
-        source_state = int(data[3])
+    async def update_state_handler(self, event, source_id, source_state):
         await self.db_manager.update_state(source_id, source_state)
-        logger.info(f"Source {source_id} state was updated to {source_state}")
+        logger.info("Source %s state was updated to %s", source_id, source_state)
         if source_state == 0:
             state = "inactive"
         elif source_state == 1:
@@ -532,207 +796,261 @@ class MediaProcessor:
             state = "active + auto approve"
         await event.edit(f"Source {source_id} state was updated to <i>{state}</i>",
                          parse_mode="html",
-                         buttons=[[Button.inline("Back ⬅️", data=f"edit_{source_id}")]]
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit", source_id))]]
                          )
 
-    async def edit_chance_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        source_id = int(event.data.decode("utf-8").split("_")[2])
+    async def edit_chance_handler(self, event, source_id):
         await self.db_manager.update_user_state(event.query.user_id, f"update_chance_{source_id}")
         await event.edit(f"Send new chance for {source_id} (from 1 to 100)",
-                         buttons=[[Button.inline("Back ⬅️", data=f"edit_{source_id}")]]
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit", source_id))]]
                          )
 
-    async def delete_source_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        source_id = int(event.data.decode("utf-8").split("_")[1])
+    async def delete_source_handler(self, event, source_id):
+        await self.backfiller.cancel(source_id)
         await self.db_manager.delete_source(source_id)
+        await self.db_manager.delete_source_mark(source_id)
+        await self.db_manager.delete_albums(source_id)
+        await self.db_manager.delete_source_stats(source_id)
+        await self.entities.delete(source_id)
+        self.forget_source_mark(source_id)
         await self.db_manager.delete_scheduled_posts(source_id)
-        self.sources.remove(source_id)
+        self.pool.remove_source(source_id)
         await event.edit(f"Source {source_id} deleted.",
-                         buttons=[[Button.inline("Back ⬅️", data="list_sources_1")]]
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("list_sources", 1))]]
+                         )
+
+    async def source_stats_handler(self, event, source_id):
+        periods = [("24h", 1), ("7d", 7), ("30d", 30), ("all", None)]
+        totals = [await self.stats.totals(source_id, days) for _, days in periods]
+        rows = [f"{'':<14}" + "".join(f"{name:>7}" for name, _ in periods)]
+        for counter in COUNTERS:
+            rows.append(f"{counter:<14}" + "".join(f"{total[counter] or 0:>7}" for total in totals))
+        hourly = dict(await self.stats.hourly(source_id, 24))
+        now = datetime.now()
+        published = [(hourly.get((now - timedelta(hours=hours)).strftime("%Y-%m-%d %H")) or {}).get("published", 0)
+                     for hours in range(23, -1, -1)]
+        bars = "▁▂▃▄▅▆▇█"
+        sparkline = "".join(bars[min(len(bars) - 1, count * (len(bars) - 1) // max(max(published), 1))] for count in published)
+        await event.edit(f"<b>Statistics for {source_id}</b>\n"
+                         f"<pre>{chr(10).join(rows)}</pre>\n"
+                         f"<b>Published per hour (24h):</b>\n<code>{sparkline}</code>",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Refresh", data=self.router.encode("source_stats", source_id))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("edit", source_id))]]
                          )
 
-    async def approve_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def sources_stats_handler(self, event):
+        overview = await self.stats.overview(7)
+        if overview:
+            rows = [f"{'source':<16}{'seen':>7}{'dup':>7}{'pub':>7}"]
+            source_names = await self.entities.get_many([source_id for source_id, _ in overview[:20]])
+            for source_id, totals in overview[:20]:
+                source_name = source_names[source_id][0][:15]
+                rows.append(f"{source_name:<16}{totals['seen'] or 0:>7}{totals['duplicate'] or 0:>7}{totals['published'] or 0:>7}")
+            stats_text = f"<pre>{html.escape(chr(10).join(rows))}</pre>"
+            if len(overview) > 20:
+                stats_text += f"\n<i>and {len(overview) - 20} more sources</i>"
+        else:
+            stats_text = "<i>No statistics collected yet</i>"
+        await event.edit(f"<b>Sources for the last 7 days</b>\n{stats_text}",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_sources"))]]
+                         )
+
+    async def backfill_handler(self, event, source_id):
+        _, offset_id, remaining, until, processed = await self.db_manager.get_backfill(source_id)
+        if offset_id is None:
+            status_text = "not started"
+        elif self.backfiller.is_running(source_id) or not self.collects:
+            status_text = f"running ({processed} messages processed)"
+        else:
+            status_text = f"paused ({processed} messages processed)"
+        buttons = [[Button.inline("Last 100 posts", data=self.router.encode("backfill_start", source_id, "m", 100)),
+                    Button.inline("Last 1000 posts", data=self.router.encode("backfill_start", source_id, "m", 1000))],
+                   [Button.inline("Last day", data=self.router.encode("backfill_start", source_id, "d", 1)),
+                    Button.inline("Last 7 days", data=self.router.encode("backfill_start", source_id, "d", 7))]]
+        if offset_id is not None:
+            buttons.append([Button.inline("Stop backfill", data=self.router.encode("backfill_stop", source_id))])
+        await event.edit(f"<b>Backfill for {source_id}:</b> <i>{status_text}</i>\n"
+                         f"Choose how much of the source history to process",
+                         parse_mode="html",
+                         buttons=buttons+[[Button.inline("Back ⬅️", data=self.router.encode("edit", source_id))]]
+                         )
+
+    async def start_backfill_handler(self, event, source_id, unit, amount):
+        if source_id not in self.sources:
+            await event.answer("Source is not active.")
+            return
+        if unit == "m":
+            await self.backfiller.start(source_id, messages=amount)
+            backfill_text = f"last {amount} posts"
+        else:
+            await self.backfiller.start(source_id, days=amount)
+            backfill_text = f"last {amount} days"
+        await event.edit(f"Backfill of {backfill_text} for {source_id} started",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("backfill", source_id))]]
+                         )
+
+    async def stop_backfill_handler(self, event, source_id):
+        await self.backfiller.cancel(source_id)
+        await event.edit(f"Backfill for {source_id} stopped",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("backfill", source_id))]]
+                         )
+
+    async def delete_confirmation_messages(self, confirmation_posts):
+        messages_by_admin = {}
+        for post in confirmation_posts:
+            messages_by_admin.setdefault(post[1], []).append(post[2])
+        for admin_id, message_ids in messages_by_admin.items():
+            await self.bot.delete_messages(admin_id, message_ids)
+            logger.info("Deleted %s confirmation messages from %s chat", len(message_ids), admin_id)
+
+    async def approve_handler(self, event, source_id, message_id):
+        post_id = f"{source_id}_{message_id}"
+        confirmation_posts = await self.db_manager.resolve_confirmation_posts([post_id])
+        if not confirmation_posts:
+            await event.answer("Post was already processed.")
             return
-        data = event.data.decode("utf-8").split("_")
-        post_id = data[1] + "_" + data[2]
-        source_id = int(data[1])
-        message_id = int(data[2])
-        logger.info(f"Approving post {message_id} from {source_id}")
-        await self.schedule_media(source_id, message_id, True)
-        confirmation_posts = await self.db_manager.get_confirmation_posts(post_id)
-        if confirmation_posts:
-            for post in confirmation_posts:
-                await self.bot.delete_messages(post[1], post[2])
-                logger.info(f"Deleted confirmation message from {post[1]} chat")
-        await self.db_manager.delete_confirmation_posts(post_id)
+        tracer.close_span((source_id, message_id), "approval_wait")
+        self.stats.inc(source_id, "approved")
+        logger.info("Approving post %s from %s", message_id, source_id, extra=log_context(source_id, message_id))
+        await self.publish(source_id, message_id, True)
+        await self.delete_confirmation_messages(confirmation_posts)
         logger.info("Deleted confirmation posts from db")
 
-    async def instant_approve_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def instant_approve_handler(self, event, source_id, message_id):
+        post_id = f"{source_id}_{message_id}"
+        confirmation_posts = await self.db_manager.resolve_confirmation_posts([post_id])
+        if not confirmation_posts:
+            await event.answer("Post was already processed.")
             return
-        data = event.data.decode("utf-8").split("_")
-        post_id = data[2] + "_" + data[3]
-        source_id = int(data[2])
-        message_id = int(data[3])
-        logger.info(f"Instantly approving post {message_id} from {source_id}")
-        await self.schedule_media(source_id, message_id, False)
-        confirmation_posts = await self.db_manager.get_confirmation_posts(post_id)
-        if confirmation_posts:
-            for post in confirmation_posts:
-                await self.bot.delete_messages(post[1], post[2])
-                logger.info(f"Deleted confirmation message from {post[1]} chat")
-        await self.db_manager.delete_confirmation_posts(post_id)
+        tracer.close_span((source_id, message_id), "approval_wait")
+        self.stats.inc(source_id, "approved")
+        logger.info("Instantly approving post %s from %s", message_id, source_id, extra=log_context(source_id, message_id))
+        await self.publish(source_id, message_id, False)
+        await self.delete_confirmation_messages(confirmation_posts)
         logger.info("Deleted confirmation posts from db")
 
-    async def reject_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def reject_handler(self, event, source_id, message_id):
+        post_id = f"{source_id}_{message_id}"
+        confirmation_posts = await self.db_manager.resolve_confirmation_posts([post_id])
+        if not confirmation_posts:
+            await event.answer("Post was already processed.")
             return
-        data = event.data.decode("utf-8").split("_")
-        post_id = data[1] + "_" + data[2]
-        source_id = int(data[1])
-        message_id = int(data[2])
-        logger.info(f"Rejecting post {message_id} from {source_id}")
-        confirmation_posts = await self.db_manager.get_confirmation_posts(post_id)
-        if confirmation_posts:
-            for post in confirmation_posts:
-                await self.bot.delete_messages(post[1], post[2])
-                logger.info(f"Deleted confirmation message from {post[1]} chat")
-        await self.db_manager.delete_confirmation_posts(post_id)
+        tracer.close_span((source_id, message_id), "approval_wait")
+        self.stats.inc(source_id, "rejected")
+        logger.info("Rejecting post %s from %s", message_id, source_id, extra=log_context(source_id, message_id))
+        await self.db_manager.delete_album(source_id, message_id)
+        await self.delete_confirmation_messages(confirmation_posts)
         logger.info("Deleted confirmation posts from db")
 
-    async def manage_admins_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def digest_approve_handler(self, event, digest_id):
+        confirmation_posts = await self.db_manager.resolve_digest(digest_id)
+        post_ids = list(dict.fromkeys(post[0] for post in confirmation_posts if not post[0].startswith("digest_")))
+        if not post_ids:
+            await event.answer("Digest was already processed.")
+            await self.delete_confirmation_messages(confirmation_posts)
             return
+        logger.info("Approving %s posts from digest %s", len(post_ids), digest_id)
+        for post_id in post_ids:
+            source_id, message_id = map(int, post_id.split("_"))
+            tracer.close_span((source_id, message_id), "approval_wait")
+            self.stats.inc(source_id, "approved")
+            await self.publish(source_id, message_id, True)
+        await self.delete_confirmation_messages(confirmation_posts)
+
+    async def digest_reject_handler(self, event, digest_id):
+        confirmation_posts = await self.db_manager.resolve_digest(digest_id)
+        post_ids = list(dict.fromkeys(post[0] for post in confirmation_posts if not post[0].startswith("digest_")))
+        if not post_ids:
+            await event.answer("Digest was already processed.")
+            await self.delete_confirmation_messages(confirmation_posts)
+            return
+        logger.info("Rejecting %s posts from digest %s", len(post_ids), digest_id)
+        for post_id in post_ids:
+            source_id, message_id = map(int, post_id.split("_"))
+            tracer.close_span((source_id, message_id), "approval_wait")
+            self.stats.inc(source_id, "rejected")
+            await self.db_manager.delete_album(source_id, message_id)
+        await self.delete_confirmation_messages(confirmation_posts)
+
+    async def manage_admins_handler(self, event):
         await self.db_manager.update_user_state(event.query.user_id, "idle")
         await event.edit("Managing admins",
-                         buttons=[[Button.inline("List admins", data="list_admins_1")],
-                                  [Button.inline("Add admin", data="add_admin")],
-                                  [Button.inline("Main Menu", data="main")]]
+                         buttons=[[Button.inline("List admins", data=self.router.encode("list_admins", 1))],
+                                  [Button.inline("Add admin", data=self.router.encode("add_admin"))],
+                                  [Button.inline("Main Menu", data=self.router.encode("main"))]]
                          )
 
-    async def list_admins_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def list_admins_handler(self, event, admins_page_number, after_id=None, before_id=None):
+        if admins_page_number < 1:
             return
-        sources_page_number = int(event.data.decode("utf-8").split("_")[2])
-        if sources_page_number < 1:
-            return
-        admins = await self.db_manager.get_admins()
-        if admins:
-            basic_buttons = [[Button.inline("Prev", data=f"list_admins_{sources_page_number-1}"),
-                              Button.inline("Back ⬅️", data="manage_admins"),
-                              Button.inline("Next", data=f"list_admins_{sources_page_number+1}")]]
-            admins_on_page = admins[5*(sources_page_number-1):5*sources_page_number]
+        admins_amount = await self.db_manager.count_admins()
+        if admins_amount:
+            admins_on_page = await self.db_manager.get_admins_page(after_id, before_id, 5)
             if admins_on_page:
-                admins_buttons = []
-                for admin in admins:
-                    admin_object = await self.bot.get_entity(admin[0])
-                    admin_name = f"{admin_object.first_name} {admin_object.last_name if admin_object.last_name else ''}"
-
-                    admins_buttons.append([Button.inline(admin_name, data=f"edit_admin_{admin[0]}")])
-                await event.edit("Here is the list of bot admins.\nClick one of the buttons below to edit admins' properties.",
+                basic_buttons = [[Button.inline("Prev", data=self.router.encode("list_admins", admins_page_number-1, None, admins_on_page[0][0])),
+                                  Button.inline("Back ⬅️", data=self.router.encode("manage_admins")),
+                                  Button.inline("Next", data=self.router.encode("list_admins", admins_page_number+1, admins_on_page[-1][0]))]]
+                admin_names = await self.entities.get_many([admin[0] for admin in admins_on_page])
+                admins_buttons = [[Button.inline(admin_names[admin[0]][0], data=self.router.encode("edit_admin", admin[0]))]
+                                  for admin in admins_on_page]
+                await event.edit(f"Here is the list of bot admins (page {admins_page_number} of {-(-admins_amount // 5)}).\n"
+                                 f"Click one of the buttons below to edit admins' properties.",
                                  buttons=admins_buttons+basic_buttons)
             else:
                 await event.answer("No admins to show.")
         else:
             await event.edit("No admins have been added yet.",
-                             buttons=[[Button.inline("Back ⬅️", data="manage_admins")]])
+                             buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_admins"))]])
 
     async def add_admin_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            message_text = "You're not allowed to add admins"
-        else:
-            message_text = "Send new admin link/username/id"
-            await self.db_manager.update_user_state(event.query.user_id, "adding_admin")
-        await event.edit(message_text,
-                         buttons=[[Button.inline("Back ⬅️", data="manage_admins")]])
+        await self.db_manager.update_user_state(event.query.user_id, "adding_admin")
+        await event.edit("Send new admin link/username/id",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_admins"))]])
 
-    async def new_admin_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        data = event.data.decode("utf-8").split("_")
-        admin_id = int(data[2])
-        super_admin = int(data[3])
+    async def new_admin_handler(self, event, admin_id, super_admin):
         await self.db_manager.add_admin(admin_id, None, None, 0, super_admin)
         self.admins.append(admin_id)
         await event.edit(f"Admin {admin_id} successfully added.",
-                         buttons=[[Button.inline("Back", data="manage_admins")]]
+                         buttons=[[Button.inline("Back", data=self.router.encode("manage_admins"))]]
                          )
 
-    async def edit_admin_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit admins",
-                             buttons=[[Button.inline("Back ⬅️", data="list_admins_1")]]
-                             )
+    async def edit_admin_handler(self, event, admin_id):
+        admin_id, _, _, admin_subscription, super_admin = await self.db_manager.get_admin(admin_id)
+        if admin_subscription == 1:
+            subscription_button = Button.inline("Disable subscription", data=self.router.encode("sub", admin_id, 0))
         else:
-            admin_id = int(event.data.decode("utf-8").split("_")[2])
-            admin_id, _, _, admin_subscription, super_admin = await self.db_manager.get_admin(admin_id)
-            if admin_subscription == 1:
-                subscription_button = Button.inline("Disable subscription", data=f"sub_{admin_id}_0")
-            else:
-                subscription_button = Button.inline("Enable subscription", data=f"sub_{admin_id}_1")
+            subscription_button = Button.inline("Enable subscription", data=self.router.encode("sub", admin_id, 1))
 
-            if super_admin == 1:
-                superadmin_button = Button.inline("Make user a regular admin", data=f"super_{admin_id}_0")
-            else:
-                superadmin_button = Button.inline("Make user a superadmin", data=f"super_{admin_id}_1")
+        if super_admin == 1:
+            superadmin_button = Button.inline("Make user a regular admin", data=self.router.encode("super", admin_id, 0))
+        else:
+            superadmin_button = Button.inline("Make user a superadmin", data=self.router.encode("super", admin_id, 1))
 
-            admin_object = await self.bot.get_entity(admin_id)
-            admin_name = f"{admin_object.first_name} {admin_object.last_name if admin_object.last_name else ''}"
-            if admin_object.username:
-                admin_link_text = f"<a href=https://t.me/{admin_object.username}>{admin_name}</a>"
-            else:
-                admin_link_text = admin_name
-            await event.edit(f"<b>Admin:</b> <i>{admin_link_text}</i>\n"
-                             f"<b>Subscribed:</b> <i>{'True' if admin_subscription else 'False'}</i>\n"
-                             f"<b>Superadmin:</b> <i>{'True' if super_admin else 'False'}</i>",
-                             parse_mode="html",
-                             buttons=[[subscription_button],
-                                      [superadmin_button],
-                                      [Button.inline("Delete admin", data=f"delete_admin_{admin_id}")],
-                                      [Button.inline("Back ⬅️", data="list_admins_1")]]
-                             )
+        admin_name, admin_username = await self.entities.get(admin_id)
+        if admin_username:
+            admin_link_text = f"<a href=https://t.me/{admin_username}>{admin_name}</a>"
+        else:
+            admin_link_text = admin_name
+        await event.edit(f"<b>Admin:</b> <i>{admin_link_text}</i>\n"
+                         f"<b>Subscribed:</b> <i>{'True' if admin_subscription else 'False'}</i>\n"
+                         f"<b>Superadmin:</b> <i>{'True' if super_admin else 'False'}</i>",
+                         parse_mode="html",
+                         buttons=[[subscription_button],
+                                  [superadmin_button],
+                                  [Button.inline("Delete admin", data=self.router.encode("delete_admin", admin_id))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("list_admins", 1))]]
+                         )
 
-    async def edit_subscription_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        data = event.data.decode("utf-8").split("_")
-        admin_id = int(data[1])
-        subscription = int(data[2])
+    async def edit_subscription_handler(self, event, admin_id, subscription):
         await self.db_manager.update_subscription(admin_id, subscription)
         await event.edit(f"Subscription status was successfully updated to <i>{'True' if subscription else 'False'}</i>",
                          parse_mode="html",
-                         buttons=[[Button.inline("Back ⬅️", data=f"edit_admin_{admin_id}")]]
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit_admin", admin_id))]]
                          )
 
-    async def edit_superadmin_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        data = event.data.decode("utf-8").split("_")
-        admin_id = int(data[1])
-        super_admin_state = int(data[2])
+    async def edit_superadmin_handler(self, event, admin_id, super_admin_state):
         _, _, _, _, super_admin = await self.db_manager.get_admin(admin_id)
         admins = await self.db_manager.get_admins()
         superadmins_amount = 0
@@ -742,20 +1060,16 @@ class MediaProcessor:
         if super_admin and superadmins_amount == 1 and not super_admin_state:
             await event.edit(
                 f"You cant remove super admin status from last superadmin or the bot will be broken.",
-                buttons=[[Button.inline("Back ⬅️", data=f"edit_admin_{admin_id}")]]
+                buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit_admin", admin_id))]]
                 )
         else:
             await self.db_manager.update_super_admin(admin_id, super_admin_state)
             await event.edit(f"Super admin status was successfully updated to <i>{'True' if super_admin_state else 'False'}</i>",
                              parse_mode="html",
-                             buttons=[[Button.inline("Back ⬅️", data=f"edit_admin_{admin_id}")]]
+                             buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit_admin", admin_id))]]
                              )
 
-    async def delete_admin_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        admin_id = int(event.data.decode("utf-8").split("_")[2])
+    async def delete_admin_handler(self, event, admin_id):
         _, _, _, _, super_admin = await self.db_manager.get_admin(admin_id)
         admins = await self.db_manager.get_admins()
         superadmins_amount = 0
@@ -766,231 +1080,352 @@ class MediaProcessor:
             await event.edit(
                 f"You cant delete last super admin or the bot will be broken.",
                 parse_mode="html",
-                buttons=[[Button.inline("Back ⬅️", data=f"edit_admin_{admin_id}")]]
+                buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit_admin", admin_id))]]
                 )
         else:
             await self.db_manager.delete_admin(admin_id)
+            await self.entities.delete(admin_id)
             await event.edit(
                 f"Admin <i>{admin_id}</i> was successfully deleted",
                 parse_mode="html",
-                buttons=[[Button.inline("Back ⬅️", data=f"manage_admins")]]
+                buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_admins"))]]
                 )
             self.admins.remove(admin_id)
 
     async def additional_settings_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit additional_settings",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
-        # await self.db_manager.update_user_state(event.query.user_id, "idle")
-        else:
-            await event.edit("Additional settings",
-                             buttons=[[Button.inline("Watermark", data="watermark")],
-                                      [Button.inline("Caption", data="caption")],
-                                      [Button.inline("Delays", data="delays")],
-                                      [Button.inline("Media types", data="media_types")],
-                                      [Button.inline("Main Menu", data="main")]]
-                             )
+        await event.edit("Additional settings",
+                         buttons=[[Button.inline("Watermark", data=self.router.encode("watermark"))],
+                                  [Button.inline("Caption", data=self.router.encode("caption"))],
+                                  [Button.inline("Delays", data=self.router.encode("delays"))],
+                                  [Button.inline("Media types", data=self.router.encode("media_types"))],
+                                  [Button.inline("Admission rules", data=self.router.encode("admission"))],
+                                  [Button.inline("Approval mode", data=self.router.encode("approval_mode"))],
+                                  [Button.inline("Storage", data=self.router.encode("storage"))],
+                                  [Button.inline("Diagnostics", data=self.router.encode("diagnostics"))],
+                                  [Button.inline("Reload settings", data=self.router.encode("reload_settings"))],
+                                  [Button.inline("Main Menu", data=self.router.encode("main"))]]
+                         )
 
     async def watermark_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit watermark",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
+        if self.settings.current.watermark_path:
+            message_text = "Watermark state: <i>enabled</i>"
+            manage_button = [[Button.inline("Disable watermark", data=self.router.encode("disable_watermark"))]]
         else:
-            _, watermark_path = await self.db_manager.get_setting("watermark")
-            if watermark_path:
-                message_text = "Watermark state: <i>enabled</i>"
-                manage_button = [[Button.inline("Disable watermark", data="disable_watermark")]]
-            else:
-                message_text = "Watermark state: <i>disabled</i>"
-                manage_button = [[Button.inline("Add watermark", data="add_watermark")]]
-            await event.edit(message_text,
-                             parse_mode="html",
-                             buttons=manage_button+[[Button.inline("Back ⬅️", data="additional_settings")]]
-                             )
+            message_text = "Watermark state: <i>disabled</i>"
+            manage_button = [[Button.inline("Add watermark", data=self.router.encode("add_watermark"))]]
+        await event.edit(message_text,
+                         parse_mode="html",
+                         buttons=manage_button+[[Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
 
     async def add_watermark_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to add watermark",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
-        else:
-            await self.db_manager.update_user_state(event.query.user_id, "adding_watermark")
-            await event.edit("Send a watermark as a file. Use .png format with transparency for best result",
-                             buttons=[[Button.inline("Back ⬅️", data="watermark")]]
-                             )
+        await self.db_manager.update_user_state(event.query.user_id, "adding_watermark")
+        await event.edit("Send a watermark as a file. Use .png format with transparency for best result",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("watermark"))]]
+                         )
 
     async def disable_watermark_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to disable watermark",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
-        else:
-            await self.db_manager.update_setting("watermark", "")
-            self.watermark = None
-            await event.edit("Watermark was disabled",
-                             buttons=[[Button.inline("Back ⬅️", data="watermark")]]
-                             )
+        await self.settings.update(watermark_path="")
+        await event.edit("Watermark was disabled",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("watermark"))]]
+                         )
 
     async def caption_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit caption",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
+        caption = self.settings.current.caption
+        if caption:
+            message_text = f"Caption state: <i>enabled</i>\n\"{caption}\""
+            manage_button = [[Button.inline("Disable caption", data=self.router.encode("disable_caption"))]]
         else:
-            _, caption = await self.db_manager.get_setting("caption")
-            if caption:
-                message_text = f"Caption state: <i>enabled</i>\n\"{caption}\""
-                manage_button = [[Button.inline("Disable caption", data="disable_caption")]]
-            else:
-                message_text = "Caption state: <i>disabled</i>"
-                manage_button = [[Button.inline("Add caption", data="add_caption")]]
-            await event.edit(message_text,
-                             parse_mode="html",
-                             buttons=manage_button+[[Button.inline("Back ⬅️", data="additional_settings")]]
-                             )
+            message_text = "Caption state: <i>disabled</i>"
+            manage_button = [[Button.inline("Add caption", data=self.router.encode("add_caption"))]]
+        await event.edit(message_text,
+                         parse_mode="html",
+                         buttons=manage_button+[[Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
 
     async def add_caption_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to add caption",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
-        else:
-            await self.db_manager.update_user_state(event.query.user_id, "adding_caption")
-            await event.edit("Send caption for posts. You can use Telegram text formatting.",
-                             buttons=[[Button.inline("Back ⬅️", data="caption")]]
-                             )
+        await self.db_manager.update_user_state(event.query.user_id, "adding_caption")
+        await event.edit("Send caption for posts. You can use Telegram text formatting.",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("caption"))]]
+                         )
 
     async def disable_caption_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to disable caption",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
-        else:
-            await self.db_manager.update_setting("caption", "")
-            self.caption = ""
-            await event.edit("Caption was disabled",
-                             buttons=[[Button.inline("Back ⬅️", data="caption")]]
-                             )
+        await self.settings.update(caption="")
+        await event.edit("Caption was disabled",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("caption"))]]
+                         )
 
     async def delay_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit delays",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
+        bottom_delay = self.settings.current.bottom_delay
+        top_delay = self.settings.current.top_delay
+        await event.edit(f"Bottom delay: <i>{bottom_delay} mins (~{bottom_delay // 60} hrs)</i>\n"
+                         f"Top delay: <i>{top_delay} mins (~{top_delay // 60} hrs)</i>",
+                         parse_mode="html",
+                         buttons=[[Button.inline("New bottom delay", data=self.router.encode("edit_delay", "bottom"))],
+                                  [Button.inline("New top delay", data=self.router.encode("edit_delay", "top"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
+
+    async def edit_delay_handler(self, event, delay_type):
+        if delay_type == "bottom":
+            await self.db_manager.update_user_state(event.query.user_id, "adding_bottom_delay")
+            await event.edit("Send new bottom delay (in minutes)",
+                             buttons=[[Button.inline("Back ⬅️", data=self.router.encode("delays"))]]
                              )
-        else:
-            _, bottom_delay = await self.db_manager.get_setting("bottom_delay")
-            bottom_delay = int(bottom_delay)
-            _, top_delay = await self.db_manager.get_setting("top_delay")
-            top_delay = int(top_delay)
-            await event.edit(f"Bottom delay: <i>{bottom_delay} mins (~{bottom_delay // 60} hrs)</i>\n"
-                             f"Top delay: <i>{top_delay} mins (~{top_delay // 60} hrs)</i>",
-                             parse_mode="html",
-                             buttons=[[Button.inline("New bottom delay", data="bottom_delay")],
-                                      [Button.inline("New top delay", data="top_delay")],
-                                      [Button.inline("Back ⬅️", data="additional_settings")]]
+        elif delay_type == "top":
+            await self.db_manager.update_user_state(event.query.user_id, "adding_top_delay")
+            await event.edit("Send new top delay (in minutes)",
+                             buttons=[[Button.inline("Back ⬅️", data=self.router.encode("delays"))]]
                              )
 
-    async def edit_delay_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
-            return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit delays",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
+    async def media_type_handler(self, event):
+        media_type = self.settings.current.media_types
+        if media_type == "pic":
+            service_buttons = [[Button.inline("vid", data=self.router.encode("update_media", "vid"))],
+                               [Button.inline("pic+vid", data=self.router.encode("update_media", "pic+vid"))]]
+            media_type_text = "pic (Processing pictures only)"
+        elif media_type == "vid":
+            service_buttons = [[Button.inline("pic", data=self.router.encode("update_media", "pic"))],
+                               [Button.inline("pic+vid", data=self.router.encode("update_media", "pic+vid"))]]
+            media_type_text = "vid (Processing videos only)"
+        elif media_type == "pic+vid":
+            service_buttons = [[Button.inline("pic", data=self.router.encode("update_media", "pic"))],
+                               [Button.inline("vid", data=self.router.encode("update_media", "vid"))]]
+            media_type_text = "pic+vid (Processing pictures and videos)"
+
+        await event.edit(f"Type of processed media:\n{media_type_text}.\nPress one of the buttons below to change it",
+                         parse_mode="html",
+                         buttons=service_buttons+[[Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
+
+    async def edit_media_type_handler(self, event, media_type):
+        await self.settings.update(media_types=media_type)
+        await event.edit(f"Processed media type updated ({media_type})",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("media_types"))]]
+                         )
+
+    async def admission_handler(self, event):
+        admission = self.settings.current.admission
+        rules_text = html.escape(format_rules(admission.rules))
+        if admission.source_rules:
+            source_names = await self.entities.get_many(list(admission.source_rules))
+            rules_text += "\n" + "\n".join(
+                f"{html.escape(source_names[source_id][0])}: {html.escape(format_rules(source_rules))}"
+                for source_id, source_rules in admission.source_rules.items())
+        if self.collects:
+            rejected = sorted(((key[0], count) for key, count in ADMISSION_REJECTED.values.items()),
+                              key=lambda item: -item[1])
+            rejected_text = "\n".join(f"{rule}: {count}" for rule, count in rejected) or "none"
         else:
-            delay_type = event.data.decode("utf-8").split("_")[0]
-            if delay_type == "bottom":
-                await self.db_manager.update_user_state(event.query.user_id, "adding_bottom_delay")
-                await event.edit("Send new bottom delay (in minutes)",
-                                 buttons=[[Button.inline("Back ⬅️", data="delays")]]
-                                 )
-            elif delay_type == "top":
-                await self.db_manager.update_user_state(event.query.user_id, "adding_top_delay")
-                await event.edit("Send new top delay (in minutes)",
-                                 buttons=[[Button.inline("Back ⬅️", data="delays")]]
-                                 )\
+            rejected_text = "counted by the collector process, see destructg_admission_rejected_total"
+        await event.edit(f"Admission rules are checked before a post is downloaded\n"
+                         f"<b>Rules:</b>\n<i>{rules_text}</i>\n"
+                         f"<b>Rejected since start:</b>\n<i>{rejected_text}</i>",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Edit rules", data=self.router.encode("admission_edit"))],
+                                  [Button.inline("Clear rules", data=self.router.encode("admission_clear"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
 
-    async def media_type_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def edit_admission_handler(self, event):
+        await self.db_manager.update_user_state(event.query.user_id, "adding_admission_rules")
+        await event.edit("Send admission rules as JSON, for example:\n"
+                         "<code>{\"max_size_mb\": 50, \"min_width\": 320, "
+                         "\"sources\": {\"-100123\": {\"max_duration\": 60}}}</code>\n"
+                         f"Rules: <i>{', '.join(ADMISSION_RULES)}</i>\n"
+                         "Source rules replace global rules with the same name, null turns a global rule off.",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("admission"))]]
+                         )
+
+    async def clear_admission_handler(self, event):
+        await self.settings.update(admission_rules="")
+        await event.edit("Admission rules were cleared",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("admission"))]]
+                         )
+
+    async def approval_mode_handler(self, event):
+        settings = self.settings.current
+        if settings.approval_mode == "digest":
+            mode_text = f"digest (every {settings.digest_interval} mins)"
+            mode_button = Button.inline("Send posts one by one", data=self.router.encode("approval_set", "single"))
+        else:
+            mode_text = "single (every post is sent separately)"
+            mode_button = Button.inline("Send posts in digests", data=self.router.encode("approval_set", "digest"))
+        await event.edit(f"Approval mode: <i>{mode_text}</i>",
+                         parse_mode="html",
+                         buttons=[[mode_button],
+                                  [Button.inline("Digest interval", data=self.router.encode("digest_interval"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
+
+    async def edit_approval_mode_handler(self, event, approval_mode):
+        await self.settings.update(approval_mode=approval_mode)
+        await event.edit(f"Approval mode updated ({approval_mode})",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("approval_mode"))]]
+                         )
+
+    async def digest_interval_handler(self, event):
+        await self.db_manager.update_user_state(event.query.user_id, "adding_digest_interval")
+        await event.edit("Send new digest interval (in minutes)",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("approval_mode"))]]
+                         )
+
+    async def diagnostics_handler(self, event):
+        await event.edit(f"Diagnostics\n"
+                         f"<b>Tracing:</b> <i>{'enabled' if tracer.enabled else 'disabled'} "
+                         f"({len(tracer.traces)} traces collected)</i>",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Export traces (Chrome)", data=self.router.encode("export_traces", "chrome"))],
+                                  [Button.inline("Export traces (JSONL)", data=self.router.encode("export_traces", "jsonl"))],
+                                  [Button.inline("Event loop lag", data=self.router.encode("loop_lag"))],
+                                  [Button.inline("Memory", data=self.router.encode("memory"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
+
+    async def loop_lag_handler(self, event):
+        watchdog = self.watchdog
+        summary = watchdog.summary()
+        if summary:
+            lag_text = (f"<b>Lag (last {watchdog.window // 60} mins):</b> <i>p50 {summary['p50'] * 1000:.1f} ms, "
+                        f"p99 {summary['p99'] * 1000:.1f} ms, max {summary['max'] * 1000:.1f} ms</i>")
+        else:
+            lag_text = "<b>Lag:</b> <i>no samples yet</i>"
+        stalls = list(watchdog.stalls)[-5:]
+        if stalls:
+            stalls_text = "\n".join(f"{stall.started:%d.%m %H:%M:%S} <b>{stall.duration:.2f}s</b> "
+                                    f"{html.escape(stall.task)}\n<code>{html.escape(stall.location)}</code>"
+                                    for stall in reversed(stalls))
+        else:
+            stalls_text = "<i>No stalls</i>"
+        await event.edit(f"<b>Event loop</b>\n"
+                         f"{lag_text}\n"
+                         f"<b>Stalls over {watchdog.threshold * 1000:.0f} ms:</b> <i>{watchdog.stalls_total}</i>\n"
+                         f"{stalls_text}",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Refresh", data=self.router.encode("loop_lag"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("diagnostics"))]]
+                         )
+
+    def memory_structures(self):
+        return [("album buffer", len(self.album_buffer), self.album_buffer.albums),
+                ("messages in flight", len(self.messages_in_flight), self.messages_in_flight),
+                ("db write queue", len(self.db_manager.writes), self.db_manager.writes),
+                ("stats buffer", len(self.stats.pending), self.stats.pending),
+                ("traces", len(tracer.traces), tracer.traces),
+                ("open spans", len(tracer.open_spans), tracer.open_spans),
+                ("source marks", len(self.source_marks), self.source_marks),
+                ("loop lag window", len(self.watchdog.recent), self.watchdog.recent),
+                ("callback routes", len(self.router.routes), self.router.trie),
+                ("watermark", 1 if self.settings.current.watermark else 0, self.settings.current.watermark)]
+
+    async def memory_handler(self, event):
+        profiler = self.memory_profiler
+        clients = [id(client) for client in self.pool.clients.values()] + [id(self.bot), id(self)]
+        rows = [f"{name:<20}{count:>7}{format_size(deep_size(structure, exclude=clients)):>11}"
+                for name, count, structure in self.memory_structures()]
+        rss = rss_bytes()
+        message_text = (f"<b>RSS:</b> <i>{format_size(rss) if rss is not None else 'unknown'}</i>\n"
+                        f"<pre>{html.escape(chr(10).join(rows))}</pre>\n")
+        if profiler.active:
+            current, peak = profiler.traced()
+            top = profiler.diff()
+            top_text = "\n".join(f"{size_diff / 1024:+.1f} KB ({format_size(size)}, {count_diff:+} blocks) {location}"
+                                 for location, size_diff, size, count_diff in top)
+            message_text += (f"<b>Profiling since</b> <i>{profiler.started:%d.%m %H:%M:%S}</i>, "
+                             f"traced <i>{format_size(current)}</i> (peak <i>{format_size(peak)}</i>)\n"
+                             f"<b>Top allocation sites since start:</b>\n<pre>{html.escape(top_text)}</pre>")
+            toggle_button = Button.inline("Stop profiling", data=self.router.encode("memory_stop"))
+        else:
+            message_text += "<b>Profiling:</b> <i>disabled</i>"
+            toggle_button = Button.inline("Start profiling", data=self.router.encode("memory_start"))
+        await event.edit(message_text,
+                         parse_mode="html",
+                         buttons=[[toggle_button],
+                                  [Button.inline("Refresh", data=self.router.encode("memory"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("diagnostics"))]]
+                         )
+
+    async def memory_start_handler(self, event):
+        self.memory_profiler.start()
+        await self.memory_handler(event)
+
+    async def memory_stop_handler(self, event):
+        self.memory_profiler.stop()
+        await self.memory_handler(event)
+
+    async def export_traces_handler(self, event, trace_format):
+        if not tracer.traces:
+            await event.answer("No traces collected. Enable tracing in config.json.")
             return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit media types",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
+        with tempfile.TemporaryDirectory() as directory:
+            path = tracer.export(directory, trace_format)
+            await self.bot.send_file(event.query.user_id, file=path, force_document=True)
+        await event.answer()
+
+    async def storage_handler(self, event):
+        table_sizes = await self.db_manager.get_table_sizes()
+        if self.db_manager.path_to_db is None:
+            db_size = "in memory"
         else:
-            _, media_type = await self.db_manager.get_setting("media_types")
-            if media_type == "pic":
-                service_buttons = [[Button.inline("vid", data="update_media_vid")],
-                                   [Button.inline("pic+vid", data="update_media_pic+vid")]]
-                media_type_text = "pic (Processing pictures only)"
-            elif media_type == "vid":
-                service_buttons = [[Button.inline("pic", data="update_media_pic")],
-                                   [Button.inline("pic+vid", data="update_media_pic+vid")]]
-                media_type_text = "vid (Processing videos only)"
-            elif media_type == "pic+vid":
-                service_buttons = [[Button.inline("pic", data="update_media_pic")],
-                                   [Button.inline("vid", data="update_media_vid")]]
-                media_type_text = "pic+vid (Processing pictures and videos)"
-
-            await event.edit(f"Type of processed media:\n{media_type_text}.\nPress one of the buttons below to change it",
-                             parse_mode="html",
-                             buttons=service_buttons+[[Button.inline("Back ⬅️", data="additional_settings")]]
-                             )
+            try:
+                db_size = f"{os.path.getsize(self.db_manager.path_to_db) / 1024 / 1024:.1f} MB"
+            except OSError:
+                db_size = "unknown"
+        tables_text = "\n".join(f"{table}: {size}" for table, size in table_sizes.items())
+        jobs = await self.db_manager.count_jobs()
+        jobs_text = "\n".join(f"{kind} {state}: {count}" for kind, state, count in jobs) or "none"
+        settings = self.settings.current
+        dedup_text = f"{settings.dedup_window} days" if settings.dedup_window else "forever"
+        ttl_text = f"{settings.confirmation_ttl} hours" if settings.confirmation_ttl else "forever"
+        if self.retention.running:
+            prune_text = "running"
+        elif self.retention.last_run is None:
+            prune_text = "never"
+        else:
+            prune_text = (f"{self.retention.last_run:%Y-%m-%d %H:%M}, {self.retention.last_duration:.1f}s, "
+                          f"{self.retention.last_pruned_hashes} hashes and "
+                          f"{self.retention.last_expired_confirmations} confirmations removed")
+        await event.edit(f"Storage\n"
+                         f"<b>Database size:</b> <i>{db_size}</i>\n"
+                         f"<b>Rows:</b>\n<i>{tables_text}</i>\n"
+                         f"<b>Jobs:</b>\n<i>{jobs_text}</i>\n"
+                         f"<b>Dedup window:</b> <i>{dedup_text}</i>\n"
+                         f"<b>Confirmation TTL:</b> <i>{ttl_text}</i>\n"
+                         f"<b>Last prune:</b> <i>{prune_text}</i>\n"
+                         f"<b>Removed since start:</b> <i>{self.retention.pruned_hashes} hashes, "
+                         f"{self.retention.expired_confirmations} confirmations</i>",
+                         parse_mode="html",
+                         buttons=[[Button.inline("Dedup window", data=self.router.encode("dedup_window"))],
+                                  [Button.inline("Confirmation TTL", data=self.router.encode("confirmation_ttl"))],
+                                  [Button.inline("Prune now", data=self.router.encode("prune_now"))],
+                                  [Button.inline("Back ⬅️", data=self.router.encode("additional_settings"))]]
+                         )
+
+    async def dedup_window_handler(self, event):
+        await self.db_manager.update_user_state(event.query.user_id, "adding_dedup_window")
+        await event.edit("Send new dedup window (in days, 0 to keep hashes forever)",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("storage"))]]
+                         )
+
+    async def confirmation_ttl_handler(self, event):
+        await self.db_manager.update_user_state(event.query.user_id, "adding_confirmation_ttl")
+        await event.edit("Send new confirmation TTL (in hours, 0 to keep confirmations forever)",
+                         buttons=[[Button.inline("Back ⬅️", data=self.router.encode("storage"))]]
+                         )
 
-    async def edit_media_type_handler(self, event):
-        if event.query.user_id not in self.admins:
-            await event.answer()
+    async def prune_now_handler(self, event):
+        if self.retention.running:
+            await event.answer("Pruning is already running.")
             return
-        _, _, _, _, super_admin = await self.db_manager.get_admin(event.query.user_id)
-        if super_admin == 0:
-            await event.edit("You're not allowed to edit delays",
-                             buttons=[[Button.inline("Back ⬅️", data="main")]]
-                             )
+        await event.answer("Pruning started.")
+        await self.retention.prune()
+
+    async def reload_settings_handler(self, event):
+        if await self.reload_settings():
+            await event.answer("Settings reloaded.")
         else:
-            media_type = event.data.decode("utf-8").split("_")[2]
-            await self.db_manager.update_setting("media_types", media_type)
-            self.media_types = media_type
-            await event.edit(f"Processed media type updated ({media_type})",
-                             buttons=[[Button.inline("Back ⬅️", data="media_types")]]
-                             )
+            await event.answer("Error while reloading settings, see app.log.")
 
     async def new_message_handler(self, event):
         sender = await event.get_sender()
@@ -1008,6 +1443,7 @@ class MediaProcessor:
                 pass
             try:
                 source_object = await self.bot.get_entity(source_id)
+                await self.entities.store(source_object)
                 sid, _, _, _ = await self.db_manager.get_source(source_object.id)
                 _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
                 if sid is not None:
@@ -1022,11 +1458,11 @@ class MediaProcessor:
                                             menu_message,
                                             f"Picked source: {link_text}\nSend a chance (from 1 to 100) of taking post for this channel.",
                                             parse_mode="html",
-                                            buttons=[[Button.inline("Back ⬅️", data="manage_sources")]])
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("manage_sources"))]])
                 await event.delete()
             except Exception as e:
                 await event.reply("Not a valid source.")
-                logger.error(f"Error occurred while getting source: {e}")
+                logger.error("Error occurred while getting source: %s", e)
 
         elif user_state.startswith("add_chance") or user_state.startswith("update_chance"):
             source_id = int(user_state.split("_")[2])
@@ -1037,15 +1473,15 @@ class MediaProcessor:
                     await self.bot.edit_message(sender.id,
                                                 menu_message,
                                                 f"Chance for {source_id} is {event.text}",
-                                                buttons=[[Button.inline("Add channel", data=f"add_{source_id}_{event.text}_1")],
-                                                         [Button.inline("Add channel (auto approve)", data=f"add_{source_id}_{event.text}_2")],
-                                                         [Button.inline("Back ⬅️", data="manage_sources")]])
+                                                buttons=[[Button.inline("Add channel", data=self.router.encode("new_source", source_id, event.text, 1))],
+                                                         [Button.inline("Add channel (auto approve)", data=self.router.encode("new_source", source_id, event.text, 2))],
+                                                         [Button.inline("Back ⬅️", data=self.router.encode("manage_sources"))]])
                 else:
                     await self.db_manager.update_chance(source_id, int(event.text))
                     await self.bot.edit_message(sender.id,
                                                 menu_message,
                                                 f"Chance for {source_id} was updated to {event.text}",
-                                                buttons=[[Button.inline("Back ⬅️", data=f"edit_{source_id}")]])
+                                                buttons=[[Button.inline("Back ⬅️", data=self.router.encode("edit", source_id))]])
                 await event.delete()
                 await self.db_manager.update_user_state(sender.id, "idle")
             else:
@@ -1062,6 +1498,7 @@ class MediaProcessor:
                 if not isinstance(admin_object, User):
                     await event.reply("Not a valid admin")
                     return
+                await self.entities.store(admin_object)
                 uid, _, _, _, _ = await self.db_manager.get_admin(admin_object.id)
                 _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
                 if uid is not None:
@@ -1076,17 +1513,17 @@ class MediaProcessor:
                                             f"Picked admin: {link_text}\nChoose an option below:",
                                             parse_mode="html",
                                             buttons=[[Button.inline("Add as regular admin",
-                                                                    data=f"add_admin_{admin_object.id}_0")],
+                                                                    data=self.router.encode("new_admin", admin_object.id, 0))],
                                                      [Button.inline("Add as superadmin",
-                                                                    data=f"add_admin_{admin_object.id}_1")],
+                                                                    data=self.router.encode("new_admin", admin_object.id, 1))],
                                                      [Button.inline("Back ⬅️",
-                                                                    data="manage_admins")]]
+                                                                    data=self.router.encode("manage_admins"))]]
                                             )
                 await event.delete()
                 await self.db_manager.update_user_state(sender.id, "idle")
             except Exception as e:
                 await event.reply("Not a valid admin.")
-                logger.error(f"Error occurred while getting source: {e}")
+                logger.error("Error occurred while getting source: %s", e)
 
         elif user_state == "adding_watermark":
             if event.document and event.document.mime_type == "image/png":
@@ -1094,13 +1531,12 @@ class MediaProcessor:
 
                 watermark_path = os.path.join(os.getcwd(), "watermark.png")
                 await self.bot.download_media(event.media, file=watermark_path)
-                await self.db_manager.update_setting("watermark", watermark_path)
-                self.watermark = open(watermark_path, "rb")
+                await self.settings.update(watermark_path=watermark_path)
 
                 await self.bot.edit_message(sender.id,
                                             menu_message,
                                             "Watermark was updated",
-                                            buttons=[[Button.inline("Back ⬅️", data="watermark")]]
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("watermark"))]]
                                             )
                 await event.delete()
                 await self.db_manager.update_user_state(sender.id, "idle")
@@ -1112,14 +1548,13 @@ class MediaProcessor:
                 _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
 
                 caption = event.text
-                await self.db_manager.update_setting("caption", caption)
-                self.caption = caption
+                await self.settings.update(caption=caption)
 
                 await self.bot.edit_message(sender.id,
                                             menu_message,
                                             f"Caption was updated:\n{caption}",
                                             parse_mode="html",
-                                            buttons=[[Button.inline("Back ⬅️", data="caption")]]
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("caption"))]]
                                             )
                 await event.delete()
                 await self.db_manager.update_user_state(sender.id, "idle")
@@ -1136,13 +1571,12 @@ class MediaProcessor:
             if bottom_delay_value > 0:
                 _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
 
-                await self.db_manager.update_setting("bottom_delay", bottom_delay)
-                self.bottom_delay = bottom_delay_value
+                await self.settings.update(bottom_delay=bottom_delay_value)
 
                 await self.bot.edit_message(sender.id,
                                             menu_message,
                                             f"Bottom delay was updated: {bottom_delay} mins",
-                                            buttons=[[Button.inline("Back ⬅️", data="delays")]]
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("delays"))]]
                                             )
                 await event.delete()
                 await self.db_manager.update_user_state(sender.id, "idle")
@@ -1160,13 +1594,12 @@ class MediaProcessor:
             if top_delay_value > 0:
                 _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
 
-                await self.db_manager.update_setting("top_delay", top_delay)
-                self.top_delay = top_delay_value
+                await self.settings.update(top_delay=top_delay_value)
 
                 await self.bot.edit_message(sender.id,
                                             menu_message,
                                             f"Bottom delay was updated: {top_delay} mins",
-                                            buttons=[[Button.inline("Back ⬅️", data="delays")]]
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("delays"))]]
                                             )
                 await event.delete()
                 await self.db_manager.update_user_state(sender.id, "idle")
@@ -1174,62 +1607,343 @@ class MediaProcessor:
             else:
                 await event.reply("Not a correct delay.")
 
-    async def process_media(self, event):
-        sender = await event.get_sender()
-        if sender.id not in self.sources:
-            return
-        if self.media_filter(event):
-            logger.info(f"New mediafile in source {sender.id}")
-            _, source_state, source_chance, _ = await self.db_manager.get_source(sender.id)
-            if source_state == 0:
-                logger.info("Skipping mediafile due to source state (inactive)")
+        elif user_state == "adding_admission_rules":
+            try:
+                await self.settings.update(admission_rules=event.text)
+            except ValueError as e:
+                await event.reply(f"Not correct rules: {e}")
                 return
-            percent = random.randint(1, 100)
-            if percent > source_chance:
-                logger.info(f"Skipping mediafile due to random ({source_chance} < {percent})")
+            _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
+            await self.bot.edit_message(sender.id,
+                                        menu_message,
+                                        "Admission rules were updated",
+                                        buttons=[[Button.inline("Back ⬅️", data=self.router.encode("admission"))]]
+                                        )
+            await event.delete()
+            await self.db_manager.update_user_state(sender.id, "idle")
+
+        elif user_state == "adding_digest_interval":
+            digest_interval = event.text
+            try:
+                digest_interval_value = int(digest_interval)
+            except ValueError:
+                await event.reply("Not a correct interval.")
                 return
-            bio = BytesIO()
-            if event.photo:
-                bio.name = "file.png"
-            elif event.video:
-                bio.name = "file.mp4"
-
-            await self.client.download_media(event.media, file=bio)
-            bio.seek(0)
-            media_hash = md5(bio.getbuffer()).hexdigest()
-            logger.info(f"Hash of current media {media_hash}")
-            stored_media_hash, _ = await self.db_manager.get_media_hash(media_hash)
-            if stored_media_hash:
-                logger.info(f"Skipping mediafile due to duplicate {stored_media_hash}")
+            if digest_interval_value > 0:
+                _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
+
+                await self.settings.update(digest_interval=digest_interval_value)
+
+                await self.bot.edit_message(sender.id,
+                                            menu_message,
+                                            f"Digest interval was updated: {digest_interval} mins",
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("approval_mode"))]]
+                                            )
+                await event.delete()
+                await self.db_manager.update_user_state(sender.id, "idle")
+
+            else:
+                await event.reply("Not a correct interval.")
+
+        elif user_state == "adding_dedup_window" or user_state == "adding_confirmation_ttl":
+            setting_name = user_state.replace("adding_", "")
+            try:
+                setting_value = int(event.text)
+            except ValueError:
+                await event.reply("Not a correct value.")
                 return
+            if setting_value >= 0:
+                _, _, menu_message, _, _ = await self.db_manager.get_admin(sender.id)
+
+                await self.settings.update(**{setting_name: setting_value})
+
+                if setting_name == "dedup_window":
+                    update_text = f"Dedup window was updated: {setting_value} days"
+                else:
+                    update_text = f"Confirmation TTL was updated: {setting_value} hours"
+                await self.bot.edit_message(sender.id,
+                                            menu_message,
+                                            update_text,
+                                            buttons=[[Button.inline("Back ⬅️", data=self.router.encode("storage"))]]
+                                            )
+                await event.delete()
+                await self.db_manager.update_user_state(sender.id, "idle")
+
             else:
-                await self.db_manager.add_media_hash(media_hash, datetime.now())
-            if source_state == 1:
-                post_id = f"{sender.id}_{event.message.id}"
-                logger.info(f"No duplicate found, sending mediafile for approve")
-                admins = await self.db_manager.get_admins()
-                for admin in admins:
-                    if admin[3] == 1:
-                        confirmation_message = await self.bot.send_file(admin[0],
-                                                                        file=bio,
-                                                                        buttons=[[Button.inline("Approve",
-                                                                                                data=f"approve_{post_id}")],
-                                                                                 [Button.inline("Approve instantly",
-                                                                                                data=f"approve_instantly_{post_id}")],
-                                                                                 [Button.inline("Reject",
-                                                                                                data=f"reject_{post_id}")]]
-                                                                        )
-                        bio.seek(0)
-                        await self.db_manager.add_confirmation_post(post_id, admin[0], confirmation_message.id)
-            elif source_state == 2:
-                logger.info(f"No duplicate found, scheduling mediafile instantly")
-                await self.schedule_media(sender.id, event.message.id, True)
+                await event.reply("Not a correct value.")
+
+    async def process_media(self, event):
+        get_sender_start = tracer.now()
+        sender = await event.get_sender()
+        if sender.id not in self.sources:
+            return
+        tracer.add_span((sender.id, event.message.id), "get_sender", get_sender_start)
+        if not self.pool.owns(event.client, sender.id):
+            return
+        if self.recorder is not None:
+            self.recorder.record_update(self.pool.owner_name(sender.id), sender.id, event.message)
+        await self.handle_message(event.client, sender.id, event.message)
+
+    async def handle_message(self, client, source_id, message, live=True, check_mark=True):
+        if not self.accepting:
+            return
+        if check_mark and message.id <= self.source_marks.get(source_id, 0):
+            logger.info("Skipping message %s from %s, it was already processed", message.id, source_id,
+                        extra=log_context(source_id, message.id, throttled=True))
+            return
+        message_key = (source_id, message.id)
+        if message_key in self.messages_in_flight:
+            return
+        self.messages_in_flight[message_key] = asyncio.current_task()
+        if live:
+            self.live_in_flight += 1
+            self.hold_mark(source_id, message.id)
+        try:
+            await self.process_message(client, source_id, message)
+        finally:
+            self.messages_in_flight.pop(message_key, None)
+            self.claims.pop(message_key, None)
+            if live:
+                self.live_in_flight -= 1
+                await self.release_mark(source_id, message.id)
+
+    def roll_chance(self, source_id, message_id):
+        if self.random_seed is None:
+            return self.random.randint(1, 100)
+        # seeded rolls depend only on the message, so concurrent processing order does not change them
+        return random.Random(f"{self.random_seed}:{source_id}:{message_id}").randint(1, 100)
+
+    def dedup_since(self):
+        dedup_window = self.settings.current.dedup_window
+        if not dedup_window:
+            return None
+        return datetime.now() - timedelta(days=dedup_window)
+
+    def hold_mark(self, source_id, message_id):
+        holds = self.mark_holds.setdefault(source_id, {})
+        holds[message_id] = holds.get(message_id, 0) + 1
+
+    def hold_album_mark(self, source_id, message_id):
+        # an album item returns from handle_message once it is buffered, the album keeps its own hold
+        # until process_album is done, only for items whose mark is held at all
+        message_key = (source_id, message_id)
+        if message_key not in self.album_holds and message_id in self.mark_holds.get(source_id, ()):
+            self.album_holds.add(message_key)
+            self.hold_mark(source_id, message_id)
+
+    async def release_album_marks(self, source_id, message_ids):
+        for message_id in message_ids:
+            if (source_id, message_id) in self.album_holds:
+                self.album_holds.discard((source_id, message_id))
+                await self.release_mark(source_id, message_id)
+
+    async def release_mark(self, source_id, message_id):
+        if self.deferred_releases is not None:
+            self.deferred_releases.append((source_id, message_id))
+            return
+        holds = self.mark_holds.get(source_id)
+        if not holds or message_id not in holds:
+            return
+        holds[message_id] -= 1
+        if holds[message_id]:
+            return
+        del holds[message_id]
+        finished = max(self.finished_ids.get(source_id, 0), message_id)
+        self.finished_ids[source_id] = finished
+        # handlers run concurrently, a later message may finish while an earlier one is still downloading
+        if holds:
+            finished = min(finished, min(holds) - 1)
+        await self.update_source_mark(source_id, finished)
+
+    def forget_source_mark(self, source_id):
+        self.source_marks.pop(source_id, None)
+        self.mark_holds.pop(source_id, None)
+        self.finished_ids.pop(source_id, None)
+        self.album_holds = {message_key for message_key in self.album_holds if message_key[0] != source_id}
+
+    async def update_source_mark(self, source_id, message_id):
+        if message_id > self.source_marks.get(source_id, 0):
+            self.source_marks[source_id] = message_id
+            await self.db_manager.update_source_mark(source_id, message_id)
+
+    async def download_media(self, client, message):
+        with STAGE_SECONDS.time(stage="download"):
+            return await self.downloader.download(client, message)
+
+    async def send_for_approval(self, source_id, message_id, files):
+        post_id = f"{source_id}_{message_id}"
+        tracer.open_span((source_id, message_id), "approval_wait")
+        POSTS.inc(stage="sent_to_approval")
+        if self.settings.current.approval_mode == "digest":
+            await self.db_manager.add_pending_post(post_id, source_id, message_id, datetime.now())
+            logger.info("Post %s added to the next digest", post_id, extra=log_context(source_id, message_id))
+            return
+        admins = await self.db_manager.get_admins()
+        buttons = [[Button.inline("Approve", data=self.router.encode("approve", source_id, message_id))],
+                   [Button.inline("Approve instantly", data=self.router.encode("approve_instantly", source_id, message_id))],
+                   [Button.inline("Reject", data=self.router.encode("reject", source_id, message_id))]]
+        with tracer.span((source_id, message_id), "admin_fan_out"):
+            for admin in admins:
+                if admin[3] == 1:
+                    if isinstance(files, list):
+                        album_messages = await self.bot.send_file(admin[0], file=files)
+                        confirmation_message = await self.bot.send_message(admin[0],
+                                                                           f"Album of {len(files)} files",
+                                                                           buttons=buttons)
+                        for file in files:
+                            file.seek(0)
+                        for album_message in album_messages:
+                            await self.db_manager.add_confirmation_post(post_id, admin[0], album_message.id)
+                    else:
+                        confirmation_message = await self.bot.send_file(admin[0], file=files, buttons=buttons)
+                        files.seek(0)
+                    await self.db_manager.add_confirmation_post(post_id, admin[0], confirmation_message.id)
+
+    async def process_message(self, client, source_id, message):
+        POSTS.inc(stage="received")
+        if not self.media_filter(message):
+            POSTS.inc(stage="filtered")
+            return
+        # runs on the metadata that came with the update, before anything is downloaded or read from the database
+        rejected_rule = self.settings.current.admission.check(source_id, message)
+        if rejected_rule is not None:
+            POSTS.inc(stage="admission_rejected")
+            ADMISSION_REJECTED.inc(rule=rejected_rule)
+            logger.info("Skipping mediafile due to admission rule %s", rejected_rule,
+                        extra=log_context(source_id, message.id, throttled=True))
+            return
+        if message.grouped_id:
+            self.hold_album_mark(source_id, message.id)
+            self.album_buffer.add(client, source_id, message)
+            return
+        context = log_context(source_id, message.id)
+        skipped_context = log_context(source_id, message.id, throttled=True)
+        logger.info("New mediafile in source %s", source_id, extra=context)
+        self.stats.inc(source_id, "seen")
+        trace_key = (source_id, message.id)
+        self.resumed_keys.discard(trace_key)
+        with tracer.span(trace_key, "get_source"):
+            _, source_state, source_chance, _ = await self.db_manager.get_source(source_id)
+        if source_state == 0:
+            logger.info("Skipping mediafile due to source state (inactive)", extra=skipped_context)
+            return
+        percent = self.roll_chance(source_id, message.id)
+        if percent > source_chance:
+            logger.info("Skipping mediafile due to random (%s < %s)", source_chance, percent, extra=skipped_context)
+            POSTS.inc(stage="chance_skipped")
+            return
+        self.stats.inc(source_id, "chance_passed")
+        with tracer.span(trace_key, "download"):
+            bio, media_hash = await self.download_media(client, message)
+        if media_hash is None:
+            with STAGE_SECONDS.time(stage="hash"), tracer.span(trace_key, "hash"):
+                media_hash = md5(bio.getbuffer()).hexdigest()
+        logger.debug("Hash of current media %s", media_hash, extra=context)
+        if self.recorder is not None:
+            self.recorder.record_hash(source_id, message.id, media_hash)
+        with tracer.span(trace_key, "dedup"):
+            claimed = await self.claim_hash(media_hash)
+        if not claimed:
+            logger.info("Skipping mediafile due to duplicate %s", media_hash, extra=skipped_context)
+            POSTS.inc(stage="duplicate")
+            self.stats.inc(source_id, "duplicate")
+            return
+        self.claims[trace_key] = media_hash
+        if source_state == 1:
+            logger.info("No duplicate found, sending mediafile for approve", extra=context)
+            await self.request_approval(source_id, message.id, bio)
+        elif source_state == 2:
+            logger.info("No duplicate found, scheduling mediafile instantly", extra=context)
+            await self.publish(source_id, message.id, True)
+
+    async def process_album(self, client, source_id, messages):
+        message_keys = [(source_id, message.id) for message in messages]
+        for message_key in message_keys:
+            self.messages_in_flight[message_key] = asyncio.current_task()
+        try:
+            await self._process_album(client, source_id, messages)
+        finally:
+            for message_key in message_keys:
+                self.messages_in_flight.pop(message_key, None)
+                self.claims.pop(message_key, None)
+            await self.release_album_marks(source_id, [message.id for message in messages])
+
+    async def _process_album(self, client, source_id, messages):
+        context = log_context(source_id, messages[0].id)
+        skipped_context = log_context(source_id, messages[0].id, throttled=True)
+        logger.info("New album in source %s", source_id, extra=context)
+        self.stats.inc(source_id, "seen")
+        trace_key = (source_id, messages[0].id)
+        with tracer.span(trace_key, "get_source"):
+            _, source_state, source_chance, _ = await self.db_manager.get_source(source_id)
+        if not source_state:
+            logger.info("Skipping album due to source state (inactive)", extra=skipped_context)
+            return
+        percent = self.roll_chance(source_id, messages[0].id)
+        if percent > source_chance:
+            logger.info("Skipping album due to random (%s < %s)", source_chance, percent, extra=skipped_context)
+            POSTS.inc(stage="chance_skipped")
+            return
+        self.stats.inc(source_id, "chance_passed")
+        files = []
+        message_ids = []
+        media_hashes = []
+        # item hashes are claimed one by one, so two albums sharing a file can't both publish it
+        claimed_hashes = []
+        try:
+            for message in messages:
+                with tracer.span(trace_key, "download"):
+                    bio, media_hash = await self.download_media(client, message)
+                if media_hash is None:
+                    with STAGE_SECONDS.time(stage="hash"), tracer.span(trace_key, "hash"):
+                        media_hash = md5(bio.getbuffer()).hexdigest()
+                media_hashes.append(media_hash)
+                if self.recorder is not None:
+                    self.recorder.record_hash(source_id, message.id, media_hash)
+                # items of an interrupted album claimed their hashes before the shutdown
+                if (source_id, message.id) not in self.resumed_keys:
+                    with tracer.span(trace_key, "dedup"):
+                        item_claimed = await self.db_manager.claim_media_hash(media_hash, datetime.now(),
+                                                                              self.dedup_since())
+                    if not item_claimed:
+                        logger.info("Skipping album file %s due to duplicate %s", message.id, media_hash,
+                                    extra=log_context(source_id, message.id, throttled=True))
+                        continue
+                    claimed_hashes.append(media_hash)
+                files.append(bio)
+                message_ids.append(message.id)
+            album_hash = md5("".join(sorted(media_hashes)).encode("utf-8")).hexdigest()
+            logger.debug("Hash of current album %s", album_hash, extra=context)
+            claimed = False
+            with tracer.span(trace_key, "dedup"):
+                if files:
+                    claimed = await self.claim_hash(album_hash)
+        except Exception:
+            await self.release_hashes(claimed_hashes)
+            raise
+        if not claimed:
+            await self.release_hashes(claimed_hashes)
+            logger.info("Skipping album due to duplicate %s", album_hash, extra=skipped_context)
+            POSTS.inc(stage="duplicate")
+            self.stats.inc(source_id, "duplicate")
+            return
+        for message in messages:
+            self.claims[(source_id, message.id)] = album_hash
+            self.resumed_keys.discard((source_id, message.id))
+        await self.db_manager.add_album(source_id, message_ids[0], message_ids)
+        if source_state == 1:
+            logger.info("No duplicate found, sending album for approve", extra=context)
+            await self.request_approval(source_id, message_ids[0], files)
+        elif source_state == 2:
+            logger.info("No duplicate found, scheduling album instantly", extra=context)
+            await self.publish(source_id, message_ids[0], True)
 
     async def send_media_from_db(self, event):
         logger.info("Mediafile from scheduled was sent")
         source_id, message_id, _ = await self.db_manager.get_scheduled_post()
         if source_id is not None and message_id is not None:
             await self.db_manager.delete_scheduled_post(source_id, message_id)
+            await self.update_overflow_queue_size()
             await self.schedule_media(source_id, message_id, True)
         else:
             logger.info("No mediafile in db to schedule")
@@ -0,0 +1,482 @@
+import bisect
+import heapq
+import itertools
+import logging
+from datetime import datetime
+
+from metrics import DB_SECONDS, timed_methods
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def _stored(value):
+    # sqlite keeps timestamps as ISO strings and compares them as text, so this backend does the same
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def _page(rows, keys, after_id, before_id, limit):
+    if before_id is not None:
+        end = bisect.bisect_left(keys, before_id)
+        return [tuple(rows[key]) for key in keys[max(0, end - limit):end]]
+    start = 0 if after_id is None else bisect.bisect_right(keys, after_id)
+    return [tuple(rows[key]) for key in keys[start:start + limit]]
+
+
+@timed_methods(DB_SECONDS)
+class MemoryStorage(Storage):
+    # nothing survives a restart, meant for benchmarks and checks that should not wait for the disk
+    def __init__(self):
+        self.path_to_db = None
+        # writes are applied right away, the queue only exists for the memory diagnostics
+        self.writes = []
+        self.seq = itertools.count()
+        self.admins = {}
+        self.admin_ids = []
+        self.sources = {}
+        self.source_ids = []
+        self.source_stats = {}
+        self.settings = {}
+        # post id -> [(seq, row)], the heap of (TimeAdded, seq, post id) finds expired confirmations
+        self.confirmations = {}
+        self.confirmation_times = []
+        self.pending_posts = {}
+        self.pending_attempts = {}
+        self.digests = {}
+        # (TimeAdded, seq, channel id, message id), deleted posts are dropped lazily when they reach the top
+        self.scheduled = []
+        self.scheduled_keys = {}
+        # media hash -> [(seq, date)], the heap of (date, seq, media hash) finds hashes to prune
+        self.hashes = {}
+        self.hash_dates = []
+        self.hash_rows = 0
+        self.entities = {}
+        self.backfills = {}
+        self.source_marks = {}
+        self.interrupted_posts = []
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.albums = {}
+        logger.info("Using in-memory storage, nothing will be kept after a restart")
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def add_admin(self, user_id, user_state, menu_message, subscription, super_admin):
+        if user_id not in self.admins:
+            bisect.insort(self.admin_ids, user_id)
+        self.admins[user_id] = [user_id, user_state, menu_message, subscription, super_admin]
+
+    async def delete_admin(self, user_id):
+        if self.admins.pop(user_id, None) is not None:
+            self.admin_ids.remove(user_id)
+
+    async def get_admin(self, user_id):
+        admin = self.admins.get(user_id)
+        return tuple(admin) if admin is not None else (None, None, None, None, None)
+
+    async def get_admins(self):
+        return [tuple(admin) for admin in self.admins.values()]
+
+    async def get_admins_page(self, after_id=None, before_id=None, limit=5):
+        return _page(self.admins, self.admin_ids, after_id, before_id, limit)
+
+    async def count_admins(self):
+        return len(self.admins)
+
+    def _update_admin(self, user_id, column, value):
+        admin = self.admins.get(user_id)
+        if admin is not None:
+            admin[column] = value
+
+    async def update_user_state(self, user_id, user_state):
+        self._update_admin(user_id, 1, user_state)
+
+    async def update_menu_message(self, user_id, menu_message):
+        self._update_admin(user_id, 2, menu_message)
+
+    async def update_subscription(self, user_id, subscription):
+        self._update_admin(user_id, 3, subscription)
+
+    async def update_super_admin(self, user_id, super_admin):
+        self._update_admin(user_id, 4, super_admin)
+
+    async def add_source(self, channel_id, state, chance, posts_amount):
+        if channel_id not in self.sources:
+            bisect.insort(self.source_ids, channel_id)
+        self.sources[channel_id] = [channel_id, state, chance, posts_amount]
+
+    async def delete_source(self, channel_id):
+        if self.sources.pop(channel_id, None) is not None:
+            self.source_ids.remove(channel_id)
+
+    async def get_source(self, channel_id):
+        source = self.sources.get(channel_id)
+        return tuple(source) if source is not None else (None, None, None, None)
+
+    async def get_sources(self):
+        return [tuple(source) for source in self.sources.values()]
+
+    async def get_sources_page(self, after_id=None, before_id=None, limit=5):
+        return _page(self.sources, self.source_ids, after_id, before_id, limit)
+
+    async def count_sources(self):
+        return len(self.sources)
+
+    def _update_source(self, channel_id, column, value):
+        source = self.sources.get(channel_id)
+        if source is not None:
+            source[column] = value
+
+    async def update_state(self, channel_id, state):
+        self._update_source(channel_id, 1, state)
+
+    async def update_chance(self, channel_id, chance):
+        self._update_source(channel_id, 2, chance)
+
+    async def update_posts_amount(self, channel_id, posts_amount):
+        self._update_source(channel_id, 3, posts_amount)
+
+    async def increment_posts_amount(self, channel_id, amount=1):
+        source = self.sources.get(channel_id)
+        if source is not None:
+            source[3] += amount
+
+    async def add_source_stats(self, rows):
+        for channel_id, period, bucket, *counters in rows:
+            current = self.source_stats.setdefault((channel_id, period, bucket), [0] * len(counters))
+            for i, counter in enumerate(counters):
+                current[i] += counter
+
+    async def get_source_stats(self, channel_id, period, since):
+        return sorted((key[2], *counters) for key, counters in self.source_stats.items()
+                      if key[0] == channel_id and key[1] == period and key[2] >= since)
+
+    async def get_source_stats_totals(self, period, since, channel_id=None):
+        totals = {}
+        for (row_channel_id, row_period, bucket), counters in self.source_stats.items():
+            if row_period != period or bucket < since or channel_id is not None and row_channel_id != channel_id:
+                continue
+            current = totals.setdefault(row_channel_id, [0] * len(counters))
+            for i, counter in enumerate(counters):
+                current[i] += counter
+        return sorted(((key, *counters) for key, counters in totals.items()), key=lambda row: row[-1], reverse=True)
+
+    async def prune_source_stats(self, period, before, limit):
+        keys = [key for key in self.source_stats if key[1] == period and key[2] < before][:limit]
+        for key in keys:
+            del self.source_stats[key]
+        return len(keys)
+
+    async def delete_source_stats(self, channel_id):
+        for key in [key for key in self.source_stats if key[0] == channel_id]:
+            del self.source_stats[key]
+
+    async def add_setting(self, setting_name, setting_value):
+        self.settings[setting_name] = setting_value
+
+    async def update_setting(self, setting_name, setting_value):
+        self._update_setting(setting_name, setting_value)
+
+    def _update_setting(self, setting_name, setting_value):
+        if setting_name in self.settings:
+            self.settings[setting_name] = setting_value
+
+    async def get_setting(self, setting_name):
+        if setting_name not in self.settings:
+            return None, None
+        return setting_name, self.settings[setting_name]
+
+    async def get_settings(self):
+        return list(self.settings.items())
+
+    async def add_settings(self, settings):
+        self.settings.update(settings)
+
+    async def update_settings(self, settings):
+        for setting_name, setting_value in settings:
+            self._update_setting(setting_name, setting_value)
+
+    async def add_confirmation_post(self, post_id, admin_id, admin_message_id):
+        self._add_confirmation_post(post_id, admin_id, admin_message_id)
+
+    def _add_confirmation_post(self, post_id, admin_id, admin_message_id):
+        seq = next(self.seq)
+        time_added = _stored(datetime.now())
+        self.confirmations.setdefault(post_id, []).append((seq, (post_id, admin_id, admin_message_id, time_added)))
+        heapq.heappush(self.confirmation_times, (time_added, seq, post_id))
+
+    def _pop_confirmations(self, post_ids):
+        rows = []
+        for post_id in dict.fromkeys(post_ids):
+            rows.extend(row for _, row in self.confirmations.pop(post_id, ()))
+        return rows
+
+    async def delete_confirmation_posts(self, post_id):
+        self.confirmations.pop(post_id, None)
+
+    async def get_confirmation_posts(self, post_id):
+        return [row for _, row in self.confirmations.get(post_id, ())]
+
+    async def resolve_confirmation_posts(self, post_ids):
+        return self._pop_confirmations(post_ids)
+
+    async def expire_confirmation_posts(self, before, limit):
+        before = _stored(before)
+        post_ids = []
+        selected = 0
+        heap = self.confirmation_times
+        while heap and heap[0][0] < before and selected < limit:
+            _, seq, post_id = heapq.heappop(heap)
+            # entries of resolved posts are left in the heap and skipped here
+            if any(row_seq == seq for row_seq, _ in self.confirmations.get(post_id, ())):
+                post_ids.append(post_id)
+                selected += 1
+        if not post_ids:
+            return []
+        rows = self._pop_confirmations(post_ids)
+        for digest_id in [digest_id for digest_id in self.digests if f"digest_{digest_id}" not in self.confirmations]:
+            del self.digests[digest_id]
+        return rows
+
+    async def add_pending_post(self, post_id, channel_id, message_id, time_added):
+        self.pending_posts[post_id] = (post_id, channel_id, message_id, _stored(time_added))
+
+    async def delete_pending_posts(self, post_ids):
+        self._delete_pending_posts(post_ids)
+
+    def _delete_pending_posts(self, post_ids):
+        for post_id in post_ids:
+            self.pending_posts.pop(post_id, None)
+            self.pending_attempts.pop(post_id, None)
+
+    async def get_pending_posts(self):
+        return sorted(self.pending_posts.values(), key=lambda row: row[3])
+
+    async def retry_pending_posts(self, post_ids, max_attempts):
+        rows = []
+        for post_id in dict.fromkeys(post_ids):
+            if post_id not in self.pending_posts:
+                continue
+            self.pending_attempts[post_id] = self.pending_attempts.get(post_id, 0) + 1
+            if self.pending_attempts[post_id] >= max_attempts:
+                rows.append(self.pending_posts[post_id][:3])
+        self._delete_pending_posts([row[0] for row in rows])
+        return rows
+
+    async def next_digest_id(self):
+        return max(self.digests, default=0) + 1
+
+    async def add_digest(self, digest_id, post_ids, confirmations):
+        self.digests.setdefault(digest_id, []).extend(post_ids)
+        for post_id, admin_id, admin_message_id in confirmations:
+            self._add_confirmation_post(post_id, admin_id, admin_message_id)
+        self._delete_pending_posts(post_ids)
+
+    async def resolve_digest(self, digest_id):
+        post_ids = self.digests.pop(digest_id, []) + [f"digest_{digest_id}"]
+        return self._pop_confirmations(post_ids)
+
+    async def add_scheduled_post(self, channel_id, message_id, time_added):
+        seq = next(self.seq)
+        heapq.heappush(self.scheduled, (_stored(time_added), seq, channel_id, message_id))
+        self.scheduled_keys.setdefault((channel_id, message_id), set()).add(seq)
+
+    def _scheduled_alive(self, entry):
+        return entry[1] in self.scheduled_keys.get((entry[2], entry[3]), ())
+
+    async def delete_scheduled_post(self, channel_id, message_id):
+        self.scheduled_keys.pop((channel_id, message_id), None)
+
+    async def delete_scheduled_posts(self, channel_id):
+        for key in [key for key in self.scheduled_keys if key[0] == channel_id]:
+            del self.scheduled_keys[key]
+
+    async def count_scheduled_posts(self):
+        return sum(len(seqs) for seqs in self.scheduled_keys.values())
+
+    async def get_scheduled_post(self):
+        while self.scheduled and not self._scheduled_alive(self.scheduled[0]):
+            heapq.heappop(self.scheduled)
+        if not self.scheduled:
+            return None, None, None
+        time_added, _, channel_id, message_id = self.scheduled[0]
+        return channel_id, message_id, time_added
+
+    async def add_media_hash(self, media_hash, date):
+        self._add_media_hash(media_hash, date)
+
+    def _add_media_hash(self, media_hash, date):
+        seq = next(self.seq)
+        date = _stored(date)
+        self.hashes.setdefault(media_hash, []).append((seq, date))
+        heapq.heappush(self.hash_dates, (date, seq, media_hash))
+        self.hash_rows += 1
+
+    def _find_hash(self, media_hash, since):
+        since = _stored(since)
+        for _, date in self.hashes.get(media_hash, ()):
+            if since is None or date >= since:
+                return date
+        return None
+
+    async def claim_media_hash(self, media_hash, date, since=None):
+        # nothing is awaited between the check and the insert, so claims can't interleave
+        if self._find_hash(media_hash, since) is not None:
+            return False
+        self._add_media_hash(media_hash, date)
+        return True
+
+    async def delete_media_hash(self, media_hash):
+        self.hash_rows -= len(self.hashes.pop(media_hash, ()))
+
+    async def get_media_hash(self, media_hash, since=None):
+        date = self._find_hash(media_hash, since)
+        return (media_hash, date) if date is not None else (None, None)
+
+    async def prune_media_hashes(self, before, limit):
+        before = _stored(before)
+        pruned = 0
+        while self.hash_dates and self.hash_dates[0][0] < before and pruned < limit:
+            _, seq, media_hash = heapq.heappop(self.hash_dates)
+            rows = self.hashes.get(media_hash)
+            if not rows or not any(row_seq == seq for row_seq, _ in rows):
+                continue
+            rows[:] = [row for row in rows if row[0] != seq]
+            if not rows:
+                del self.hashes[media_hash]
+            self.hash_rows -= 1
+            pruned += 1
+        return pruned
+
+    async def add_entities(self, entities):
+        for entity_id, title, username, updated in entities:
+            self.entities[entity_id] = (entity_id, title, username, _stored(updated))
+
+    async def get_entities(self, entity_ids):
+        return [self.entities[entity_id] for entity_id in dict.fromkeys(entity_ids) if entity_id in self.entities]
+
+    async def get_stale_entities(self, before, limit):
+        before = _stored(before)
+        return heapq.nsmallest(limit, (entity for entity in self.entities.values() if entity[3] < before),
+                               key=lambda entity: entity[3])
+
+    async def delete_entity(self, entity_id):
+        self.entities.pop(entity_id, None)
+
+    async def get_table_sizes(self):
+        return {
+            "Hashes": self.hash_rows,
+            "ConfirmationPosts": sum(len(rows) for rows in self.confirmations.values()),
+            "ScheduledPosts": await self.count_scheduled_posts(),
+            "PendingPosts": len(self.pending_posts),
+            "AlbumItems": sum(len(message_ids) for message_ids in self.albums.values()),
+            "Sources": len(self.sources),
+            "Admins": len(self.admins),
+            "Jobs": len(self.jobs),
+        }
+
+    async def add_backfill(self, channel_id, remaining, until):
+        self.backfills[channel_id] = [channel_id, 0, remaining, _stored(until), 0]
+
+    async def update_backfill(self, channel_id, offset_id, remaining, processed):
+        backfill = self.backfills.get(channel_id)
+        if backfill is not None:
+            backfill[1], backfill[2], backfill[4] = offset_id, remaining, processed
+
+    async def delete_backfill(self, channel_id):
+        self.backfills.pop(channel_id, None)
+
+    async def get_backfill(self, channel_id):
+        backfill = self.backfills.get(channel_id)
+        return tuple(backfill) if backfill is not None else (None, None, None, None, None)
+
+    async def get_backfills(self):
+        return [tuple(backfill) for backfill in self.backfills.values()]
+
+    async def update_source_mark(self, channel_id, message_id):
+        self.source_marks[channel_id] = max(self.source_marks.get(channel_id, message_id), message_id)
+
+    async def delete_source_mark(self, channel_id):
+        self.source_marks.pop(channel_id, None)
+
+    async def get_source_marks(self):
+        return list(self.source_marks.items())
+
+    async def add_interrupted_posts(self, posts, time_added):
+        self.interrupted_posts.extend((channel_id, message_id, stage, media_hash, _stored(time_added))
+                                      for channel_id, message_id, stage, media_hash in posts)
+
+    async def get_interrupted_posts(self):
+        return sorted(self.interrupted_posts, key=lambda row: row[4])
+
+    async def delete_interrupted_posts(self, channel_id, message_ids):
+        message_ids = set(message_ids)
+        self.interrupted_posts = [row for row in self.interrupted_posts
+                                  if row[0] != channel_id or row[1] not in message_ids]
+
+    async def add_job(self, kind, payload, available_at):
+        job_id = next(self.job_ids)
+        self.jobs[job_id] = [job_id, kind, payload, "queued", 0, _stored(available_at), None, None, None]
+        return job_id
+
+    async def lease_job(self, kind, owner, now, lease_until):
+        now = _stored(now)
+        available = [job for job in self.jobs.values() if job[1] == kind and
+                     (job[3] == "queued" and job[5] <= now or job[3] == "leased" and job[7] < now)]
+        if not available:
+            return None
+        job = min(available, key=lambda job: (job[5], job[0]))
+        job[3], job[6], job[7] = "leased", owner, _stored(lease_until)
+        job[4] += 1
+        return job[0], job[2], job[4]
+
+    def _leased_job(self, job_id, owner):
+        job = self.jobs.get(job_id)
+        return job if job is not None and job[6] == owner else None
+
+    async def extend_job_lease(self, job_id, owner, lease_until):
+        job = self._leased_job(job_id, owner)
+        if job is None or job[3] != "leased":
+            return 0
+        job[7] = _stored(lease_until)
+        return 1
+
+    async def complete_job(self, job_id, owner):
+        if self._leased_job(job_id, owner) is not None:
+            del self.jobs[job_id]
+
+    async def fail_job(self, job_id, owner, state, available_at, error):
+        job = self._leased_job(job_id, owner)
+        if job is not None:
+            job[3], job[5], job[6], job[7], job[8] = state, _stored(available_at), None, None, error
+
+    async def release_job(self, job_id, owner):
+        job = self._leased_job(job_id, owner)
+        if job is not None:
+            job[3], job[6], job[7] = "queued", None, None
+            job[4] -= 1
+
+    async def count_jobs(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[(job[1], job[3])] = counts.get((job[1], job[3]), 0) + 1
+        return [(kind, state, count) for (kind, state), count in sorted(counts.items())]
+
+    async def add_album(self, channel_id, album_id, message_ids):
+        self.albums.setdefault((channel_id, album_id), []).extend(message_ids)
+
+    async def delete_album(self, channel_id, album_id):
+        self.albums.pop((channel_id, album_id), None)
+
+    async def delete_albums(self, channel_id):
+        for key in [key for key in self.albums if key[0] == channel_id]:
+            del self.albums[key]
+
+    async def get_album(self, channel_id, album_id):
+        return sorted(self.albums.get((channel_id, album_id), ()))
@@ -0,0 +1,108 @@
+import logging
+import os
+import sys
+import tracemalloc
+import types
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+                 types.CodeType, types.FrameType)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # only the peak is available outside linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def deep_size(obj, exclude=(), limit=200000):
+    # clients and other shared objects are passed in `exclude`, otherwise every buffered message would count them
+    seen = set(exclude)
+    stack = [obj]
+    size = 0
+    while stack and len(seen) < limit:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, SKIPPED_TYPES):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)) or type(current).__name__ == "deque":
+            stack.extend(current)
+        elif hasattr(current, "__dict__"):
+            # private attributes hold back references such as message._client
+            stack.extend(value for name, value in vars(current).items() if not name.startswith("_"))
+    return size
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class MemoryProfiler:
+    def __init__(self, frames=10, top=10):
+        self.frames = frames
+        self.top = top
+        self.baseline = None
+        self.started = None
+
+    @property
+    def active(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if self.active:
+            return False
+        # tracing slows every allocation down, so it only runs between start and stop
+        tracemalloc.start(self.frames)
+        self.baseline = self.snapshot()
+        self.started = datetime.now()
+        logger.info("Memory profiling started")
+        return True
+
+    def stop(self):
+        if not self.active:
+            return False
+        tracemalloc.stop()
+        self.baseline = None
+        self.started = None
+        logger.info("Memory profiling stopped")
+        return True
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ])
+
+    def diff(self):
+        stats = self.snapshot().compare_to(self.baseline, "lineno")
+        top = []
+        for stat in stats[:self.top]:
+            frame = stat.traceback[0]
+            location = os.sep.join(frame.filename.split(os.sep)[-2:])
+            top.append((f"{location}:{frame.lineno}", stat.size_diff, stat.size, stat.count_diff))
+        return top
+
+    def traced(self):
+        return tracemalloc.get_traced_memory()
@@ -0,0 +1,267 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        return super().render()
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series["buckets"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def quantile(self, q, **labels):
+        series = self.values.get(self._key(labels))
+        if not series or not series["count"]:
+            return None
+        target = q * series["count"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, series["buckets"]):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+POSTS = registry.counter("destructg_posts_total",
+                         "Posts that reached a pipeline stage",
+                         ["stage"])
+STAGE_SECONDS = registry.histogram("destructg_stage_seconds",
+                                   "Time spent in a pipeline stage",
+                                   ["stage"])
+DB_SECONDS = registry.histogram("destructg_db_seconds",
+                                "Latency of DBManager calls",
+                                ["method"],
+                                buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+QUEUE_DEPTH = registry.gauge("destructg_queue_depth",
+                             "Messages currently in the ingestion pipeline")
+OVERFLOW_QUEUE_SIZE = registry.gauge("destructg_overflow_queue_size",
+                                     "Posts waiting in ScheduledPosts because the schedule is full")
+PRUNED_ROWS = registry.counter("destructg_pruned_rows_total",
+                               "Rows removed by the retention pruner",
+                               ["table"])
+CALLBACK_SECONDS = registry.histogram("destructg_callback_seconds",
+                                      "Time spent handling a bot button press",
+                                      ["route"])
+LOOP_LAG_SECONDS = registry.histogram("destructg_loop_lag_seconds",
+                                      "How late the event loop ran the watchdog tick",
+                                      buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_STALLS = registry.counter("destructg_loop_stalls_total",
+                               "Event loop stalls longer than the watchdog threshold",
+                               ["task"])
+COMPONENT_RESTARTS = registry.counter("destructg_component_restarts_total",
+                                     "Restarts of supervised components",
+                                     ["component"])
+COMPONENT_FAILURES = registry.counter("destructg_component_failures_total",
+                                      "Failures of one-shot components that are not restarted",
+                                      ["component"])
+JOBS = registry.counter("destructg_jobs_total",
+                        "Jobs passed between processes by outcome",
+                        ["kind", "outcome"])
+ADMISSION_REJECTED = registry.counter("destructg_admission_rejected_total",
+                                     "Posts rejected by admission rules before download",
+                                     ["rule"])
+LOG_RECORDS_DROPPED = registry.counter("destructg_log_records_dropped_total",
+                                      "Log records that were not written",
+                                      ["reason"])
+STARTUP_SECONDS = registry.gauge("destructg_startup_seconds",
+                                 "Seconds from process start to a startup phase",
+                                 ["phase"])
+
+
+def timed_methods(histogram):
+    def decorator(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.iscoroutinefunction(method):
+                continue
+            setattr(cls, name, _timed(histogram, name, method))
+        return cls
+    return decorator
+
+
+def _timed(histogram, name, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start, method=name)
+    return wrapper
+
+
+class MetricsServer:
+    def __init__(self, metrics_registry, host="127.0.0.1", port=9108):
+        self.registry = metrics_registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Metrics are served on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = self.registry.render().encode("utf-8")
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except Exception as e:
+            logger.error("Error while serving metrics: %s", e)
+        finally:
+            writer.close()
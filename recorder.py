@@ -0,0 +1,89 @@
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def media_type(message):
+    if message.photo:
+        return "photo"
+    if message.video:
+        return "video"
+    if message.document:
+        return "document"
+    return None
+
+
+def media_metadata(message):
+    file = message.file
+    media = message.photo or message.document
+    return {
+        "media_type": media_type(message),
+        "media_id": getattr(media, "id", None),
+        "size": getattr(file, "size", None),
+        "mime_type": getattr(file, "mime_type", None),
+        "duration": getattr(file, "duration", None),
+        "width": getattr(file, "width", None),
+        "height": getattr(file, "height", None),
+    }
+
+
+class UpdateRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.recorded = 0
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, "a", buffering=1)
+            logger.info("Recording incoming updates to %s", self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _write(self, entry):
+        try:
+            self.open()
+            self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        except Exception as e:
+            logger.error("Error while recording update: %s", e)
+
+    def record_update(self, collector, source_id, message):
+        entry = {
+            "type": "update",
+            "received": round(time.time(), 3),
+            "collector": collector,
+            "source_id": source_id,
+            "message_id": message.id,
+            "grouped_id": message.grouped_id,
+            "date": message.date.timestamp() if message.date else None,
+        }
+        entry.update(media_metadata(message))
+        self._write(entry)
+        self.recorded += 1
+
+    def record_hash(self, source_id, message_id, media_hash):
+        self._write({"type": "hash", "source_id": source_id, "message_id": message_id, "content_hash": media_hash})
+
+
+def load_recording(path):
+    updates = []
+    hashes = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get("type") == "hash":
+                hashes[(entry["source_id"], entry["message_id"])] = entry["content_hash"]
+            else:
+                updates.append(entry)
+    for update in updates:
+        update["content_hash"] = hashes.get((update["source_id"], update["message_id"]))
+    updates.sort(key=lambda update: update["received"])
+    return updates
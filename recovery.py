@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class GapRecovery:
+    def __init__(self, processor, concurrency=4, max_messages=1000, batch_size=20):
+        self.processor = processor
+        self.db_manager = processor.db_manager
+        self.concurrency = concurrency
+        self.max_messages = max_messages
+        self.batch_size = batch_size
+
+    async def recover(self):
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sources = list(self.processor.sources)
+        results = await asyncio.gather(*[self._recover_source(source_id, semaphore) for source_id in sources],
+                                       return_exceptions=True)
+        recovered = 0
+        for source_id, result in zip(sources, results):
+            if isinstance(result, Exception):
+                logger.error("Gap recovery for %s failed: %s", source_id, result)
+            else:
+                recovered += result
+        logger.info("Gap recovery finished in %.2fs, %s missed messages processed from %s sources",
+                    time.monotonic() - started, recovered, len(sources))
+
+    async def _recover_source(self, source_id, semaphore):
+        client = self.processor.pool.client_for(source_id)
+        async with semaphore:
+            latest = await client.get_messages(source_id, limit=1)
+            if not latest:
+                return 0
+            mark = self.processor.source_marks.get(source_id)
+            if mark is None:
+                await self.processor.update_source_mark(source_id, latest[0].id)
+                return 0
+            recovered = 0
+            held = []
+            while recovered < self.max_messages:
+                limit = min(self.batch_size, self.max_messages - recovered)
+                messages = await client.get_messages(source_id, min_id=mark, max_id=latest[0].id + 1,
+                                                     reverse=True, limit=limit)
+                # the next batch is held before the previous one is released, live messages that finish
+                # meanwhile can't move the mark past missed ones, a failed recovery leaves it held
+                self._hold(source_id, messages)
+                await self._release(source_id, held)
+                held = messages
+                if not messages:
+                    break
+                await self._recover_batch(client, source_id, messages)
+                recovered += len(messages)
+                mark = messages[-1].id
+                if len(messages) < limit:
+                    break
+            await self._release(source_id, held)
+            if recovered:
+                logger.info("Recovered %s missed messages from %s", recovered, source_id)
+            return recovered
+
+    def _hold(self, source_id, messages):
+        for message in messages:
+            self.processor.hold_mark(source_id, message.id)
+
+    async def _release(self, source_id, messages):
+        # on shutdown the messages that were never started keep the mark below them
+        if self.processor.accepting:
+            for message in messages:
+                await self.processor.release_mark(source_id, message.id)
+
+    async def _recover_batch(self, client, source_id, messages):
+        # messages of a batch run concurrently, the batch hold keeps the mark below the slowest of them
+        results = await asyncio.gather(*[self.processor.handle_message(client, source_id, message, check_mark=False)
+                                         for message in messages], return_exceptions=True)
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                logger.error("Error while recovering message %s from %s: %s", message.id, source_id, result)
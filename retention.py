@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from metrics import PRUNED_ROWS
+from stats import HOURLY_RETENTION_DAYS, hour_bucket
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPruner:
+    def __init__(self, processor, interval=3600, batch_size=500, batch_delay=0.1):
+        self.processor = processor
+        self.db_manager = processor.db_manager
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.running = False
+        self.last_run = None
+        self.last_duration = None
+        self.last_pruned_hashes = 0
+        self.last_expired_confirmations = 0
+        self.pruned_hashes = 0
+        self.expired_confirmations = 0
+
+    async def run(self):
+        while True:
+            try:
+                await self.prune()
+            except Exception as e:
+                logger.error("Error while pruning old data: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def prune(self):
+        if self.running:
+            return False
+        self.running = True
+        start = time.perf_counter()
+        try:
+            self.last_pruned_hashes = await self.prune_hashes()
+            self.last_expired_confirmations = await self.expire_confirmations()
+            await self.prune_spool()
+            await self.prune_source_stats()
+        finally:
+            self.running = False
+            self.last_run = datetime.now()
+            self.last_duration = time.perf_counter() - start
+        logger.info("Pruned %s hashes and %s confirmation posts in %.2fs",
+                    self.last_pruned_hashes, self.last_expired_confirmations, self.last_duration)
+        return True
+
+    async def prune_hashes(self):
+        dedup_window = self.processor.settings.current.dedup_window
+        if not dedup_window:
+            return 0
+        before = datetime.now() - timedelta(days=dedup_window)
+        pruned = 0
+        while True:
+            # small batches keep every write transaction short so the pipeline is never blocked for long
+            deleted = await self.db_manager.prune_media_hashes(before, self.batch_size)
+            pruned += deleted
+            PRUNED_ROWS.inc(deleted, table="Hashes")
+            self.pruned_hashes += deleted
+            if deleted < self.batch_size:
+                return pruned
+            await asyncio.sleep(self.batch_delay)
+
+    async def prune_source_stats(self):
+        # daily rows are kept forever, hourly ones are only needed for recent charts
+        before = hour_bucket(datetime.now() - timedelta(days=HOURLY_RETENTION_DAYS))
+        while True:
+            deleted = await self.db_manager.prune_source_stats("h", before, self.batch_size)
+            PRUNED_ROWS.inc(deleted, table="SourceStats")
+            if deleted < self.batch_size:
+                return
+            await asyncio.sleep(self.batch_delay)
+
+    async def prune_spool(self):
+        # files of approval jobs that never ran are not needed once their confirmation would have expired
+        confirmation_ttl = self.processor.settings.current.confirmation_ttl
+        if confirmation_ttl:
+            await self.processor.spool.prune(datetime.now() - timedelta(hours=confirmation_ttl))
+
+    async def expire_confirmations(self):
+        confirmation_ttl = self.processor.settings.current.confirmation_ttl
+        if not confirmation_ttl:
+            return 0
+        before = datetime.now() - timedelta(hours=confirmation_ttl)
+        expired = 0
+        while True:
+            confirmation_posts = await self.db_manager.expire_confirmation_posts(before, self.batch_size)
+            if not confirmation_posts:
+                return expired
+            expired += len(confirmation_posts)
+            PRUNED_ROWS.inc(len(confirmation_posts), table="ConfirmationPosts")
+            self.expired_confirmations += len(confirmation_posts)
+            for post_id in dict.fromkeys(post[0] for post in confirmation_posts):
+                if post_id.startswith("digest_"):
+                    continue
+                source_id, message_id = post_id.split("_")
+                await self.db_manager.delete_album(int(source_id), int(message_id))
+            try:
+                await self.processor.delete_confirmation_messages(confirmation_posts)
+            except Exception as e:
+                logger.error("Error while deleting expired confirmation messages: %s", e)
+            await asyncio.sleep(self.batch_delay)
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+from dataclasses import dataclass, field, fields
+
+from admission import AdmissionRules, parse_rules
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PREDICATES = {
+    "pic+vid": lambda message: bool(message.photo or message.video),
+    "pic": lambda message: bool(message.photo),
+    "vid": lambda message: bool(message.video),
+}
+APPROVAL_MODES = ("single", "digest")
+# the watermark path was stored under this name before settings became a snapshot
+SETTING_NAMES = {"watermark_path": "watermark"}
+
+
+def _reject_all(message):
+    return False
+
+
+@dataclass(frozen=True)
+class Settings:
+    watermark_path: str = ""
+    caption: str = ""
+    bottom_delay: int = 720
+    top_delay: int = 1440
+    media_types: str = "pic+vid"
+    approval_mode: str = "single"
+    digest_interval: int = 60
+    dedup_window: int = 180
+    # bots can only delete their messages for 48 hours, expire confirmations before that
+    confirmation_ttl: int = 36
+    admission_rules: str = ""
+    watermark: bytes = field(default=None, repr=False, compare=False)
+    media_predicate: object = field(default=None, init=False, repr=False, compare=False)
+    admission: object = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "media_predicate", MEDIA_PREDICATES.get(self.media_types, _reject_all))
+        object.__setattr__(self, "admission", AdmissionRules(parse_rules(self.admission_rules)))
+
+
+STORED_FIELDS = [f for f in fields(Settings) if f.name not in ("watermark", "media_predicate", "admission")]
+
+
+def setting_name(field_name):
+    return SETTING_NAMES.get(field_name, field_name)
+
+
+def parse_setting(field_name, value):
+    settings_field = next(f for f in STORED_FIELDS if f.name == field_name)
+    if settings_field.type is int:
+        value = int(value)
+        if value < 0:
+            raise ValueError(f"{field_name} can't be negative")
+        return value
+    if field_name == "admission_rules":
+        # rules come as a JSON string from the bot and the database, and as an object from config.json
+        rules = parse_rules(value)
+        return json.dumps(rules, ensure_ascii=False) if rules else ""
+    value = str(value)
+    if field_name == "media_types" and value not in MEDIA_PREDICATES:
+        raise ValueError(f"unknown media types {value}")
+    if field_name == "approval_mode" and value not in APPROVAL_MODES:
+        raise ValueError(f"unknown approval mode {value}")
+    return value
+
+
+class SettingsManager:
+    def __init__(self, db_manager, config_path="config.json"):
+        self.db_manager = db_manager
+        self.config_path = config_path
+        self.current = Settings()
+        self.rows = None
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        async with self.lock:
+            rows = dict(await self.db_manager.get_settings())
+            self.rows = rows
+            defaults = Settings()
+            missing = [(setting_name(f.name), str(getattr(defaults, f.name)))
+                       for f in STORED_FIELDS if setting_name(f.name) not in rows]
+            if missing:
+                logger.info("Settings not found, setting to defaults: %s", ', '.join(name for name, _ in missing))
+                await self.db_manager.add_settings(missing)
+            values = {}
+            for settings_field in STORED_FIELDS:
+                raw_value = rows.get(setting_name(settings_field.name))
+                if raw_value is None:
+                    continue
+                try:
+                    values[settings_field.name] = parse_setting(settings_field.name, raw_value)
+                except ValueError as e:
+                    logger.error("Invalid setting %s (%s), using default: %s", settings_field.name, raw_value, e)
+            self.current = await self._build(values)
+            logger.info("Settings loaded: %s", self.current)
+            return self.current
+
+    async def update(self, **changes):
+        async with self.lock:
+            values = {name: parse_setting(name, value) for name, value in changes.items()}
+            await self.db_manager.update_settings([(setting_name(name), str(value)) for name, value in values.items()])
+            current = {f.name: getattr(self.current, f.name) for f in STORED_FIELDS}
+            current.update(values)
+            watermark = self.current.watermark if "watermark_path" not in values else None
+            # a single assignment, handlers that already took the previous snapshot keep using it
+            self.current = await self._build(current, watermark)
+            return self.current
+
+    async def reload(self, from_config=False):
+        if from_config:
+            changes = self.read_config()
+            if changes:
+                await self.update(**changes)
+        return await self.load()
+
+    async def refresh(self):
+        # other processes change settings in the database, the snapshot is rebuilt only when a row changed
+        if dict(await self.db_manager.get_settings()) == self.rows:
+            return False
+        await self.load()
+        return True
+
+    def read_config(self):
+        try:
+            with open(self.config_path, "r") as f:
+                config_settings = json.load(f).get("settings", {})
+        except (OSError, ValueError) as e:
+            logger.error("Error while reading settings from %s: %s", self.config_path, e)
+            return {}
+        stored_names = {f.name for f in STORED_FIELDS}
+        changes = {}
+        for name, value in config_settings.items():
+            if name not in stored_names:
+                logger.error("Unknown setting %s in %s, skipping", name, self.config_path)
+                continue
+            try:
+                changes[name] = parse_setting(name, value)
+            except ValueError as e:
+                logger.error("Invalid setting %s in %s, skipping: %s", name, self.config_path, e)
+        return changes
+
+    async def _build(self, values, watermark=None):
+        watermark_path = values.get("watermark_path", "")
+        if watermark_path and watermark is None:
+            try:
+                with open(watermark_path, "rb") as f:
+                    watermark = f.read()
+            except FileNotFoundError:
+                logger.info("Watermark file was probably moved or deleted, setting watermark path to (\"\")")
+                values["watermark_path"] = ""
+                await self.db_manager.update_settings([(setting_name("watermark_path"), "")])
+        return Settings(**values, watermark=watermark if values.get("watermark_path") else None)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ("seen", "chance_passed", "duplicate", "approved", "rejected", "published")
+HOURLY_RETENTION_DAYS = 30
+
+
+def hour_bucket(moment):
+    return moment.strftime("%Y-%m-%d %H")
+
+
+def day_bucket(moment):
+    return moment.strftime("%Y-%m-%d")
+
+
+class SourceStats:
+    def __init__(self, db_manager, flush_interval=10):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.pending = {}
+
+    def inc(self, source_id, counter, amount=1):
+        now = datetime.now()
+        for period, bucket in (("h", hour_bucket(now)), ("d", day_bucket(now))):
+            counters = self.pending.setdefault((source_id, period, bucket), [0] * len(COUNTERS))
+            counters[COUNTERS.index(counter)] += amount
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error while flushing source stats: %s", e)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await self.db_manager.add_source_stats([key + tuple(counters) for key, counters in pending.items()])
+        except Exception:
+            # the counts go back to pending, merged with the ones made while the write was running
+            for key, counters in pending.items():
+                merged = self.pending.setdefault(key, [0] * len(COUNTERS))
+                for i, amount in enumerate(counters):
+                    merged[i] += amount
+            raise
+
+    async def totals(self, source_id, days=None):
+        await self.flush()
+        since = day_bucket(datetime.now() - timedelta(days=days - 1)) if days else ""
+        rows = await self.db_manager.get_source_stats_totals("d", since, source_id)
+        return dict(zip(COUNTERS, rows[0][1:])) if rows else dict.fromkeys(COUNTERS, 0)
+
+    async def hourly(self, source_id, hours=24):
+        await self.flush()
+        since = hour_bucket(datetime.now() - timedelta(hours=hours - 1))
+        return [(bucket, dict(zip(COUNTERS, counters)))
+                for bucket, *counters in await self.db_manager.get_source_stats(source_id, "h", since)]
+
+    async def overview(self, days=7):
+        await self.flush()
+        since = day_bucket(datetime.now() - timedelta(days=days - 1))
+        return [(row[0], dict(zip(COUNTERS, row[1:])))
+                for row in await self.db_manager.get_source_stats_totals("d", since)]
@@ -0,0 +1,352 @@
+from abc import ABC, abstractmethod
+
+BACKENDS = ("sqlite", "memory")
+
+
+def create_storage(backend, path, batch_interval=0.005, batch_size=100):
+    if backend == "sqlite":
+        from db_manager import DBManager
+        return DBManager(path, batch_interval=batch_interval, batch_size=batch_size)
+    if backend == "memory":
+        from memory_storage import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend {backend}, expected one of {', '.join(BACKENDS)}")
+
+
+class Storage(ABC):
+    # every backend returns the same tuples as the sqlite rows and compares timestamps the way sqlite stores them
+
+    @abstractmethod
+    async def flush(self):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+    # rows are (UserId, UserState, MenuMessage, Subscription, SuperAdmin), a missing row is returned as a tuple of Nones
+    @abstractmethod
+    async def add_admin(self, user_id, user_state, menu_message, subscription, super_admin):
+        pass
+
+    @abstractmethod
+    async def delete_admin(self, user_id):
+        pass
+
+    @abstractmethod
+    async def get_admin(self, user_id):
+        pass
+
+    @abstractmethod
+    async def get_admins(self):
+        pass
+
+    @abstractmethod
+    async def get_admins_page(self, after_id=None, before_id=None, limit=5):
+        pass
+
+    @abstractmethod
+    async def count_admins(self):
+        pass
+
+    @abstractmethod
+    async def update_user_state(self, user_id, user_state):
+        pass
+
+    @abstractmethod
+    async def update_menu_message(self, user_id, menu_message):
+        pass
+
+    @abstractmethod
+    async def update_subscription(self, user_id, subscription):
+        pass
+
+    @abstractmethod
+    async def update_super_admin(self, user_id, super_admin):
+        pass
+
+    # rows are (ChannelId, State, Chance, PostsAmount), pages are ordered by ChannelId
+    @abstractmethod
+    async def add_source(self, channel_id, state, chance, posts_amount):
+        pass
+
+    @abstractmethod
+    async def delete_source(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def get_source(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def get_sources(self):
+        pass
+
+    @abstractmethod
+    async def get_sources_page(self, after_id=None, before_id=None, limit=5):
+        pass
+
+    @abstractmethod
+    async def count_sources(self):
+        pass
+
+    @abstractmethod
+    async def update_state(self, channel_id, state):
+        pass
+
+    @abstractmethod
+    async def update_chance(self, channel_id, chance):
+        pass
+
+    @abstractmethod
+    async def update_posts_amount(self, channel_id, posts_amount):
+        pass
+
+    @abstractmethod
+    async def increment_posts_amount(self, channel_id, amount=1):
+        pass
+
+    # counters are added to the existing bucket, totals are ordered by published posts
+    @abstractmethod
+    async def add_source_stats(self, rows):
+        pass
+
+    @abstractmethod
+    async def get_source_stats(self, channel_id, period, since):
+        pass
+
+    @abstractmethod
+    async def get_source_stats_totals(self, period, since, channel_id=None):
+        pass
+
+    @abstractmethod
+    async def prune_source_stats(self, period, before, limit):
+        pass
+
+    @abstractmethod
+    async def delete_source_stats(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def add_setting(self, setting_name, setting_value):
+        pass
+
+    @abstractmethod
+    async def update_setting(self, setting_name, setting_value):
+        pass
+
+    @abstractmethod
+    async def get_setting(self, setting_name):
+        pass
+
+    @abstractmethod
+    async def get_settings(self):
+        pass
+
+    @abstractmethod
+    async def add_settings(self, settings):
+        pass
+
+    @abstractmethod
+    async def update_settings(self, settings):
+        pass
+
+    # resolving returns the (PostId, AdminId, AdminMessageId, TimeAdded) rows and removes them in one step
+    @abstractmethod
+    async def add_confirmation_post(self, post_id, admin_id, admin_message_id):
+        pass
+
+    @abstractmethod
+    async def delete_confirmation_posts(self, post_id):
+        pass
+
+    @abstractmethod
+    async def get_confirmation_posts(self, post_id):
+        pass
+
+    @abstractmethod
+    async def resolve_confirmation_posts(self, post_ids):
+        pass
+
+    @abstractmethod
+    async def expire_confirmation_posts(self, before, limit):
+        pass
+
+    @abstractmethod
+    async def add_pending_post(self, post_id, channel_id, message_id, time_added):
+        pass
+
+    @abstractmethod
+    async def delete_pending_posts(self, post_ids):
+        pass
+
+    @abstractmethod
+    async def get_pending_posts(self):
+        pass
+
+    @abstractmethod
+    async def retry_pending_posts(self, post_ids, max_attempts):
+        pass
+
+    @abstractmethod
+    async def next_digest_id(self):
+        pass
+
+    @abstractmethod
+    async def add_digest(self, digest_id, post_ids, confirmations):
+        pass
+
+    @abstractmethod
+    async def resolve_digest(self, digest_id):
+        pass
+
+    # the overflow queue of posts that did not fit into the schedule, oldest first
+    @abstractmethod
+    async def add_scheduled_post(self, channel_id, message_id, time_added):
+        pass
+
+    @abstractmethod
+    async def delete_scheduled_post(self, channel_id, message_id):
+        pass
+
+    @abstractmethod
+    async def delete_scheduled_posts(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def count_scheduled_posts(self):
+        pass
+
+    @abstractmethod
+    async def get_scheduled_post(self):
+        pass
+
+    # claiming checks and inserts atomically, so two posts can never claim the same hash
+    @abstractmethod
+    async def add_media_hash(self, media_hash, date):
+        pass
+
+    @abstractmethod
+    async def claim_media_hash(self, media_hash, date, since=None):
+        pass
+
+    @abstractmethod
+    async def delete_media_hash(self, media_hash):
+        pass
+
+    @abstractmethod
+    async def get_media_hash(self, media_hash, since=None):
+        pass
+
+    @abstractmethod
+    async def prune_media_hashes(self, before, limit):
+        pass
+
+    @abstractmethod
+    async def add_entities(self, entities):
+        pass
+
+    @abstractmethod
+    async def get_entities(self, entity_ids):
+        pass
+
+    @abstractmethod
+    async def get_stale_entities(self, before, limit):
+        pass
+
+    @abstractmethod
+    async def delete_entity(self, entity_id):
+        pass
+
+    @abstractmethod
+    async def get_table_sizes(self):
+        pass
+
+    @abstractmethod
+    async def add_backfill(self, channel_id, remaining, until):
+        pass
+
+    @abstractmethod
+    async def update_backfill(self, channel_id, offset_id, remaining, processed):
+        pass
+
+    @abstractmethod
+    async def delete_backfill(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def get_backfill(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def get_backfills(self):
+        pass
+
+    @abstractmethod
+    async def update_source_mark(self, channel_id, message_id):
+        pass
+
+    @abstractmethod
+    async def delete_source_mark(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def get_source_marks(self):
+        pass
+
+    @abstractmethod
+    async def add_interrupted_posts(self, posts, time_added):
+        pass
+
+    @abstractmethod
+    async def get_interrupted_posts(self):
+        pass
+
+    @abstractmethod
+    async def delete_interrupted_posts(self, channel_id, message_ids):
+        pass
+
+    # leasing picks the oldest available job and increments its attempts
+    @abstractmethod
+    async def add_job(self, kind, payload, available_at):
+        pass
+
+    @abstractmethod
+    async def lease_job(self, kind, owner, now, lease_until):
+        pass
+
+    @abstractmethod
+    async def extend_job_lease(self, job_id, owner, lease_until):
+        pass
+
+    @abstractmethod
+    async def complete_job(self, job_id, owner):
+        pass
+
+    @abstractmethod
+    async def fail_job(self, job_id, owner, state, available_at, error):
+        pass
+
+    @abstractmethod
+    async def release_job(self, job_id, owner):
+        pass
+
+    @abstractmethod
+    async def count_jobs(self):
+        pass
+
+    @abstractmethod
+    async def add_album(self, channel_id, album_id, message_ids):
+        pass
+
+    @abstractmethod
+    async def delete_album(self, channel_id, album_id):
+        pass
+
+    @abstractmethod
+    async def delete_albums(self, channel_id):
+        pass
+
+    @abstractmethod
+    async def get_album(self, channel_id, album_id):
+        pass
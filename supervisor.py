@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+
+from metrics import COMPONENT_FAILURES, COMPONENT_RESTARTS
+
+logger = logging.getLogger(__name__)
+
+
+class Component:
+    def __init__(self, name, factory, restart):
+        self.name = name
+        self.factory = factory
+        self.restart = restart
+        self.task = None
+        self.restarts = 0
+        self.last_error = None
+
+
+class Supervisor:
+    def __init__(self, min_backoff=1, max_backoff=60, healthy_after=60):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.healthy_after = healthy_after
+        self.components = {}
+        self.stopping = asyncio.Event()
+
+    def add(self, name, factory, restart=True):
+        # factory is called again for every restart, so it has to return a fresh coroutine
+        component = Component(name, factory, restart)
+        self.components[name] = component
+        component.task = asyncio.create_task(self._supervise(component), name=name)
+        return component
+
+    def request_stop(self):
+        if not self.stopping.is_set():
+            logger.info("Shutdown requested")
+            self.stopping.set()
+
+    async def wait(self):
+        await self.stopping.wait()
+
+    async def stop(self, timeout=10):
+        # components are stopped in reverse order, the clients that were added first go last
+        for component in reversed(list(self.components.values())):
+            if component.task is None or component.task.done():
+                continue
+            component.task.cancel()
+            try:
+                await asyncio.wait_for(component.task, timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                pass
+            except Exception as e:
+                logger.error("Error while stopping %s: %s", component.name, e)
+        logger.info("All components stopped")
+
+    async def _supervise(self, component):
+        backoff = self.min_backoff
+        while True:
+            started = time.monotonic()
+            try:
+                await component.factory()
+                error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = component.last_error = e
+            # a one-shot component runs once even if it failed, running it again would repeat its work
+            if not component.restart:
+                if error is not None:
+                    logger.error("Component %s failed, not restarting it: %s", component.name, error, exc_info=error)
+                    COMPONENT_FAILURES.inc(component=component.name)
+                return
+            if self.stopping.is_set():
+                return
+            # a component that ran for a while starts from the shortest delay again
+            if time.monotonic() - started >= self.healthy_after:
+                backoff = self.min_backoff
+            if error is None:
+                logger.warning("Component %s stopped, restarting in %ss", component.name, backoff)
+            else:
+                logger.error("Component %s failed, restarting in %ss: %s", component.name, backoff, error,
+                             exc_info=error)
+            component.restarts += 1
+            COMPONENT_RESTARTS.inc(component=component.name)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
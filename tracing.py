@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, key, name):
+        self.tracer = tracer
+        self.key = key
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add_span(self.key, self.name, self.start, error=exc_type.__name__ if exc_type else None)
+        return False
+
+
+class Tracer:
+    def __init__(self, enabled=False, max_traces=1000):
+        self.enabled = enabled
+        self.max_traces = max_traces
+        self.traces = OrderedDict()
+        self.open_spans = {}
+        self.epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def configure(self, enabled, max_traces=1000):
+        self.enabled = enabled
+        self.max_traces = max_traces
+        if not enabled:
+            self.traces.clear()
+            self.open_spans.clear()
+
+    @staticmethod
+    def now():
+        return time.perf_counter_ns()
+
+    def span(self, key, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, key, name)
+
+    def add_span(self, key, name, start, end=None, error=None):
+        if not self.enabled:
+            return
+        spans = self.traces.get(key)
+        if spans is None:
+            spans = self.traces[key] = []
+            if len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        spans.append((name, start, (end or time.perf_counter_ns()) - start, error))
+
+    def open_span(self, key, name):
+        if self.enabled:
+            self.open_spans[(key, name)] = time.perf_counter_ns()
+            if len(self.open_spans) > self.max_traces:
+                del self.open_spans[next(iter(self.open_spans))]
+
+    def close_span(self, key, name):
+        if not self.enabled:
+            return
+        start = self.open_spans.pop((key, name), None)
+        if start is not None:
+            self.add_span(key, name, start)
+
+    def last_traces(self, amount=None):
+        traces = list(self.traces.items())
+        return traces[-amount:] if amount else traces
+
+    def chrome_trace(self, amount=None):
+        events = []
+        for tid, (key, spans) in enumerate(self.last_traces(amount), start=1):
+            source_id, message_id = key
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid,
+                           "args": {"name": f"{source_id}/{message_id}"}})
+            for name, start, duration, error in spans:
+                args = {"source_id": source_id, "message_id": message_id}
+                if error:
+                    args["error"] = error
+                events.append({"name": name, "ph": "X", "pid": 1, "tid": tid,
+                               "ts": (start + self.epoch_offset_ns) / 1000, "dur": duration / 1000,
+                               "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome(self, path, amount=None):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(amount), f)
+        return path
+
+    def export_jsonl(self, path, amount=None):
+        with open(path, "w") as f:
+            for (source_id, message_id), spans in self.last_traces(amount):
+                f.write(json.dumps({"source_id": source_id,
+                                    "message_id": message_id,
+                                    "spans": [[name, round((start + self.epoch_offset_ns) / 1e6, 3),
+                                               round(duration / 1e6, 3), error]
+                                              for name, start, duration, error in spans]},
+                                   separators=(",", ":")) + "\n")
+        return path
+
+    def export(self, directory, trace_format="chrome", amount=None):
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        if trace_format == "jsonl":
+            path = os.path.join(directory, f"traces-{timestamp}.jsonl")
+            self.export_jsonl(path, amount)
+        else:
+            path = os.path.join(directory, f"traces-{timestamp}.json")
+            self.export_chrome(path, amount)
+        logger.info("Exported %s traces to %s", len(self.last_traces(amount)), path)
+        return path
+
+
+tracer = Tracer()